@@ -0,0 +1,18 @@
+"""
+One-time setup for a deployment. A single uvicorn process runs it from its
+startup hook; under gunicorn (gunicorn.conf.py) the master runs it once as
+`python -m app.bootstrap` before forking workers and sets STARTUP_PREPARED
+so the workers skip it.
+"""
+from .config.monitoring import MetricsCollector
+from .models.database import create_schema, count_active_whitelist
+
+
+def prepare():
+    """Create the schema and publish the whitelist size"""
+    create_schema()
+    MetricsCollector.set_whitelisted_ips(count_active_whitelist())
+
+
+if __name__ == "__main__":
+    prepare()
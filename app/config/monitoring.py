@@ -1,7 +1,26 @@
-from prometheus_client import Counter, Histogram, Gauge
-from typing import Dict
+from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, multiprocess
+from typing import Any, Dict, List, Tuple
+import os
 
 
+def metrics_registry() -> CollectorRegistry:
+    """
+    Registry that /metrics and the admin summaries read. When several
+    workers run with PROMETHEUS_MULTIPROC_DIR set, each one writes its
+    values to files in that directory and this collects all of them.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+
+# Gauges say how to combine worker values in multi-process mode: livesum for
+# per-worker amounts, livemax for worst-worker state, mostrecent for values
+# every worker computes alike
+
 # Request metrics
 REQUEST_COUNT = Counter(
     'sentinel_http_requests_total',
@@ -9,10 +28,33 @@ REQUEST_COUNT = Counter(
     ['method', 'endpoint', 'status']
 )
 
+# Shield decisions served in-process take well under a millisecond
+REQUEST_LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
 REQUEST_LATENCY = Histogram(
     'sentinel_http_request_duration_seconds',
     'HTTP request latency',
-    ['endpoint']
+    ['endpoint'],
+    buckets=REQUEST_LATENCY_BUCKETS
+)
+
+ENDPOINT_LABEL_OVERFLOW = Counter(
+    'sentinel_http_endpoint_label_overflow_total',
+    'Requests counted under the "other" endpoint because the endpoint label limit was reached'
+)
+
+# Request path stage metrics
+STAGE_LATENCY = Histogram(
+    'sentinel_stage_duration_seconds',
+    'Time spent in each step of handling a request',
+    ['stage'],
+    buckets=REQUEST_LATENCY_BUCKETS
+)
+
+TRACES = Counter(
+    'sentinel_traces_total',
+    'Sampled request traces by export outcome',
+    ['outcome']
 )
 
 # IP Quality metrics
@@ -38,8 +80,151 @@ REQUESTS_BY_STATUS = Counter(
     ['status']
 )
 
-AVERAGE_LATENCY = Gauge('sentinel_average_latency_seconds', 'Average request latency in seconds')
+AVERAGE_LATENCY = Gauge('sentinel_average_latency_seconds', 'Average request latency in seconds',
+                        multiprocess_mode='mostrecent')
+IPQS_COALESCED_CALLS = Counter(
+    'sentinel_ipqs_coalesced_calls_total',
+    'IPQS lookups answered by another in-flight lookup',
+    ['lookup', 'scope']
+)
+
+IPQS_REQUEST_LATENCY = Histogram(
+    'sentinel_ipqs_request_duration_seconds',
+    'IPQS API call latency',
+    ['upstream', 'outcome'],
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0]
+)
+
+IPQS_INFLIGHT_REQUESTS = Gauge(
+    'sentinel_ipqs_inflight_requests',
+    'IPQS API calls currently holding a pooled connection',
+    multiprocess_mode='livesum'
+)
+
+IPQS_POOL_SATURATION = Gauge(
+    'sentinel_ipqs_pool_saturation_ratio',
+    'In-flight IPQS API calls relative to the connection pool limit',
+    multiprocess_mode='livemax'
+)
+
+IPQS_POOL_TIMEOUTS = Counter(
+    'sentinel_ipqs_pool_timeouts_total',
+    'IPQS API calls that gave up waiting for a pooled connection'
+)
+
+RATE_LIMITED_REQUESTS = Counter(
+    'sentinel_rate_limited_requests_total',
+    'Requests rejected with 429 by the rate limiter',
+    ['risk_level', 'source']
+)
+
+IP_LIST_MATCHES = Counter(
+    'sentinel_ip_list_matches_total',
+    'Requests decided by a CIDR allow or deny list',
+    ['list_type']
+)
+
+RISK_POLICY_VERSION = Gauge(
+    'sentinel_risk_policy_version',
+    'Version of the risk policy in force (0 for the built-in thresholds)',
+    multiprocess_mode='mostrecent'
+)
+
+RISK_POLICY_RULES = Gauge(
+    'sentinel_risk_policy_rules',
+    'Rules in the risk policy in force',
+    multiprocess_mode='mostrecent'
+)
+
+IP_LIST_RULES = Gauge(
+    'sentinel_ip_list_rules',
+    'Networks loaded into the CIDR allow and deny lists',
+    ['list_type'],
+    multiprocess_mode='mostrecent'
+)
+
+IPQS_CIRCUIT_STATE = Gauge(
+    'sentinel_ipqs_circuit_state',
+    'IPQS circuit breaker state (0 closed, 1 half-open, 2 open)',
+    multiprocess_mode='livemax'
+)
+
+IPQS_SHORT_CIRCUITED = Counter(
+    'sentinel_ipqs_short_circuited_total',
+    'IPQS lookups refused because the circuit breaker is open',
+    ['upstream']
+)
+
+STALE_VERDICTS_SERVED = Counter(
+    'sentinel_stale_verdicts_served_total',
+    'Expired verdicts served while a background refresh runs'
+)
+
+REFRESH_AHEAD_REFRESHES = Counter(
+    'sentinel_refresh_ahead_total',
+    'Hot verdicts refreshed before they expired'
+)
+
+HOT_KEYS_TRACKED = Gauge(
+    'sentinel_hot_keys_tracked',
+    'Verdicts tracked for refresh-ahead',
+    multiprocess_mode='livesum'
+)
+
+# Local reputation snapshot metrics
+REPUTATION_LOOKUPS = Counter(
+    'sentinel_reputation_lookups_total',
+    'Local reputation snapshot lookups',
+    ['result']
+)
+
+REPUTATION_RANGES = Gauge(
+    'sentinel_reputation_ranges',
+    'IP ranges in the loaded reputation snapshot',
+    multiprocess_mode='mostrecent'
+)
+
+# Audit log metrics
+AUDIT_QUEUE_DEPTH = Gauge(
+    'sentinel_audit_queue_depth',
+    'Audit rows waiting to be written',
+    multiprocess_mode='livesum'
+)
+
+AUDIT_FLUSH_LATENCY = Histogram(
+    'sentinel_audit_flush_duration_seconds',
+    'Time taken to write one batch of audit rows',
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+)
+
+AUDIT_ROWS_WRITTEN = Counter(
+    'sentinel_audit_rows_flushed_total',
+    'Audit rows handed to the database in batches'
+)
+
+AUDIT_ROWS_DROPPED = Counter(
+    'sentinel_audit_rows_dropped_total',
+    'Audit rows discarded before reaching the database',
+    ['reason']
+)
+
+AUDIT_ROWS_ARCHIVED = Counter(
+    'sentinel_audit_rows_archived_total',
+    'Audit rows moved from audit_logs into per-day archive tables'
+)
+
+AUDIT_ARCHIVES_DROPPED = Counter(
+    'sentinel_audit_archive_tables_dropped_total',
+    'Per-day audit archive tables dropped by retention'
+)
+
 # Cache metrics
+REDIS_ERRORS = Counter(
+    'sentinel_redis_errors_total',
+    'Redis commands that failed after retries, by kind',
+    ['kind']
+)
+
 CACHE_HITS = Counter(
     'sentinel_cache_hits_total',
     'Number of cache hits'
@@ -50,15 +235,85 @@ CACHE_MISSES = Counter(
     'Number of cache misses'
 )
 
+LOCAL_CACHE_HITS = Counter(
+    'sentinel_local_cache_hits_total',
+    'Number of in-process cache hits'
+)
+
+LOCAL_CACHE_MISSES = Counter(
+    'sentinel_local_cache_misses_total',
+    'Number of in-process cache misses'
+)
+
+LOCAL_CACHE_EVICTIONS = Counter(
+    'sentinel_local_cache_evictions_total',
+    'Number of in-process cache evictions',
+    ['reason']
+)
+
+SUBNET_VERDICTS = Counter(
+    'sentinel_subnet_verdicts_total',
+    'Aggregated /24 and /64 verdicts served, promoted and demoted',
+    ['event']
+)
+
+CACHE_WARMED = Counter(
+    'sentinel_cache_warmed_total',
+    'Keys refilled from the database, warmed verdicts revalidated and expired whitelist rows purged',
+    ['kind']
+)
+
+LOCAL_CACHE_SIZE = Gauge(
+    'sentinel_local_cache_entries',
+    'Number of entries held in the in-process cache',
+    multiprocess_mode='livesum'
+)
+
+# Traffic analytics metrics, from the sketches merged over all workers
+TRAFFIC_REQUESTS = Gauge(
+    'sentinel_traffic_requests',
+    'Shielded requests in the sliding window',
+    ['window'],
+    multiprocess_mode='mostrecent'
+)
+
+TRAFFIC_DISTINCT = Gauge(
+    'sentinel_traffic_distinct',
+    'Estimated distinct client IPs or subnets in the sliding window',
+    ['window', 'kind'],
+    multiprocess_mode='mostrecent'
+)
+
+TRAFFIC_TOP_REQUESTS = Gauge(
+    'sentinel_traffic_top_requests',
+    'Estimated requests from the busiest client IPs or subnets in the sliding window, by rank',
+    ['window', 'kind', 'rank'],
+    multiprocess_mode='mostrecent'
+)
+
 # System metrics
 ACTIVE_CONNECTIONS = Gauge(
     'sentinel_active_connections',
-    'Number of active connections'
+    'Number of active connections',
+    multiprocess_mode='livesum'
 )
 
 WHITELISTED_IPS = Gauge(
     'sentinel_whitelisted_ips',
-    'Number of whitelisted IPs'
+    'Number of whitelisted IPs',
+    multiprocess_mode='mostrecent'
+)
+
+# Dashboard event stream metrics
+DASHBOARD_SUBSCRIBERS = Gauge(
+    'sentinel_dashboard_subscribers',
+    'Dashboards connected to the live event stream',
+    multiprocess_mode='livesum'
+)
+
+DASHBOARD_RESYNCS = Counter(
+    'sentinel_dashboard_resyncs_total',
+    'Times a slow dashboard fell behind and was told to reload'
 )
 
 class MetricsCollector:
@@ -73,6 +328,18 @@ class MetricsCollector:
     def record_latency(cls, endpoint: str, duration: float):
         REQUEST_LATENCY.labels(endpoint=endpoint).observe(duration)
     
+    @classmethod
+    def record_stage(cls, stage: str, duration: float):
+        STAGE_LATENCY.labels(stage=stage).observe(duration)
+
+    @classmethod
+    def record_trace(cls, outcome: str, count: int = 1):
+        TRACES.labels(outcome=outcome).inc(count)
+
+    @classmethod
+    def record_endpoint_overflow(cls):
+        ENDPOINT_LABEL_OVERFLOW.inc()
+
     @classmethod
     def record_risk_score(cls, score: float):
         RISK_SCORE.observe(score)
@@ -93,6 +360,90 @@ class MetricsCollector:
     def set_average_latency(cls, latency: float):
         AVERAGE_LATENCY.set(latency)
 
+    @classmethod
+    def record_coalesced_call(cls, lookup: str, scope: str):
+        IPQS_COALESCED_CALLS.labels(lookup=lookup, scope=scope).inc()
+
+    @classmethod
+    def record_ipqs_latency(cls, upstream: str, outcome: str, duration: float):
+        IPQS_REQUEST_LATENCY.labels(upstream=upstream, outcome=outcome).observe(duration)
+
+    @classmethod
+    def set_ipqs_pool_usage(cls, inflight: int, limit: int):
+        IPQS_INFLIGHT_REQUESTS.set(inflight)
+        IPQS_POOL_SATURATION.set(inflight / limit if limit else 0)
+
+    @classmethod
+    def record_ipqs_pool_timeout(cls):
+        IPQS_POOL_TIMEOUTS.inc()
+
+    @classmethod
+    def record_redis_error(cls, kind: str):
+        REDIS_ERRORS.labels(kind=kind).inc()
+
+    @classmethod
+    def record_rate_limited(cls, risk_level: str, source: str):
+        RATE_LIMITED_REQUESTS.labels(risk_level=risk_level, source=source).inc()
+
+    @classmethod
+    def record_ip_list_match(cls, list_type: str):
+        IP_LIST_MATCHES.labels(list_type=list_type).inc()
+
+    @classmethod
+    def set_risk_policy(cls, version: int, rules: int):
+        RISK_POLICY_VERSION.set(version)
+        RISK_POLICY_RULES.set(rules)
+
+    @classmethod
+    def set_ip_list_rules(cls, list_type: str, count: int):
+        IP_LIST_RULES.labels(list_type=list_type).set(count)
+
+    @classmethod
+    def set_ipqs_circuit_state(cls, state: int):
+        IPQS_CIRCUIT_STATE.set(state)
+
+    @classmethod
+    def record_ipqs_short_circuit(cls, upstream: str):
+        IPQS_SHORT_CIRCUITED.labels(upstream=upstream).inc()
+
+    @classmethod
+    def record_stale_served(cls):
+        STALE_VERDICTS_SERVED.inc()
+
+    @classmethod
+    def record_refresh_ahead(cls):
+        REFRESH_AHEAD_REFRESHES.inc()
+
+    @classmethod
+    def set_hot_keys(cls, count: int):
+        HOT_KEYS_TRACKED.set(count)
+
+    @classmethod
+    def record_reputation_lookup(cls, hit: bool):
+        REPUTATION_LOOKUPS.labels(result="hit" if hit else "miss").inc()
+
+    @classmethod
+    def set_reputation_ranges(cls, count: int):
+        REPUTATION_RANGES.set(count)
+
+    @classmethod
+    def set_audit_queue_depth(cls, depth: int):
+        AUDIT_QUEUE_DEPTH.set(depth)
+
+    @classmethod
+    def record_audit_flush(cls, rows: int, duration: float):
+        AUDIT_ROWS_WRITTEN.inc(rows)
+        AUDIT_FLUSH_LATENCY.observe(duration)
+
+    @classmethod
+    def record_audit_dropped(cls, reason: str, rows: int = 1):
+        AUDIT_ROWS_DROPPED.labels(reason=reason).inc(rows)
+
+    @classmethod
+    def record_audit_archived(cls, rows: int, tables_dropped: int):
+        AUDIT_ROWS_ARCHIVED.inc(rows)
+        AUDIT_ARCHIVES_DROPPED.inc(tables_dropped)
+
     @classmethod
     def record_cache_hit(cls):
         CACHE_HITS.inc()
@@ -101,10 +452,111 @@ class MetricsCollector:
     def record_cache_miss(cls):
         CACHE_MISSES.inc()
     
+    @classmethod
+    def record_local_cache_hit(cls):
+        LOCAL_CACHE_HITS.inc()
+
+    @classmethod
+    def record_local_cache_miss(cls):
+        LOCAL_CACHE_MISSES.inc()
+
+    @classmethod
+    def record_local_cache_eviction(cls, reason: str):
+        LOCAL_CACHE_EVICTIONS.labels(reason=reason).inc()
+
+    @classmethod
+    def record_subnet_verdict(cls, event: str):
+        SUBNET_VERDICTS.labels(event=event).inc()
+
+    @classmethod
+    def record_cache_warm(cls, kind: str, count: int = 1):
+        CACHE_WARMED.labels(kind=kind).inc(count)
+
+    @classmethod
+    def set_local_cache_size(cls, count: int):
+        LOCAL_CACHE_SIZE.set(count)
+
+    @classmethod
+    def set_traffic_summary(cls, summary: Dict[str, Any], top_k: int):
+        window = f"{summary['window']}s"
+        TRAFFIC_REQUESTS.labels(window=window).set(summary["requests"])
+        for kind in ("ips", "subnets"):
+            TRAFFIC_DISTINCT.labels(window=window, kind=kind).set(summary[f"distinct_{kind}"])
+            top = summary[f"top_{kind}"]
+            for rank in range(1, top_k + 1):
+                count = top[rank - 1]["requests"] if rank <= len(top) else 0
+                TRAFFIC_TOP_REQUESTS.labels(window=window, kind=kind, rank=str(rank)).set(count)
+
     @classmethod
     def set_active_connections(cls, count: int):
         ACTIVE_CONNECTIONS.set(count)
     
     @classmethod
     def set_whitelisted_ips(cls, count: int):
-        WHITELISTED_IPS.set(count) 
\ No newline at end of file
+        WHITELISTED_IPS.set(count)
+
+    @classmethod
+    def set_dashboard_subscribers(cls, count: int):
+        DASHBOARD_SUBSCRIBERS.set(count)
+
+    @classmethod
+    def record_dashboard_resync(cls):
+        DASHBOARD_RESYNCS.inc()
+
+    @classmethod
+    def _samples(cls) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+        """(labels, value) per sample name, from every worker in multi-process mode"""
+        samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        for family in METRICS_REGISTRY.collect():
+            for sample in family.samples:
+                samples.setdefault(sample.name, []).append((sample.labels, sample.value))
+        return samples
+
+    @classmethod
+    def admin_summary(cls) -> Dict[str, Dict]:
+        """Request, performance and security totals for /admin/metrics"""
+        samples = cls._samples()
+
+        def total(name: str) -> float:
+            return sum(value for _, value in samples.get(name, []))
+
+        by_status = {"200": 0, "403": 0, "500": 0}
+        for labels, value in samples.get("sentinel_http_requests_total", []):
+            by_status[str(labels["status"])] = by_status.get(str(labels["status"]), 0) + value
+        latency_count = total("sentinel_http_request_duration_seconds_count")
+        risk_count = total("sentinel_ip_risk_scores_count")
+        lookups = total("sentinel_cache_hits_total") + total("sentinel_cache_misses_total")
+        return {
+            "requests": {
+                "total": sum(by_status.values()),
+                "by_status": by_status
+            },
+            "performance": {
+                "avg_latency": total("sentinel_http_request_duration_seconds_sum") / latency_count if latency_count else 0,
+                "cache_hit_rate": total("sentinel_cache_hits_total") / lookups if lookups else 0,
+            },
+            "security": {
+                "blocked_ips": total("sentinel_blocked_ips_total"),
+                "whitelisted_ips": total("sentinel_whitelisted_ips"),
+                "avg_risk_score": total("sentinel_ip_risk_scores_sum") / risk_count if risk_count else 0
+            }
+        }
+
+    @classmethod
+    def dashboard_summary(cls) -> Dict[str, float]:
+        """Headline numbers for the admin dashboard, summed over all workers"""
+        summary = cls.admin_summary()
+        by_status = summary["requests"]["by_status"]
+        return {
+            "total_requests": summary["requests"]["total"],
+            "requests_200": by_status["200"],
+            "requests_403": by_status["403"],
+            "requests_429": by_status.get("429", 0),
+            "average_latency": summary["performance"]["avg_latency"],
+            "blocked_ips": summary["security"]["blocked_ips"],
+            "cache_hit_rate": summary["performance"]["cache_hit_rate"],
+        }
+
+
+# Registry every summary and /metrics read from
+METRICS_REGISTRY = metrics_registry()
@@ -1,35 +1,188 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import Optional
+from typing import Any, Dict, List, Literal, Optional
 
 class Settings(BaseSettings):
     # Application Settings
     APP_NAME: str = "SentinelShield"
     DEBUG: bool = False
+    STARTUP_PREPARED: bool = False  # set by the gunicorn master once app.bootstrap has run
     
     # IPQS API Settings
     IPQS_API_KEY: str
     IPQS_BASE_URL: str = "https://www.ipqualityscore.com/api/json/ip"
     IPQS_DEVICE_BASE_URL: str = "https://www.ipqualityscore.com/api/json/device"
+    IPQS_COALESCE_ACROSS_WORKERS: bool = True  # share in-flight lookups through a Redis lease
+    IPQS_LOOKUP_LEASE_MS: int = 5000  # how long other workers wait on the lease holder
+    IPQS_LOOKUP_POLL_MS: int = 25
+    IPQS_SHARED_RESULT_TTL: int = 30  # seconds a shared lookup result stays in Redis
+    IPQS_BREAKER_FAILURE_THRESHOLD: int = 5  # consecutive failures before the circuit opens
+    IPQS_BREAKER_RESET_TIMEOUT: float = 30.0  # seconds before a probe call is let through
+    IPQS_FAILURE_POLICY: Literal["open", "closed"] = "open"  # allow or block when IPQS is down and nothing is cached
+    IPQS_LOOKUP_DEADLINE: float = 2.5  # seconds for the IP and device lookups of one request, run concurrently
+
+    # IPQS HTTP Client Settings
+    IPQS_HTTP2: bool = True
+    IPQS_MAX_CONNECTIONS: int = 100
+    IPQS_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    IPQS_KEEPALIVE_EXPIRY: float = 30.0  # seconds
+    IPQS_CONNECT_TIMEOUT: float = 1.0  # seconds
+    IPQS_READ_TIMEOUT: float = 2.0  # seconds
+    IPQS_WRITE_TIMEOUT: float = 1.0  # seconds
+    IPQS_POOL_TIMEOUT: float = 0.5  # seconds waiting for a free pooled connection
     
     # Redis Settings
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
     REDIS_PASSWORD: Optional[str] = None
+    REDIS_MODE: Literal["standalone", "sentinel", "sharded"] = "standalone"
+    REDIS_SENTINELS: List[str] = []  # "host:port" of each sentinel, for sentinel mode
+    REDIS_SENTINEL_SERVICE: str = "mymaster"
+    REDIS_SENTINEL_PASSWORD: Optional[str] = None
+    REDIS_SHARD_URLS: List[str] = []  # redis:// URL of each instance, for sharded mode
+    REDIS_SHARD_VNODES: int = 160  # hash ring points per shard
+    REDIS_MAX_CONNECTIONS: int = 50  # per worker and per instance
+    REDIS_POOL_TIMEOUT: float = 0.5  # seconds waiting for a free pooled connection
+    REDIS_SOCKET_TIMEOUT: float = 0.5  # seconds
+    REDIS_CONNECT_TIMEOUT: float = 0.5  # seconds
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30  # seconds idle before a connection is pinged on reuse
+    REDIS_RETRY_ATTEMPTS: int = 2  # retries after a connection error or timeout
+    REDIS_RETRY_BACKOFF_BASE: float = 0.01  # seconds, doubled on each retry with jitter
+    REDIS_RETRY_BACKOFF_CAP: float = 0.1  # seconds
     
     # SQLite Settings
     DATABASE_URL: str = "sqlite:///./sentinel_shield.db"
+    SQLITE_JOURNAL_MODE: str = "WAL"  # readers don't block the audit writer
+    SQLITE_SYNCHRONOUS: str = "NORMAL"  # durable with WAL, without an fsync per commit
+    SQLITE_BUSY_TIMEOUT: int = 5000  # milliseconds to wait for a lock
+    SQLITE_CACHE_SIZE: int = -20000  # pages, or KiB when negative
+
+    # Audit Log Settings
+    AUDIT_QUEUE_SIZE: int = 10000  # rows buffered in memory per worker
+    AUDIT_BATCH_SIZE: int = 500
+    AUDIT_FLUSH_INTERVAL: float = 1.0  # seconds
+    AUDIT_OVERFLOW_POLICY: Literal["drop", "sample", "block"] = "drop"
+    AUDIT_SAMPLE_RATE: float = 0.1  # fraction kept by "sample" once the queue is half full
+    AUDIT_LIVE_DAYS: int = 1  # days kept in audit_logs before moving to per-day archive tables
+    AUDIT_RETENTION_DAYS: int = 30  # archive tables older than this are dropped
+    AUDIT_COMPACT_INTERVAL: float = 3600.0  # seconds between retention runs
+    AUDIT_COMPACT_BATCH: int = 5000  # rows moved per transaction
+    AUDIT_ROLLUP_MINUTE_RETENTION_HOURS: int = 48  # per-minute rollups; hourly ones follow AUDIT_RETENTION_DAYS
+    AUDIT_QUERY_MAX_LIMIT: int = 1000  # rows per page from /admin/logs
     
     # Security Settings
     RISK_THRESHOLD_HIGH: float = 75.0
     RISK_THRESHOLD_MEDIUM: float = 50.0
     RISK_THRESHOLD_LOW: float = 25.0
     CHALLENGE_ENABLED: bool = True
-    THROTTLE_DELAY: int = 5  # seconds
+
+    # Risk Policy Settings
+    # Published policies (/admin/policy) replace the RISK_THRESHOLD_* bands above
+    RISK_POLICY_DRY_RUN_LIMIT: int = 100000  # cached verdicts replayed per dry run
+    RISK_POLICY_DRY_RUN_SAMPLES: int = 20  # changed verdicts listed in a dry-run report
+
+    # Rate Limit Settings
+    RATE_LIMIT_ENABLED: bool = True
+    # Token buckets per risk level: requests per second and burst size, per IP and per /24 or /64.
+    # Risk levels without an entry are not limited.
+    RATE_LIMITS: Dict[str, Dict[str, float]] = {
+        "medium": {"ip_rate": 1.0, "ip_burst": 5, "subnet_rate": 10.0, "subnet_burst": 50},
+    }
+    RATE_LIMIT_LOCAL_MAX_SIZE: int = 10000  # over-limit clients remembered per worker
 
     # Cache Settings
     CACHE_TTL: int = 3600  # 1 hour
+    CACHE_STALE_TTL: int = 86400  # how long an expired verdict may still be served while it is refreshed
+    # Verdict TTLs: the first flag set on a verdict wins, otherwise its risk level; CACHE_TTL if neither matches
+    CACHE_TTL_BY_FLAG: Dict[str, int] = {"tor": 21600, "proxy": 1800, "vpn": 1800}
+    CACHE_TTL_BY_RISK_LEVEL: Dict[str, int] = {"high": 21600, "medium": 3600, "low": 3600}
+    CACHE_TTL_JITTER: float = 0.1  # +/- fraction, so verdicts cached together don't expire together
     WHITELIST_TTL: int = 86400  # 24 hours
+    DEVICE_CACHE_TTL: int = 3600  # device fingerprint results, cached apart from IP verdicts
+
+    # Subnet Verdict Settings
+    SUBNET_VERDICTS_ENABLED: bool = False  # serve uncached IPs from their /24 (IPv4) or /64 (IPv6) verdict
+    # First rule met wins: at least min_ips IPs of the prefix at risk_level, making up at least min_share (optional) of those seen
+    SUBNET_PROMOTION_RULES: List[Dict[str, Any]] = [
+        {"risk_level": "high", "min_ips": 3, "min_share": 0.5},
+        {"risk_level": "low", "min_ips": 5, "min_share": 0.8},
+    ]
+    SUBNET_VERDICT_TTL: int = 3600  # how long a promoted prefix verdict is served
+    SUBNET_TALLY_WINDOW: int = 86400  # seconds a prefix's looked-up IPs are remembered after the last one
+    SUBNET_TALLY_MAX_IPS: int = 256  # IPs remembered per prefix
+
+    # Refresh-ahead Settings
+    REFRESH_AHEAD_ENABLED: bool = True
+    REFRESH_AHEAD_INTERVAL: float = 10.0  # seconds between scans
+    REFRESH_AHEAD_WINDOW: int = 300  # refresh hot verdicts expiring within this many seconds
+    REFRESH_AHEAD_MIN_HITS: int = 20  # decayed hit count that makes a verdict hot
+    REFRESH_AHEAD_BATCH: int = 100  # refreshes started per scan
+    REFRESH_AHEAD_MAX_KEYS: int = 50000  # verdicts tracked per worker
+
+    # CIDR Allow/Deny List Settings
+    IP_LISTS_ENABLED: bool = True
+    IP_LISTS_MAX_IMPORT: int = 100000  # networks accepted per bulk import
+
+    # Local Reputation Snapshot Settings
+    REPUTATION_SNAPSHOT_ENABLED: bool = True
+    REPUTATION_SNAPSHOT_PATH: str = "data/reputation.bin"  # memory-mapped by every worker
+    REPUTATION_MAX_IMPORT: int = 5000000  # feed lines accepted per import
+
+    # Bulk Check Settings
+    BULK_CHECK_MAX_IPS: int = 100000  # unique IPs checked per request
+    BULK_CHECK_CHUNK_SIZE: int = 500  # IPs resolved from the cache per MGET
+    BULK_CHECK_CONCURRENCY: int = 20  # IPQS lookups in flight per request
+
+    # In-process (L1) Cache Settings
+    LOCAL_CACHE_ENABLED: bool = True
+    LOCAL_CACHE_MAX_SIZE: int = 10000  # entries per worker
+    LOCAL_CACHE_TTL: int = 30  # seconds
+    CACHE_INVALIDATION_CHANNEL: str = "sentinel:cache:invalidate"
+
+    # Warm Start Settings
+    WARM_START_ENABLED: bool = True  # refill Redis from the database at startup and whenever it comes back empty
+    WARM_START_LOOKBACK_HOURS: float = 6.0  # audit_logs rows verdicts are rebuilt from
+    WARM_START_MAX_IPS: int = 50000  # most recently seen IPs warmed
+    WARM_START_BATCH: int = 1000  # keys written per pipelined round trip
+    WARM_START_REVALIDATE_RATE: float = 5.0  # IPQS lookups per second for warmed verdicts past their TTL
+    WHITELIST_RECONCILE_INTERVAL: float = 300.0  # seconds between whitelist re-syncs and expired row purges
+
+    # Traffic Analytics Settings
+    TRAFFIC_ANALYTICS_ENABLED: bool = True
+    TRAFFIC_BUCKET_SECONDS: int = 10  # sketches are kept per time bucket; windows slide by this much
+    TRAFFIC_WINDOWS: List[int] = [60, 300]  # seconds; reported as gauges, and the longest bounds /admin/stats/traffic
+    TRAFFIC_FLUSH_INTERVAL: float = 5.0  # seconds between writes of this worker's sketches to Redis
+    TRAFFIC_GAUGE_INTERVAL: float = 15.0  # seconds between gauge updates, by one worker at a time
+    TRAFFIC_CMS_WIDTH: int = 2048  # count-min counters per row; overcounts by at most ~e/width of the traffic
+    TRAFFIC_CMS_DEPTH: int = 4  # count-min rows; the bound holds with probability 1 - e^-depth
+    TRAFFIC_HLL_PRECISION: int = 12  # 2^p HyperLogLog registers, ~1.04/sqrt(2^p) error (1.6%)
+    TRAFFIC_TOP_K: int = 10  # top IPs and subnets reported
+
+    # Live Dashboard Settings
+    DASHBOARD_EVENTS_INTERVAL: float = 1.0  # seconds between pushed updates
+    DASHBOARD_EVENTS_HEARTBEAT: float = 15.0  # seconds between keep-alive comments
+    DASHBOARD_EVENTS_CLIENT_BUFFER: int = 16  # updates buffered per dashboard before it is told to resync
+    DASHBOARD_EVENTS_MAX_ROWS: int = 100  # newest audit rows pushed per update
+
+    # Request Metrics Settings
+    METRICS_MAX_ENDPOINTS: int = 200  # endpoint labels per worker; requests beyond that are counted as "other"
+    METRICS_PATH_DEPTH: int = 3  # leading segments kept when labelling a path no route matches
+    METRICS_PATH_PATTERNS: Dict[str, str] = {}  # regex -> replacement applied to such paths first
+
+    # Tracing Settings
+    STAGE_METRICS_ENABLED: bool = True  # per-stage latency histograms for the request path
+    TRACING_ENABLED: bool = False  # record sampled requests as OpenTelemetry spans
+    TRACING_SAMPLE_RATE: float = 0.01  # fraction of requests traced
+    TRACING_EXPORT: Literal["file", "otlp"] = "file"
+    TRACING_FILE: str = "data/traces.jsonl"  # OTLP/JSON export requests, one per line
+    TRACING_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"  # OTLP/HTTP collector
+    TRACING_EXPORT_INTERVAL: float = 5.0  # seconds
+    TRACING_EXPORT_TIMEOUT: float = 2.0  # seconds
+    TRACING_MAX_QUEUE: int = 10000  # finished traces waiting for export before new ones are dropped
+
+    # Profiler Settings
+    PROFILER_MAX_SECONDS: float = 60.0
+    PROFILER_DEFAULT_INTERVAL: float = 0.005  # seconds between stack samples
 
     # Admin Settings
     ADMIN_USERNAME: str = "admin"
@@ -46,6 +199,17 @@ def validate_settings(settings):
         raise ValueError("REDIS_HOST cannot be empty.")
     if not isinstance(settings.REDIS_PORT, int):
         raise ValueError("REDIS_PORT must be an integer.")
+    if settings.REDIS_MODE == "sentinel" and not settings.REDIS_SENTINELS:
+        raise ValueError("REDIS_SENTINELS cannot be empty in sentinel mode.")
+    if settings.REDIS_MODE == "sharded" and not settings.REDIS_SHARD_URLS:
+        raise ValueError("REDIS_SHARD_URLS cannot be empty in sharded mode.")
+    for rule in settings.SUBNET_PROMOTION_RULES:
+        if rule.get("risk_level") not in ("high", "medium", "low"):
+            raise ValueError("SUBNET_PROMOTION_RULES risk_level must be high, medium or low.")
+        if not isinstance(rule.get("min_ips"), int) or rule["min_ips"] < 1:
+            raise ValueError("SUBNET_PROMOTION_RULES min_ips must be a positive integer.")
+        if "min_share" in rule and not 0 < rule["min_share"] <= 1:
+            raise ValueError("SUBNET_PROMOTION_RULES min_share must be above 0 and at most 1.")
     if not isinstance(settings.RISK_THRESHOLD_HIGH, float):
         raise ValueError("RISK_THRESHOLD_HIGH must be a float.")
     if not isinstance(settings.RISK_THRESHOLD_MEDIUM, float):
@@ -1,64 +1,80 @@
 from fastapi import FastAPI, Request, Response, HTTPException, Depends
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.middleware.wsgi import WSGIMiddleware
 from prometheus_client import make_asgi_app
 import secrets
 import time
-from datetime import datetime, timezone
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Literal
 import asyncio
+import json
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from .config.settings import settings
-from .config.monitoring import MetricsCollector, total_requests, requests_by_status, average_latency
+from .config.monitoring import MetricsCollector, METRICS_REGISTRY
+from .bootstrap import prepare
 from .services.ipqs import ipqs_service
 import logging
-from .services.cache import cache_service
-from .models.database import database, AuditLog, WhitelistedIP
+from .services.cache import cache_service, canonical_ip
+from .services.audit import audit_writer, audit_archiver, log_request
+from .middleware import ShieldMiddleware, MetricsMiddleware
+from .services.bulk import bulk_checker, iterate
+from .services.iplists import ip_lists
+from .services.policy import risk_policy
+from .services.reputation import reputation_store
+from .services.reports import audit_reports
+from .services.events import dashboard_events
+from .services.verdicts import verdict_service
+from .services.tracing import tracer
+from .services.traffic import traffic_analytics
+from .services.warmstart import cache_warmer
+from .services.profiler import profiler
+from .models.database import database, WhitelistedIP
 
 app = FastAPI(title=settings.APP_NAME)
 security = HTTPBasic()
 
-# Mount Prometheus metrics endpoint
-metrics_app = make_asgi_app()
-app.mount("/metrics", WSGIMiddleware(metrics_app))
+# Mount Prometheus metrics endpoint; aggregates every worker's metrics in multi-process mode
+app.mount("/metrics", make_asgi_app(registry=METRICS_REGISTRY))
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    duration = time.time() - start_time
-    
-    # Record metrics
-    MetricsCollector.record_request(
-        method=request.method,
-        endpoint=request.url.path,
-        status=response.status_code
-    )
-    MetricsCollector.record_latency(request.url.path, duration)
-    
-    return response
+# Pure ASGI middleware; the last one added runs first, so metrics also see shield responses
+app.add_middleware(ShieldMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 @app.on_event("startup")
 async def startup():
+    # Schema and whitelist count; done once by the gunicorn master when running several workers
+    if not settings.STARTUP_PREPARED:
+        prepare()
     await database.connect()
     await cache_service.init()
-    
-    # Initialize metrics
-    whitelist_count = await database.fetch_val(
-        "SELECT COUNT(*) FROM whitelisted_ips WHERE expires_at > ?",
-        [datetime.now(timezone.utc).timestamp()]
-    )
-    MetricsCollector.set_whitelisted_ips(whitelist_count)
+    await ipqs_service.start()
+    await audit_writer.start()
+    audit_archiver.start()
+    await ip_lists.start()
+    await risk_policy.start()
+    await reputation_store.start()
+    # Before serving, so a Redis that lost its data does not send every IP to IPQS
+    await cache_warmer.start()
+    cache_service.start_refresh_ahead(verdict_service.refresh_key)
+    tracer.start()
+    traffic_analytics.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    await dashboard_events.stop()
+    await tracer.stop()
+    await traffic_analytics.stop()
+    await cache_warmer.stop()
+    await audit_archiver.stop()
+    await audit_writer.stop()
     await database.disconnect()
     await cache_service.close()
+    await ipqs_service.close()
 
 async def verify_admin(credentials: HTTPBasicCredentials = Depends(security)):
     is_admin = secrets.compare_digest(credentials.username, settings.ADMIN_USERNAME) and \
@@ -71,118 +87,6 @@ async def verify_admin(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return True
 
-async def log_request(request_data: dict, action: str):
-    """Log request details to database and update metrics"""
-    query = AuditLog.__table__.insert().values(
-        ip_address=request_data["ip_address"],
-        device_fingerprint=request_data.get("device_fingerprint"),
-        risk_score=request_data["risk_score"],
-        is_proxy=request_data["is_proxy"],
-        is_vpn=request_data["is_vpn"],
-        is_tor=request_data["is_tor"],
-        country_code=request_data["country_code"],
-        city=request_data.get("city"),
-        action_taken=action,
-        request_path=request_data["request_path"],
-        user_agent=request_data["user_agent"]
-    )
-    await database.execute(query)
-    
-    # Update metrics
-    MetricsCollector.record_risk_score(request_data["risk_score"])
-    if action == "high":
-        MetricsCollector.record_blocked_ip()
-
-@app.middleware("http")
-async def shield_middleware(request: Request, call_next):
-    # Skip admin dashboard, metrics, and static files
-    if request.url.path.startswith(("/admin", "/static", "/metrics")):
-        return await call_next(request)
-    
-    # Get IP and headers
-    ip_address = request.client.host
-    user_agent = request.headers.get("user-agent", "Unknown")
-    device_fingerprint = request.headers.get("x-device-fingerprint")
-    
-    # Check whitelist
-    if await cache_service.is_whitelisted(ip_address):
-        MetricsCollector.record_cache_hit()
-        return await call_next(request)
-    
-    # Check cache first
-    cache_key = f"ip:{ip_address}"
-    cached_data = await cache_service.get(cache_key)
-    
-    if cached_data:
-        MetricsCollector.record_cache_hit()
-    else:
-        MetricsCollector.record_cache_miss()
-        # Get IP reputation
-        ip_data = await ipqs_service.check_ip(ip_address, user_agent)
-        
-        try:
-            risk_score = ip_data.get("fraud_score", 0)
-            if not isinstance(risk_score, (int, float)):
-                logging.error(f"Invalid risk_score type received: {type(risk_score)}. Setting to 100.")
-                risk_score = 100
-        except Exception as e:
-            logging.error(f"Error validating risk_score: {e}. Setting to 100.")
-            risk_score = 100
-        total_requests.inc()
-        requests_by_status.labels(status=200).inc()
-        average_latency.set(0)
-        
-        # Get device reputation if fingerprint provided
-        device_data = None
-        if device_fingerprint:
-            device_data = await ipqs_service.check_device(device_fingerprint)
-        
-        # Calculate risk level
-        risk_level = ipqs_service.calculate_risk_level(ip_data, device_data)    
-        
-        # Cache the results
-        cached_data = {
-            "ip_address": ip_address,
-            "device_fingerprint": device_fingerprint,
-            "risk_score": ip_data.get("fraud_score", 0),
-            "is_proxy": ip_data.get("proxy", False),
-            "is_vpn": ip_data.get("vpn", False),
-            "is_tor": ip_data.get("tor", False),
-            "country_code": ip_data.get("country_code", "Unknown"),
-            "city": ip_data.get("city", None),
-            "risk_level": risk_level,
-            "request_path": str(request.url),
-            "user_agent": user_agent
-        }
-        await cache_service.set(cache_key, cached_data)
-    
-    # Log request and update metrics
-    await log_request(cached_data, cached_data["risk_level"])
-    
-    # Handle based on risk level
-    if cached_data["risk_level"] == "high":
-        return JSONResponse(
-            status_code=403,
-            content={"error": "Access denied due to high risk score"}
-        )
-    elif cached_data["risk_level"] == "medium" and settings.CHALLENGE_ENABLED:
-        # Redirect to challenge page
-        return HTMLResponse(content="""
-            <html>
-                <head><title>Security Challenge</title></head>
-                <body>
-                    <h1>Please Complete Security Challenge</h1>
-                    <div class="g-recaptcha" data-sitekey="YOUR_RECAPTCHA_SITE_KEY"></div>
-                    <script src='https://www.google.com/recaptcha/api.js'></script>
-                </body>
-            </html>
-        """)
-    elif cached_data["risk_level"] == "medium":
-        # Apply throttling
-        await asyncio.sleep(settings.THROTTLE_DELAY)
-    
-    return await call_next(request)
-
 @app.get("/admin/dashboard")
 async def admin_dashboard(_: bool = Depends(verify_admin)):
     """Admin dashboard HTML page"""
@@ -190,24 +94,138 @@ async def admin_dashboard(_: bool = Depends(verify_admin)):
         return HTMLResponse(content=f.read())
 
 @app.get("/admin/logs")
-async def get_logs(_: bool = Depends(verify_admin)):
-    """Get recent audit logs"""
-    query = "SELECT * FROM audit_logs ORDER BY timestamp DESC LIMIT 100"
-    logs = await database.fetch_all(query)
-    return {"logs": logs}
+async def get_logs(ip: Optional[str] = None, action: Optional[str] = None, country: Optional[str] = None,
+                   since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   cursor: Optional[int] = None, limit: int = 100, _: bool = Depends(verify_admin)):
+    """Get audit logs, newest first, from the live table then its archives; pass next_cursor back as cursor for the next page"""
+    limit = max(1, min(limit, settings.AUDIT_QUERY_MAX_LIMIT))
+    archives = await audit_archiver.archives_between(since, until)
+    return await audit_reports.logs(ip, action, country, since, until, cursor, limit, archives)
+
+@app.get("/admin/events")
+async def admin_events(_: bool = Depends(verify_admin)):
+    """Server-Sent Events stream of metric changes and new audit rows for the dashboard"""
+    queue = dashboard_events.subscribe()
+
+    async def stream():
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            dashboard_events.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/admin/stats/timeseries")
+async def get_timeseries(since: datetime, until: Optional[datetime] = None,
+                         granularity: Literal["minute", "hour"] = "hour",
+                         group_by: Literal["action_taken", "country_code", "risk_bucket"] = "action_taken",
+                         action: Optional[str] = None, country: Optional[str] = None,
+                         _: bool = Depends(verify_admin)):
+    """Audit counts per minute or hour from the rollup tables"""
+    return {"series": await audit_reports.timeseries(granularity, group_by, since, until, action, country)}
+
+@app.get("/admin/stats/top-ips")
+async def get_top_ips(since: datetime, until: Optional[datetime] = None, action: Optional[str] = None,
+                      limit: int = 10, _: bool = Depends(verify_admin)):
+    """IPs with the most audit rows since a time, e.g. top blocked IPs today with action=high"""
+    limit = max(1, min(limit, settings.AUDIT_QUERY_MAX_LIMIT))
+    return {"ips": await audit_reports.top_ips(since, until, action, limit)}
+
+@app.get("/admin/stats/traffic")
+async def get_traffic(window: Optional[int] = None, _: bool = Depends(verify_admin)):
+    """Live request count, distinct IPs and subnets, and top talkers over the last window seconds, from sketches"""
+    longest = max(settings.TRAFFIC_WINDOWS)
+    window = window or longest
+    if not 0 < window <= longest:
+        raise HTTPException(status_code=400, detail=f"window must be between 1 and {longest} seconds")
+    return await traffic_analytics.summary(window)
 
 @app.post("/admin/whitelist/{ip_address}")
 async def whitelist_ip(ip_address: str, _: bool = Depends(verify_admin)):
     """Whitelist an IP address"""
+    ip_address = canonical_ip(ip_address)
     await cache_service.whitelist_ip(ip_address)
-    # Also store in database
-    query = WhitelistedIP.__table__.insert().values(
+    # Also store in database, where warm start and reconciliation read it back; whitelisting again extends it
+    query = sqlite_insert(WhitelistedIP.__table__).values(
         ip_address=ip_address,
-        expires_at=datetime.now(timezone.utc).timestamp() + settings.WHITELIST_TTL
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=settings.WHITELIST_TTL)
     )
-    await database.execute(query)
+    await database.execute(query.on_conflict_do_update(
+        index_elements=["ip_address"],
+        set_={"expires_at": query.excluded.expires_at}
+    ))
     return {"message": f"IP {ip_address} has been whitelisted"}
 
+@app.get("/admin/ip-lists")
+async def get_ip_lists(_: bool = Depends(verify_admin)):
+    """List the networks in the CIDR allow and deny lists"""
+    return {"rules": await ip_lists.list_rules()}
+
+@app.post("/admin/ip-lists/{list_type}")
+async def import_ip_list(list_type: Literal["allow", "deny"], request: Request,
+                         comment: Optional[str] = None, _: bool = Depends(verify_admin)):
+    """Bulk import networks from a JSON array or a text body with one CIDR per line"""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            cidrs = json.loads(body)
+        else:
+            cidrs = body.decode().splitlines()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not isinstance(cidrs, list) or not all(isinstance(cidr, str) for cidr in cidrs):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of CIDR strings")
+    if len(cidrs) > settings.IP_LISTS_MAX_IMPORT:
+        raise HTTPException(status_code=413, detail=f"At most {settings.IP_LISTS_MAX_IMPORT} networks per import")
+    return await ip_lists.add(list_type, cidrs, comment)
+
+@app.delete("/admin/ip-lists/{list_type}/{cidr:path}")
+async def delete_ip_list_entry(list_type: Literal["allow", "deny"], cidr: str, _: bool = Depends(verify_admin)):
+    """Remove a network from the allow or deny list"""
+    try:
+        await ip_lists.remove(list_type, cidr)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid network {cidr}")
+    return {"message": f"{cidr} removed from the {list_type} list"}
+
+@app.get("/admin/policy")
+async def get_policy(_: bool = Depends(verify_admin)):
+    """Show the risk policy in force and its version"""
+    return risk_policy.describe()
+
+@app.put("/admin/policy")
+async def put_policy(request: Request, comment: Optional[str] = None, _: bool = Depends(verify_admin)):
+    """Publish a risk policy to every worker"""
+    try:
+        return await risk_policy.publish(await request.json(), comment)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/admin/policy/dry-run")
+async def dry_run_policy(request: Request, limit: Optional[int] = None, _: bool = Depends(verify_admin)):
+    """Replay cached verdicts through a candidate policy and report how their risk levels would change"""
+    limit = max(1, min(limit or settings.RISK_POLICY_DRY_RUN_LIMIT, settings.RISK_POLICY_DRY_RUN_LIMIT))
+    try:
+        return await risk_policy.dry_run(await request.json(), limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/admin/reputation")
+async def get_reputation(_: bool = Depends(verify_admin)):
+    """Describe the loaded local reputation snapshot"""
+    snapshot = reputation_store.snapshot
+    return {"loaded": snapshot is not None, "ranges": len(snapshot) if snapshot is not None else 0}
+
+@app.post("/admin/reputation/import")
+async def import_reputation(request: Request, _: bool = Depends(verify_admin)):
+    """Replace the local reputation snapshot with a CSV range feed or NDJSON IPQS export"""
+    lines = (await request.body()).decode(errors="replace").splitlines()
+    if len(lines) > settings.REPUTATION_MAX_IMPORT:
+        raise HTTPException(status_code=413, detail=f"At most {settings.REPUTATION_MAX_IMPORT} lines per import")
+    return await reputation_store.import_feed(lines)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -218,70 +236,98 @@ async def check_ip(ip: str, request: Request):
     """
     Check IP reputation and return detailed results
     """
-    # Check whitelist
-    if await cache_service.is_whitelisted(ip):
+    ip = canonical_ip(ip)
+    with tracer.stage("ip_lists"):
+        list_match = ip_lists.match(ip)
+    if list_match == "allow":
         return {"status": "whitelisted", "risk_level": "low"}
+    if list_match == "deny":
+        return {"status": "blocked", "risk_level": "high"}
     
-    # Check cache first
-    cache_key = f"ip:{ip}"
-    cached_data = await cache_service.get(cache_key)
+    # Check whitelist and cache in one round trip
+    with tracer.stage("cache_redis"):
+        whitelisted, cached_data = await cache_service.get_decision(ip)
+    if whitelisted:
+        return {"status": "whitelisted", "risk_level": "low"}
     
+    user_agent = request.headers.get("user-agent", "Unknown")
+    request_path = str(request.url)
+    with tracer.stage("verdict_cached"):
+        verdict = verdict_service.resolve_cached(ip, cached_data, user_agent, request_path=request_path)
+    if verdict is None:
+        with tracer.stage("verdict_lookup"):
+            verdict = await verdict_service.resolve_miss(ip, user_agent, request_path=request_path)
     if not cached_data:
-        # Get IP reputation
-        user_agent = request.headers.get("user-agent", "Unknown")
-        try:
-            ip_data = await ipqs_service.check_ip(ip, user_agent)
-        except Exception as e:
-            logging.error(f"Error calling ipqs api : {e}")
-            return {"error":"Error calling ipqs api"}
-        try:
-            risk_score = ip_data.get("fraud_score", 0)
-        except:
-            risk_score = 100
-        
-        # Calculate risk level
-        risk_level = ipqs_service.calculate_risk_level(ip_data, None)
-        
-        # Cache the results
-        cached_data = {  
-            "ip_address": ip,
-            "risk_score": ip_data.get("fraud_score", 0),
-            "is_proxy": ip_data.get("proxy", False),
-            "is_vpn": ip_data.get("vpn", False),
-            "is_tor": ip_data.get("tor", False),
-            "country_code": ip_data.get("country_code", "Unknown"),
-            "city": ip_data.get("city", None),
-            "risk_level": risk_level,
-            "request_path": str(request.url),
-            "user_agent": user_agent
-        }
-        await cache_service.set(cache_key, cached_data)
-        
         # Log request
-        await log_request(cached_data, risk_level)
+        with tracer.stage("audit_log"):
+            await log_request(verdict, verdict["risk_level"])
     
-    return cached_data 
-REQUEST_COUNT, REQUEST_LATENCY, CACHE_HITS, CACHE_MISSES, BLOCKED_IPS, WHITELISTED_IPS, RISK_SCORE = MetricsCollector.get_metrics()
+    return verdict
+
+
+async def _ndjson_ips(request: Request) -> list:
+    """
+    Parse IPs from an NDJSON body line by line; lines may be bare, JSON strings or {"ip": ...}.
+    The body is read before responding, as StreamingResponse consumes receive() for disconnects.
+    """
+    ips, buffer = [], b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        ips.extend(ip for ip in map(_ndjson_ip, lines) if ip)
+    ip = _ndjson_ip(buffer)
+    if ip:
+        ips.append(ip)
+    return ips
+
+def _ndjson_ip(line: bytes) -> str:
+    line = line.strip()
+    if not line.startswith((b'"', b"{")):
+        return line.decode(errors="replace")
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return line.decode(errors="replace")
+    return str(value.get("ip", "")) if isinstance(value, dict) else str(value)
+
+@app.post("/api/check-ips")
+async def check_ips(request: Request):
+    """
+    Check many IPs at once. Accepts a JSON array or an NDJSON stream and
+    streams NDJSON results back in completion order, each tagged with its IP.
+    """
+    if "ndjson" in request.headers.get("content-type", ""):
+        ips = iterate(await _ndjson_ips(request))
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Expected a JSON array of IP addresses or NDJSON")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of IP addresses or NDJSON")
+        ips = iterate(str(ip) for ip in body)
+
+    user_agent = request.headers.get("user-agent", "Unknown")
+
+    async def results():
+        async for result in bulk_checker.check(ips, user_agent, request_path=str(request.url)):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.get("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(seconds: float = 10.0, interval: Optional[float] = None, _: bool = Depends(verify_admin)):
+    """Sample this worker's event loop for a number of seconds; returns collapsed stacks for a flamegraph"""
+    if not 0 < seconds <= settings.PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {settings.PROFILER_MAX_SECONDS}")
+    interval = interval or settings.PROFILER_DEFAULT_INTERVAL
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1 second")
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="A profile is already being taken")
+    return await profiler.profile(seconds, interval)
 
 @app.get("/admin/metrics")
 async def admin_metrics(_: bool = Depends(verify_admin)):
-    """Get detailed system metrics"""
-    return {
-        "requests": {
-            "total": REQUEST_COUNT._value.sum() if REQUEST_COUNT._value else 0 ,
-            "by_status": {
-                "200": REQUEST_COUNT.labels(status=200)._value if REQUEST_COUNT.labels(status=200)._value else 0,
-                "403": REQUEST_COUNT.labels(status=403)._value if REQUEST_COUNT.labels(status=403)._value else 0,
-                "500": REQUEST_COUNT.labels(status=500)._value if REQUEST_COUNT.labels(status=500)._value else 0
-            }
-        },
-        "performance": {
-            "avg_latency": REQUEST_LATENCY._sum.sum() / REQUEST_LATENCY._count.sum() if REQUEST_LATENCY._count.sum()>0 else 0 ,
-            "cache_hit_rate": CACHE_HITS._value.sum() / (CACHE_HITS._value.sum() + CACHE_MISSES._value.sum()) if (CACHE_HITS._value.sum() + CACHE_MISSES._value.sum()) > 0 else 0,
-        },
-        "security": {
-            "blocked_ips": BLOCKED_IPS._value.sum(),
-            "whitelisted_ips": WHITELISTED_IPS._value,
-            "avg_risk_score": RISK_SCORE._sum.sum() / RISK_SCORE._count.sum() if RISK_SCORE._count.sum() > 0 else 0
-        }
-    } 
\ No newline at end of file
+    """Get detailed system metrics, summed over all workers"""
+    return MetricsCollector.admin_summary()
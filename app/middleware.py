@@ -0,0 +1,241 @@
+from typing import Any, Dict, Optional, Set
+import ipaddress
+import re
+import time
+from starlette.datastructures import Headers, URL
+from starlette.routing import Match
+from starlette.responses import HTMLResponse, JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from .config.settings import settings
+from .config.monitoring import MetricsCollector
+from .services.audit import log_request, log_request_nowait
+from .services.cache import cache_service, canonical_ip
+from .services.iplists import ip_lists, ALLOW, DENY
+from .services.ratelimit import rate_limiter
+from .services.tracing import tracer
+from .services.traffic import traffic_analytics
+from .services.verdicts import verdict_service
+
+# Admin dashboard, metrics and static files are not shielded
+UNSHIELDED_PREFIXES = ("/admin", "/static", "/metrics")
+
+CHALLENGE_PAGE = """
+            <html>
+                <head><title>Security Challenge</title></head>
+                <body>
+                    <h1>Please Complete Security Challenge</h1>
+                    <div class="g-recaptcha" data-sitekey="YOUR_RECAPTCHA_SITE_KEY"></div>
+                    <script src='https://www.google.com/recaptcha/api.js'></script>
+                </body>
+            </html>
+        """
+
+
+class ShieldMiddleware:
+    """
+    Decides whether a request reaches the application from the client IP's
+    verdict. Each stage has a synchronous form used when its data is held
+    in-process (CIDR lists, the local cache, the reputation snapshot, local
+    rate-limit blocks, the audit queue); the request only waits on Redis or
+    IPQS when one of those misses.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].startswith(UNSHIELDED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        ip_address = canonical_ip(scope["client"][0]) if scope.get("client") else "unknown"
+        # Every shielded request is counted, whatever is decided for it
+        traffic_analytics.record(ip_address)
+
+        # CIDR allow/deny lists are decided in-process, before any Redis or IPQS call
+        with tracer.stage("ip_lists"):
+            list_match = ip_lists.match(ip_address)
+        if list_match == ALLOW:
+            await self.app(scope, receive, send)
+            return
+        if list_match == DENY:
+            MetricsCollector.record_blocked_ip()
+            await JSONResponse(status_code=403, content={"error": "Access denied"})(scope, receive, send)
+            return
+
+        # Whitelist and cached verdict: in-process if held locally, otherwise one Redis round trip
+        with tracer.stage("cache_local"):
+            decision = cache_service.local_decision(ip_address)
+        if decision is None:
+            with tracer.stage("cache_redis"):
+                decision = await cache_service.get_decision(ip_address)
+        whitelisted, cached_data = decision
+        if whitelisted:
+            MetricsCollector.record_cache_hit()
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        user_agent = headers.get("user-agent", "Unknown")
+        device_fingerprint = headers.get("x-device-fingerprint")
+        request_path = str(URL(scope=scope))
+        with tracer.stage("verdict_cached"):
+            verdict = verdict_service.resolve_cached(ip_address, cached_data, user_agent, device_fingerprint,
+                                                     request_path)
+        if verdict is None:
+            with tracer.stage("verdict_lookup"):
+                verdict = await verdict_service.resolve_miss(ip_address, user_agent, device_fingerprint, request_path)
+        elif device_fingerprint:
+            with tracer.stage("verdict_device"):
+                verdict = await verdict_service.with_device(verdict, device_fingerprint)
+
+        # Log request and update metrics
+        risk_level = verdict["risk_level"]
+        with tracer.stage("audit_log"):
+            if not log_request_nowait(verdict, risk_level):
+                await log_request(verdict, risk_level)
+
+        # Handle based on risk level
+        if risk_level == "high":
+            response = JSONResponse(status_code=403, content={"error": "Access denied due to high risk score"})
+            await response(scope, receive, send)
+            return
+        # Throttle: reject over-limit clients immediately instead of holding the connection.
+        # Checked before the challenge page, so clients that keep getting challenged are limited too.
+        with tracer.stage("rate_limit"):
+            retry_after = rate_limiter.check_nowait(ip_address, risk_level)
+            if retry_after is None:
+                retry_after = await rate_limiter.check(ip_address, risk_level)
+        if retry_after:
+            response = JSONResponse(
+                status_code=429,
+                content={"error": "Too many requests"},
+                headers=rate_limiter.retry_after_header(retry_after)
+            )
+            await response(scope, receive, send)
+            return
+
+        if risk_level == "medium" and settings.CHALLENGE_ENABLED:
+            await HTMLResponse(content=CHALLENGE_PAGE)(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+
+# Endpoint label for requests beyond METRICS_MAX_ENDPOINTS
+OVERFLOW_ENDPOINT = "other"
+
+_TOKEN_SEGMENT = re.compile(r"^[0-9a-fA-F-]{16,}$|^(?=.*\d)[A-Za-z0-9_-]{20,}$")
+
+
+def _normalize_segment(segment: str) -> str:
+    if segment.isdigit():
+        return "{id}"
+    if _TOKEN_SEGMENT.match(segment):
+        return "{token}"
+    try:
+        ipaddress.ip_address(segment)
+        return "{ip}"
+    except ValueError:
+        return segment
+
+
+class EndpointLabels:
+    """
+    Bounded endpoint labels for request metrics. Routed requests are
+    labelled with the route template (/admin/whitelist/{ip_address}), even
+    when the shield answered before routing. Other paths are cut to
+    METRICS_PATH_DEPTH segments with IDs, tokens and addresses replaced by
+    placeholders. Past METRICS_MAX_ENDPOINTS distinct labels, new ones are
+    counted under OVERFLOW_ENDPOINT.
+    """
+
+    def __init__(self, max_labels: int, max_paths: int = 10000):
+        self.max_labels = max_labels
+        self.max_paths = max_paths
+        self._labels: Set[str] = set()
+        # Label per raw path, so unrouted paths are matched and normalized once
+        self._by_path: Dict[str, str] = {}
+        self._patterns = [(re.compile(pattern), replacement)
+                          for pattern, replacement in settings.METRICS_PATH_PATTERNS.items()]
+
+    def label(self, scope: Scope) -> str:
+        label = self._label(scope)
+        if label == OVERFLOW_ENDPOINT:
+            MetricsCollector.record_endpoint_overflow()
+        return label
+
+    def _label(self, scope: Scope) -> str:
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path_format"):
+            return self._bounded(route.path_format)
+
+        path = scope["path"]
+        label = self._by_path.get(path)
+        if label is None:
+            label = self._bounded(self._route_template(scope) or self.normalize(path))
+            if len(self._by_path) >= self.max_paths:
+                self._by_path.clear()
+            self._by_path[path] = label
+        return label
+
+    @staticmethod
+    def _route_template(scope: Scope) -> Optional[str]:
+        app: Any = scope.get("app")
+        for route in getattr(getattr(app, "router", None), "routes", ()):
+            match, _ = route.matches(scope)
+            if match != Match.NONE and hasattr(route, "path_format"):
+                return route.path_format
+        return None
+
+    def normalize(self, path: str) -> str:
+        for pattern, replacement in self._patterns:
+            path = pattern.sub(replacement, path)
+        segments = [segment for segment in path.split("/") if segment]
+        label = "/" + "/".join(_normalize_segment(segment) for segment in segments[:settings.METRICS_PATH_DEPTH])
+        return label + "/*" if len(segments) > settings.METRICS_PATH_DEPTH else label
+
+    def _bounded(self, label: str) -> str:
+        if label in self._labels:
+            return label
+        if len(self._labels) >= self.max_labels:
+            return OVERFLOW_ENDPOINT
+        self._labels.add(label)
+        return label
+
+
+class MetricsMiddleware:
+    """Records the count and latency of every HTTP request, including ones the shield answers"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.endpoints = EndpointLabels(settings.METRICS_MAX_ENDPOINTS)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+        trace = tracer.start_request()
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start_time
+            endpoint = self.endpoints.label(scope)
+            MetricsCollector.record_request(method=scope["method"], endpoint=endpoint, status=status_code)
+            MetricsCollector.record_latency(endpoint, duration)
+            if trace is not None:
+                tracer.finish_request(trace, f"{scope['method']} {endpoint}", {
+                    "http.request.method": scope["method"],
+                    "http.route": endpoint,
+                    "http.response.status_code": status_code,
+                })
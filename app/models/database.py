@@ -1,19 +1,50 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, create_engine, exc
+from sqlalchemy import Column, Integer, String, Text, Float, Boolean, DateTime, Index, UniqueConstraint, create_engine, event, exc, select, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from databases import Database
+from datetime import datetime, timezone
 import logging
+import sqlite3
 from ..config.settings import settings
 
+# Applied to every SQLite connection; journal_mode is persistent but cheap to repeat
+SQLITE_PRAGMAS = (
+    f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+    f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+    f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}",
+    f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def apply_sqlite_pragmas(connection):
+    for pragma in SQLITE_PRAGMAS:
+        connection.execute(pragma)
+
+
+class TunedSQLiteConnection(sqlite3.Connection):
+    """sqlite3 connection that applies SQLITE_PRAGMAS when opened"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        apply_sqlite_pragmas(self)
+
+
 # Database URL
-database = Database(settings.DATABASE_URL)
+if settings.DATABASE_URL.startswith("sqlite"):
+    # The sqlite backend opens a new connection per acquire and passes these options through
+    database = Database(settings.DATABASE_URL, factory=TunedSQLiteConnection)
+else:
+    database = Database(settings.DATABASE_URL)
 Base = declarative_base()
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
+    # Also serves lookups by ip_address alone
+    __table_args__ = (Index("ix_audit_logs_ip_address_timestamp", "ip_address", "timestamp"),)
     
     id = Column(Integer, primary_key=True, index=True)
-    ip_address = Column(String, index=True)
+    ip_address = Column(String)
     device_fingerprint = Column(String, nullable=True)
     risk_score = Column(Float)
     is_proxy = Column(Boolean)
@@ -22,7 +53,8 @@ class AuditLog(Base):
     country_code = Column(String)
     city = Column(String, nullable=True)
     action_taken = Column(String)  # "block", "throttle", "challenge", "allow"
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    verdict_source = Column(String, nullable=True)  # "ipqs", "subnet", "local", "device" or "fallback"
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     request_path = Column(String)
     user_agent = Column(String)
 
@@ -34,11 +66,88 @@ class WhitelistedIP(Base):
     expires_at = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-# Create tables
-try:
-    engine = create_engine(settings.DATABASE_URL)
-    Base.metadata.create_all(bind=engine)
-except exc.SQLAlchemyError as e:
-    logging.error(f"Database error: {e}")
-except Exception as e:
-    logging.error(f"An unexpected error occurred: {e}")
\ No newline at end of file
+class IPRangeRule(Base):
+    __tablename__ = "ip_range_rules"
+    __table_args__ = (UniqueConstraint("cidr", "list_type"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    cidr = Column(String, index=True)  # normalized network, e.g. "203.0.113.0/24"
+    list_type = Column(String)  # "allow" or "deny"
+    comment = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class RiskPolicy(Base):
+    """Published risk policies; the newest row is the one in force"""
+    __tablename__ = "risk_policies"
+
+    id = Column(Integer, primary_key=True)  # policy version
+    document = Column(Text)  # JSON {"rules": [...], "default": ...}
+    comment = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class AuditRollup(Base):
+    """Audit row counts per minute or hour, by action, country and risk bucket"""
+    __tablename__ = "audit_rollups"
+    __table_args__ = (
+        UniqueConstraint("granularity", "bucket_start", "action_taken", "country_code", "risk_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String)  # "minute" or "hour"
+    bucket_start = Column(DateTime)  # UTC
+    action_taken = Column(String)
+    country_code = Column(String)
+    risk_bucket = Column(Integer)  # lower bound of the 25-point risk score band
+    count = Column(Integer)
+
+class AuditIPRollup(Base):
+    """Audit row counts per IP, hour and action, for top-IP queries"""
+    __tablename__ = "audit_ip_rollups"
+    __table_args__ = (UniqueConstraint("bucket_start", "ip_address", "action_taken"),)
+
+    id = Column(Integer, primary_key=True)
+    bucket_start = Column(DateTime)  # UTC hour
+    ip_address = Column(String)
+    action_taken = Column(String)
+    count = Column(Integer)
+
+engine = create_engine(settings.DATABASE_URL)
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", lambda connection, _: apply_sqlite_pragmas(connection))
+
+
+def create_schema():
+    """Create missing tables and indexes; run once per deployment rather than in every worker"""
+    try:
+        Base.metadata.create_all(bind=engine)
+        # create_all skips indexes added to tables that already exist
+        for index in AuditLog.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+        if engine.dialect.name == "sqlite":
+            with engine.begin() as connection:
+                # create_all skips columns added to tables that already exist; archives copy audit_logs
+                tables = connection.execute(text(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'audit_logs%'"
+                )).scalars().all()
+                for table in tables:
+                    columns = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+                    if "verdict_source" not in columns:
+                        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN verdict_source VARCHAR"))
+                # Whitelist expiries used to be written as epoch seconds, which never compare as active
+                connection.execute(text(
+                    "UPDATE whitelisted_ips SET expires_at = datetime(expires_at, 'unixepoch') "
+                    "WHERE typeof(expires_at) IN ('integer', 'real')"
+                ))
+    except exc.SQLAlchemyError as e:
+        logging.error(f"Database error: {e}")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {e}")
+
+
+def count_active_whitelist() -> int:
+    """Whitelist entries that have not expired yet"""
+    with engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).select_from(WhitelistedIP.__table__)
+            .where(WhitelistedIP.expires_at > datetime.now(timezone.utc))
+        ).scalar()
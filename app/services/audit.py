@@ -0,0 +1,310 @@
+from typing import Optional, Dict, Any, List
+import asyncio
+import logging
+import random
+import re
+import time
+from datetime import date, datetime, timedelta, timezone
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from ..models.database import database, AuditLog
+from .cache import cache_service
+from .events import dashboard_events
+from .reports import audit_reports
+
+ARCHIVE_PREFIX = "audit_logs_"
+_ARCHIVE_TABLE = re.compile(r"^audit_logs_(\d{8})$")
+
+
+def verdict_source(verdict: Dict[str, Any]) -> str:
+    """Where a verdict came from: the IP's own IPQS lookup, or something it was borrowed or derived from"""
+    if verdict.get("degraded"):
+        return "fallback"
+    if verdict.get("source") == "local":
+        return "local"
+    if "subnet" in verdict:
+        return "subnet"
+    if verdict.get("device_adjusted"):
+        return "device"
+    return "ipqs"
+
+
+def audit_row(verdict: Dict[str, Any], action: str) -> Dict[str, Any]:
+    """Build an audit_logs row from a verdict and the action taken on it"""
+    return {
+        "ip_address": verdict["ip_address"],
+        "device_fingerprint": verdict.get("device_fingerprint"),
+        "risk_score": verdict["risk_score"],
+        "is_proxy": verdict["is_proxy"],
+        "is_vpn": verdict["is_vpn"],
+        "is_tor": verdict["is_tor"],
+        "country_code": verdict["country_code"],
+        "city": verdict.get("city"),
+        "action_taken": action,
+        "verdict_source": verdict_source(verdict),
+        # Stamped here rather than by the database, since rows are written later in batches
+        "timestamp": datetime.now(timezone.utc),
+        "request_path": verdict["request_path"],
+        "user_agent": verdict["user_agent"]
+    }
+
+
+class AuditWriter:
+    """
+    Buffers audit rows in a bounded in-memory queue and writes them from a
+    background task, one transaction per batch. A batch is flushed once
+    AUDIT_BATCH_SIZE rows are waiting or every AUDIT_FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        """Start the background flush task"""
+        if self._task is None:
+            self.queue = asyncio.Queue(maxsize=settings.AUDIT_QUEUE_SIZE)
+            self._batch_ready = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued and stop the background task"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    def submit_nowait(self, record: Dict[str, Any]) -> Optional[bool]:
+        """submit() without awaiting; None if the writer isn't running or the row would have to wait"""
+        if self._task is None or (self.queue.full() and settings.AUDIT_OVERFLOW_POLICY == "block"):
+            return None
+        queued = self._enqueue_nowait(record)
+        self._queued()
+        return queued
+
+    async def submit(self, record: Dict[str, Any]) -> bool:
+        """
+        Queue an audit row; returns False if it was dropped by the overflow policy
+        """
+        await self.start()
+        queued = await self._enqueue(record)
+        self._queued()
+        return queued
+
+    async def submit_many(self, records: List[Dict[str, Any]]) -> int:
+        """Queue several audit rows at once; returns how many were kept"""
+        await self.start()
+        queued = 0
+        for record in records:
+            queued += await self._enqueue(record)
+        self._queued()
+        return queued
+
+    async def _enqueue(self, record: Dict[str, Any]) -> bool:
+        if self.queue.full() and settings.AUDIT_OVERFLOW_POLICY == "block":
+            # Let the writer drain a full batch rather than waiting out the flush interval
+            self._batch_ready.set()
+            await self.queue.put(record)
+            return True
+        return self._enqueue_nowait(record)
+
+    def _enqueue_nowait(self, record: Dict[str, Any]) -> bool:
+        policy = settings.AUDIT_OVERFLOW_POLICY
+        if self.queue.full():
+            MetricsCollector.record_audit_dropped("overflow")
+            return False
+        # Past the high-water mark, "sample" keeps only a fraction of rows
+        if policy == "sample" and self.queue.qsize() >= self.queue.maxsize // 2 \
+                and random.random() >= settings.AUDIT_SAMPLE_RATE:
+            MetricsCollector.record_audit_dropped("sampled")
+            return False
+        self.queue.put_nowait(record)
+        return True
+
+    def _queued(self):
+        MetricsCollector.set_audit_queue_depth(self.queue.qsize())
+        if self.queue.qsize() >= settings.AUDIT_BATCH_SIZE:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), settings.AUDIT_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+        await self.flush()
+
+    async def flush(self):
+        """Write every queued row in batches of at most AUDIT_BATCH_SIZE"""
+        while self.queue is not None and not self.queue.empty():
+            size = min(settings.AUDIT_BATCH_SIZE, self.queue.qsize())
+            batch = [self.queue.get_nowait() for _ in range(size)]
+            await self._write(batch)
+            MetricsCollector.set_audit_queue_depth(self.queue.qsize())
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        start_time = time.perf_counter()
+        try:
+            async with database.transaction():
+                await database.execute_many(query=AuditLog.__table__.insert(), values=batch)
+                await audit_reports.record(batch)
+            dashboard_events.add_audit_rows(batch)
+        except Exception as e:
+            logging.error(f"Error writing audit batch of {len(batch)} rows: {e}")
+            MetricsCollector.record_audit_dropped("flush_error", len(batch))
+        finally:
+            MetricsCollector.record_audit_flush(len(batch), time.perf_counter() - start_time)
+
+
+def record_verdict_metrics(verdict: Dict[str, Any], action: str):
+    # Fallback verdicts carry no real score
+    if not verdict.get("degraded"):
+        MetricsCollector.record_risk_score(verdict["risk_score"])
+    if action == "high":
+        MetricsCollector.record_blocked_ip()
+
+
+def log_request_nowait(verdict: Dict[str, Any], action: str) -> bool:
+    """log_request without awaiting; False if the caller has to await log_request instead"""
+    if audit_writer.submit_nowait(audit_row(verdict, action)) is None:
+        return False
+    record_verdict_metrics(verdict, action)
+    return True
+
+
+async def log_request(verdict: Dict[str, Any], action: str):
+    """Queue request details for the audit log and update metrics"""
+    await audit_writer.submit(audit_row(verdict, action))
+    record_verdict_metrics(verdict, action)
+
+
+def _utc_date(ts: Optional[datetime]) -> Optional[date]:
+    if ts is None:
+        return None
+    return (ts.astimezone(timezone.utc) if ts.tzinfo else ts).date()
+
+
+def archive_table(day: date) -> str:
+    return f"{ARCHIVE_PREFIX}{day:%Y%m%d}"
+
+
+class AuditArchiver:
+    """
+    Keeps audit_logs small. Rows older than AUDIT_LIVE_DAYS are moved, in
+    batches, into one archive table per UTC day, and archive tables older
+    than AUDIT_RETENTION_DAYS are dropped whole. One worker at a time runs
+    it, under a Redis lock.
+    """
+
+    LOCK_KEY = "lock:audit-archive"
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task], timeout=5)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.AUDIT_COMPACT_INTERVAL)
+            token = await cache_service.acquire_lock(self.LOCK_KEY, int(settings.AUDIT_COMPACT_INTERVAL * 1000))
+            if token is None:
+                continue
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Error archiving audit logs: {e}")
+            finally:
+                await cache_service.release_lock(self.LOCK_KEY, token)
+
+    async def run_once(self, today: Optional[date] = None) -> Dict[str, int]:
+        """Archive old rows and drop expired archive tables; returns counts"""
+        today = today or datetime.now(timezone.utc).date()
+        cutoff = today - timedelta(days=settings.AUDIT_LIVE_DAYS - 1)
+        archived = 0
+        days = await database.fetch_all(
+            "SELECT DISTINCT date(timestamp) AS day FROM audit_logs WHERE timestamp < :cutoff",
+            {"cutoff": f"{cutoff} 00:00:00"}
+        )
+        for row in days:
+            if row["day"]:
+                archived += await self._archive_day(date.fromisoformat(row["day"]))
+
+        dropped = 0
+        oldest = today - timedelta(days=settings.AUDIT_RETENTION_DAYS)
+        for table in await self.archive_tables():
+            match = _ARCHIVE_TABLE.match(table)
+            if datetime.strptime(match.group(1), "%Y%m%d").date() < oldest:
+                await database.execute(f"DROP TABLE {table}")
+                dropped += 1
+
+        now = datetime.now(timezone.utc)
+        await audit_reports.prune(
+            minute_cutoff=now - timedelta(hours=settings.AUDIT_ROLLUP_MINUTE_RETENTION_HOURS),
+            hour_cutoff=now - timedelta(days=settings.AUDIT_RETENTION_DAYS)
+        )
+
+        if database.url.dialect == "sqlite":
+            await database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await database.execute("PRAGMA optimize")
+        MetricsCollector.record_audit_archived(archived, dropped)
+        return {"archived": archived, "dropped_tables": dropped}
+
+    async def archive_tables(self) -> List[str]:
+        rows = await database.fetch_all(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :prefix ORDER BY name",
+            {"prefix": f"{ARCHIVE_PREFIX}%"}
+        )
+        return [row["name"] for row in rows if _ARCHIVE_TABLE.match(row["name"])]
+
+    async def archives_between(self, since: Optional[datetime], until: Optional[datetime]) -> List[str]:
+        """Archive tables for the UTC days from since to until (either end open), newest first"""
+        first, last = _utc_date(since), _utc_date(until)
+        tables = []
+        for table in await self.archive_tables():
+            day = datetime.strptime(_ARCHIVE_TABLE.match(table).group(1), "%Y%m%d").date()
+            if (first is None or day >= first) and (last is None or day <= last):
+                tables.append(table)
+        return tables[::-1]
+
+    async def _archive_day(self, day: date) -> int:
+        table = archive_table(day)
+        window = {"start": f"{day} 00:00:00", "end": f"{day + timedelta(days=1)} 00:00:00"}
+        in_window = "timestamp >= :start AND timestamp < :end"
+        await database.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM audit_logs WHERE 0")
+        await database.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_ip_address ON {table} (ip_address)")
+        moved = 0
+        while True:
+            # Short transactions, so the audit writer is never blocked for long
+            async with database.transaction():
+                last_id = await database.fetch_val(
+                    f"SELECT MAX(id) FROM (SELECT id FROM audit_logs WHERE {in_window} ORDER BY id LIMIT :batch)",
+                    {**window, "batch": settings.AUDIT_COMPACT_BATCH}
+                )
+                if last_id is None:
+                    return moved
+                batch = {**window, "last_id": last_id}
+                await database.execute(
+                    f"INSERT INTO {table} SELECT * FROM audit_logs WHERE {in_window} AND id <= :last_id", batch
+                )
+                moved += await database.fetch_val("SELECT changes()")
+                await database.execute(f"DELETE FROM audit_logs WHERE {in_window} AND id <= :last_id", batch)
+
+
+# Create singleton instances
+audit_writer = AuditWriter()
+audit_archiver = AuditArchiver()
@@ -0,0 +1,126 @@
+from typing import Dict, Any, AsyncIterator, Iterable, List, Set
+import asyncio
+import ipaddress
+from ..config.settings import settings
+from .audit import audit_writer, audit_row, record_verdict_metrics
+from .cache import cache_service, canonical_ip
+from .iplists import ip_lists
+from .verdicts import verdict_service
+
+
+async def _chunks(ips: AsyncIterator[str], size: int) -> AsyncIterator[List[str]]:
+    chunk = []
+    async for ip in ips:
+        chunk.append(ip)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def iterate(ips: Iterable[str]) -> AsyncIterator[str]:
+    """Adapt a plain iterable of IPs to the async input BulkChecker.check expects"""
+    for ip in ips:
+        yield ip
+
+
+class BulkChecker:
+    """
+    Scores many IPs for one caller. Input is deduplicated and handled in
+    chunks: list matches and cached verdicts are answered from one MGET per
+    chunk, and the misses are looked up with at most BULK_CHECK_CONCURRENCY
+    IPQS calls in flight. Results are yielded as soon as they are known.
+    """
+
+    async def check(self, ips: AsyncIterator[str], user_agent: str,
+                    request_path: str = "") -> AsyncIterator[Dict[str, Any]]:
+        seen: Set[str] = set()
+        pending: Set[asyncio.Task] = set()
+        audit_rows: List[Dict[str, Any]] = []
+        try:
+            async for chunk in _chunks(ips, settings.BULK_CHECK_CHUNK_SIZE):
+                unique, over_limit = [], False
+                for ip in chunk:
+                    # Different spellings of one address are checked once
+                    ip = canonical_ip(ip.strip())
+                    if not ip or ip in seen:
+                        continue
+                    if len(seen) >= settings.BULK_CHECK_MAX_IPS:
+                        over_limit = True
+                        break
+                    seen.add(ip)
+                    unique.append(ip)
+
+                misses = []
+                for result in await self._answer_cached(unique, user_agent, request_path, misses):
+                    yield result
+
+                for ip in misses:
+                    if len(pending) >= settings.BULK_CHECK_CONCURRENCY:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield self._looked_up(task.result(), audit_rows)
+                    pending.add(asyncio.create_task(
+                        verdict_service.resolve(ip, None, user_agent, request_path=request_path)
+                    ))
+
+                if audit_rows:
+                    await audit_writer.submit_many(audit_rows)
+                    audit_rows = []
+                if over_limit:
+                    yield {"error": f"Too many IPs; only the first {settings.BULK_CHECK_MAX_IPS} were checked"}
+                    break
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield self._looked_up(task.result(), audit_rows)
+        finally:
+            for task in pending:
+                task.cancel()
+            if audit_rows:
+                await audit_writer.submit_many(audit_rows)
+
+    async def _answer_cached(self, ips: List[str], user_agent: str, request_path: str,
+                             misses: List[str]) -> List[Dict[str, Any]]:
+        """Results for every IP answerable without IPQS; the rest are appended to misses"""
+        results, candidates = [], []
+        for ip in ips:
+            try:
+                ipaddress.ip_address(ip)
+            except ValueError:
+                results.append({"ip": ip, "error": "Invalid IP address"})
+                continue
+            list_match = ip_lists.match(ip)
+            if list_match == "allow":
+                results.append({"ip": ip, "status": "whitelisted", "risk_level": "low"})
+            elif list_match == "deny":
+                results.append({"ip": ip, "status": "blocked", "risk_level": "high"})
+            else:
+                candidates.append(ip)
+
+        if candidates:
+            decisions = await cache_service.get_decisions(candidates)
+            for ip, (whitelisted, cached) in zip(candidates, decisions):
+                if whitelisted:
+                    results.append({"ip": ip, "status": "whitelisted", "risk_level": "low"})
+                    continue
+                # Stale verdicts are served without a refresh, which would escape BULK_CHECK_CONCURRENCY
+                verdict = verdict_service.resolve_cached(ip, cached, user_agent, request_path=request_path,
+                                                         refresh=False)
+                if verdict is not None:
+                    results.append({"ip": ip, **verdict})
+                else:
+                    misses.append(ip)
+        return results
+
+    @staticmethod
+    def _looked_up(verdict: Dict[str, Any], audit_rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        audit_rows.append(audit_row(verdict, verdict["risk_level"]))
+        record_verdict_metrics(verdict, verdict["risk_level"])
+        return {"ip": verdict["ip_address"], **verdict}
+
+
+# Create singleton instance
+bulk_checker = BulkChecker()
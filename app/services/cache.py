@@ -1,80 +1,560 @@
+import asyncio
+import functools
+import ipaddress
 import json
-from typing import Optional, Any
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
 import logging
-from redis import asyncio as aioredis
+from redis import exceptions as redis_exceptions
 from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .redis_client import create_redis, close_redis
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Marker for "not held locally", distinct from a cached negative (None) result
+_MISSING = object()
+
+
+@functools.lru_cache(maxsize=65536)
+def canonical_ip(ip: str) -> str:
+    """
+    The one spelling of an address used in keys: IPv4-mapped IPv6 as plain
+    IPv4, other IPv6 compressed and lower-case. Anything that is not an
+    address is returned unchanged.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return str(address)
+
+
+@functools.lru_cache(maxsize=65536)
+def subnet_of(ip: str) -> str:
+    """Return the /24 (IPv4) or /64 (IPv6) network containing ip; raises ValueError if it is not an address"""
+    address = ipaddress.ip_address(canonical_ip(ip))
+    prefix = 24 if address.version == 4 else 64
+    # Masking the integer is several times cheaper than building an ip_network
+    host_bits = address.max_prefixlen - prefix
+    return f"{type(address)(int(address) >> host_bits << host_bits)}/{prefix}"
+
+
+def verdict_key(ip: str) -> str:
+    return f"ip:{canonical_ip(ip)}"
+
+
+def whitelist_key(ip: str) -> str:
+    return f"whitelist:{canonical_ip(ip)}"
+
+
+def subnet_key(network: str) -> str:
+    # The {network} hash tag keeps a prefix's verdict and tally on one shard in sharded Redis mode
+    return f"subnet:{{{network}}}"
+
+
+class LocalCache:
+    """Bounded, TTL-aware LRU cache held in process memory.
+
+    Values are stored as decoded objects and returned by reference, so
+    callers must treat them as read-only.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Any:
+        """Return the cached value, or _MISSING if absent or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            MetricsCollector.record_local_cache_miss()
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            MetricsCollector.record_local_cache_eviction("expired")
+            MetricsCollector.record_local_cache_miss()
+            return _MISSING
+        self._entries.move_to_end(key)
+        MetricsCollector.record_local_cache_hit()
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value, evicting the least recently used entries when full"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            MetricsCollector.record_local_cache_eviction("capacity")
+        MetricsCollector.set_local_cache_size(len(self._entries))
+
+    def delete(self, key: str):
+        """Drop a key if present"""
+        if self._entries.pop(key, None) is not None:
+            MetricsCollector.record_local_cache_eviction("invalidated")
+            MetricsCollector.set_local_cache_size(len(self._entries))
+
+    def clear(self):
+        """Drop every entry"""
+        if self._entries:
+            MetricsCollector.record_local_cache_eviction("flushed")
+        self._entries.clear()
+        MetricsCollector.set_local_cache_size(0)
+
+
+class HotKeyTracker:
+    """
+    Approximate hit counts for cached verdicts, halved on every refresh-ahead
+    scan so that only keys hit steadily stay hot. Bounded to max_keys; new
+    keys are ignored while full until the next decay frees room.
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> [hits, expires_at]
+        self._entries: Dict[str, List[float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def record(self, key: str, expires_at: float):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[1] = expires_at
+        elif len(self._entries) < self.max_keys:
+            self._entries[key] = [1, expires_at]
+
+    def due(self, now: float, window: float, min_hits: int, limit: int) -> List[str]:
+        """Hottest keys expiring within window seconds; they are marked so they are not picked twice"""
+        keys = [
+            key for key, (hits, expires_at) in self._entries.items()
+            if hits >= min_hits and expires_at - now <= window
+        ]
+        keys.sort(key=lambda key: self._entries[key][0], reverse=True)
+        keys = keys[:limit]
+        for key in keys:
+            # Picked up again once a hit reports the refreshed expiry
+            self._entries[key][1] = float("inf")
+        return keys
+
+    def decay(self):
+        self._entries = {
+            key: [hits // 2, expires_at]
+            for key, (hits, expires_at) in self._entries.items()
+            if hits > 1
+        }
+
 
 class CacheService:
     def __init__(self):
         self.redis = None
-        
+        self.local = LocalCache(settings.LOCAL_CACHE_MAX_SIZE, settings.LOCAL_CACHE_TTL) \
+            if settings.LOCAL_CACHE_ENABLED else None
+        # Identifies this worker so it can ignore its own invalidation messages
+        self.instance_id = uuid.uuid4().hex
+        self._listener_task = None
+        self._listening = False
+        # Keys whose invalidation triggers a reload elsewhere in the process
+        self._invalidation_handlers: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._scripts: Dict[str, Any] = {}
+        self.hot_keys = HotKeyTracker(settings.REFRESH_AHEAD_MAX_KEYS)
+        self._refresh_task = None
+
     async def init(self):
         """Initialize Redis connection"""
         if not self.redis:
-            self.redis = aioredis.Redis(
-                host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                db=settings.REDIS_DB,
-                password=settings.REDIS_PASSWORD,
-                decode_responses=True
-            )
-            
-    async def _execute_redis_command(self, command, *args, **kwargs):
-        """Execute a Redis command with error handling."""
+            self.redis = create_redis()
+        if self._listener_task is None:
+            self._listening = True
+            self._listener_task = asyncio.create_task(self._listen_for_invalidations())
+
+    async def _execute_redis_command(self, command, *args, error_result=None, **kwargs):
+        """Execute a Redis command with error handling, returning error_result if it fails.
+
+        Connection errors and timeouts have already been retried with
+        backoff by the client (REDIS_RETRY_ATTEMPTS) when they get here.
+        """
         try:
             return await command(*args, **kwargs)
-        except aioredis.exceptions.ConnectionError as e:
+        except redis_exceptions.ConnectionError as e:
             logging.error(f"Redis connection error: {e}")
-            return None
-        except aioredis.exceptions.RedisError as e:
+            MetricsCollector.record_redis_error("connection")
+            return error_result
+        except redis_exceptions.TimeoutError as e:
+            logging.error(f"Redis timeout: {e}")
+            MetricsCollector.record_redis_error("timeout")
+            return error_result
+        except redis_exceptions.RedisError as e:
             logging.error(f"Redis error: {e}")
-            return None
-    
-    async def get(self, key: str) -> Optional[Any]:
+            MetricsCollector.record_redis_error("other")
+            return error_result
+
+    def on_invalidate(self, key: str, handler: Callable[[], Awaitable[Any]]):
+        """Run handler whenever another worker publishes an invalidation for key"""
+        self._invalidation_handlers[key] = handler
+
+    def _flush_local(self):
+        if self.local is not None:
+            self.local.clear()
+
+    async def _listen_for_invalidations(self):
+        """Evict local entries when another worker writes or deletes a key.
+
+        The local cache is flushed (and every invalidation handler run) whenever
+        the subscription is re-established, since invalidations published while
+        disconnected are lost.
+        """
+        subscribed_before = False
+        while self._listening:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL)
+                # redis-py can swallow a cancellation delivered while it connects
+                if asyncio.current_task().cancelling():
+                    raise asyncio.CancelledError()
+                self._flush_local()
+                if subscribed_before:
+                    for handler in self._invalidation_handlers.values():
+                        asyncio.create_task(handler())
+                subscribed_before = True
+                while self._listening:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    origin, _, key = message["data"].partition(" ")
+                    if origin == self.instance_id:
+                        continue
+                    if self.local is not None:
+                        self.local.delete(key)
+                    handler = self._invalidation_handlers.get(key)
+                    if handler is not None:
+                        asyncio.create_task(handler())
+            except asyncio.CancelledError:
+                # The pubsub connection is released when the pool is closed
+                raise
+            except Exception as e:
+                logging.error(f"Cache invalidation listener error: {e}")
+                self._flush_local()
+                try:
+                    await pubsub.reset()
+                except Exception:
+                    pass
+                await asyncio.sleep(1)
+
+    def _publish_invalidation(self, pipe, key: str):
+        """Queue an invalidation message for other workers on a pipeline"""
+        pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, f"{self.instance_id} {key}")
+
+    async def publish_invalidation(self, key: str) -> bool:
+        """Tell other workers that key changed without writing it"""
+        await self.init()
+        result = await self._execute_redis_command(
+            self.redis.publish, settings.CACHE_INVALIDATION_CHANNEL, f"{self.instance_id} {key}"
+        )
+        return result is not None
+
+    async def get(self, key: str, use_local: bool = True) -> Optional[Any]:
         """Get value from cache"""
+        if use_local and self.local is not None:
+            value = self.local.get(key)
+            if value is not _MISSING:
+                return value
         await self.init()
-        value = await self._execute_redis_command(self.redis.get, key)
-        if value:
-            return json.loads(value)
-        return None
-    
+        value = await self._execute_redis_command(self.redis.get, key, error_result=_MISSING)
+        if value is _MISSING:
+            # Not held locally: a failed read is not a miss
+            return None
+        value = json.loads(value) if value else None
+        if use_local and self.local is not None:
+            # Negative results are held too, so repeat misses skip Redis
+            self.local.set(key, value)
+        return value
+
+    async def get_many(self, keys: List[str], use_local: bool = True) -> List[Optional[Any]]:
+        """Get several values in one MGET round trip, skipping keys held locally"""
+        if use_local and self.local is not None:
+            values = [self.local.get(key) for key in keys]
+        else:
+            values = [_MISSING] * len(keys)
+        missing = [i for i, value in enumerate(values) if value is _MISSING]
+        if missing:
+            await self.init()
+            raw_values = await self._execute_redis_command(
+                self.redis.mget, [keys[i] for i in missing], error_result=_MISSING
+            )
+            if raw_values is _MISSING:
+                # A failed read is not a miss, so nothing is held locally
+                for i in missing:
+                    values[i] = None
+                return values
+            for i, raw in zip(missing, raw_values):
+                values[i] = json.loads(raw) if raw else None
+                if self.local is not None:
+                    self.local.set(keys[i], values[i])
+        return values
+
+    async def _scan_batches(self, pattern: str, limit: int, batch: int) -> AsyncIterator[List[str]]:
+        keys: List[str] = []
+        async for key in self.redis.scan_iter(match=pattern, count=batch):
+            keys.append(key)
+            limit -= 1
+            if len(keys) >= batch or limit <= 0:
+                yield keys
+                keys = []
+                if limit <= 0:
+                    return
+        if keys:
+            yield keys
+
+    async def scan(self, pattern: str, limit: int, batch: int = 500) -> AsyncIterator[Tuple[str, Any]]:
+        """(key, value) for up to limit keys matching pattern, read from Redis in MGET batches"""
+        await self.init()
+        try:
+            async for keys in self._scan_batches(pattern, limit, batch):
+                for key, raw in zip(keys, await self.redis.mget(keys)):
+                    yield key, json.loads(raw) if raw else None
+        except redis_exceptions.RedisError as e:
+            logging.error(f"Redis error scanning {pattern}: {e}")
+
+    def local_get(self, key: str) -> Optional[Any]:
+        """The value held in the in-process cache for key, or None, without touching Redis"""
+        if self.local is None:
+            return None
+        value = self.local.get(key)
+        return None if value is _MISSING else value
+
+    @staticmethod
+    def _decision_keys(ip: str) -> List[str]:
+        """The whitelist and verdict keys for ip, then its prefix verdict key if that tier is on"""
+        keys = [whitelist_key(ip), verdict_key(ip)]
+        if settings.SUBNET_VERDICTS_ENABLED:
+            try:
+                keys.append(subnet_key(subnet_of(ip)))
+            except ValueError:
+                pass
+        return keys
+
+    @staticmethod
+    def _decision(values: List[Optional[Any]]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        whitelisted, verdict = values[0], values[1]
+        if verdict is None and len(values) > 2:
+            # The prefix verdict only answers for IPs without one of their own
+            verdict = values[2]
+        return whitelisted is not None, verdict
+
+    def local_decision(self, ip: str) -> Optional[Tuple[bool, Optional[Dict[str, Any]]]]:
+        """get_decision answered from the in-process cache alone, or None if Redis is needed"""
+        if self.local is None:
+            return None
+        keys = self._decision_keys(ip)
+        whitelisted = self.local.get(keys[0])
+        if whitelisted is not _MISSING and whitelisted is not None:
+            return True, None
+        verdict = self.local.get(keys[1])
+        if whitelisted is _MISSING or verdict is _MISSING:
+            return None
+        if verdict is None and len(keys) > 2:
+            verdict = self.local.get(keys[2])
+            if verdict is _MISSING:
+                return None
+        return False, verdict
+
+    async def get_decision(self, ip: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Return (is_whitelisted, cached verdict) for an IP in a single round trip"""
+        decision = self.local_decision(ip)
+        if decision is not None:
+            return decision
+        return self._decision(await self.get_many(self._decision_keys(ip), use_local=False))
+
+    async def get_decisions(self, ips: List[str]) -> List[Tuple[bool, Optional[Dict[str, Any]]]]:
+        """get_decision for several IPs with one MGET, skipping keys held locally"""
+        key_lists = [self._decision_keys(ip) for ip in ips]
+        values = await self.get_many([key for keys in key_lists for key in keys])
+        decisions, position = [], 0
+        for keys in key_lists:
+            decisions.append(self._decision(values[position:position + len(keys)]))
+            position += len(keys)
+        return decisions
+
     async def set(self, key: str, value: Any, expire: int = None) -> bool:
         """Set value in cache with optional expiration"""
         await self.init()
-        result = await self._execute_redis_command(self.redis.set,
-            key,
-            json.dumps(value),
-            ex=expire or settings.CACHE_TTL
-        )
-        return result is not None
-    
+        expire = expire or settings.CACHE_TTL
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(key, json.dumps(value), ex=expire)
+        self._publish_invalidation(pipe, key)
+        result = await self._execute_redis_command(pipe.execute)
+        if result is None:
+            return False
+        if self.local is not None:
+            self.local.set(key, value, expire)
+        return True
+
+    async def set_many(self, items: Dict[str, Any], expire: int = None) -> bool:
+        """Set several values with one pipelined round trip"""
+        if not items:
+            return True
+        await self.init()
+        expire = expire or settings.CACHE_TTL
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(key, json.dumps(value), ex=expire)
+            self._publish_invalidation(pipe, key)
+        result = await self._execute_redis_command(pipe.execute)
+        if result is None:
+            return False
+        if self.local is not None:
+            for key, value in items.items():
+                self.local.set(key, value, expire)
+        return True
+
+    async def fill(self, entries: List[Tuple[str, Any, int]], batch: int = 1000) -> List[str]:
+        """
+        Write (key, value, expire) entries that Redis does not hold, with
+        pipelined SET NX, batch keys per round trip; returns the keys written.
+        No invalidations are published: only absent keys are written, and a
+        miss another worker holds locally lapses within LOCAL_CACHE_TTL.
+        """
+        await self.init()
+        written: List[str] = []
+        for start in range(0, len(entries), batch):
+            chunk = entries[start:start + batch]
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value, expire in chunk:
+                pipe.set(key, json.dumps(value), ex=max(1, int(expire)), nx=True)
+            result = await self._execute_redis_command(pipe.execute)
+            if result is None:
+                break
+            for (key, value, expire), stored in zip(chunk, result):
+                if stored:
+                    written.append(key)
+                    if self.local is not None:
+                        self.local.set(key, value, expire)
+        return written
+
     async def delete(self, key: str) -> bool:
         """Delete key from cache"""
         await self.init()
-        result = await self._execute_redis_command(self.redis.delete,key)
-        return result is not None and result > 0
-    
+        if self.local is not None:
+            self.local.delete(key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(key)
+        self._publish_invalidation(pipe, key)
+        result = await self._execute_redis_command(pipe.execute)
+        return result is not None and result[0] > 0
+
+    async def set_field(self, key: str, field: str, value: str, expire: int) -> bool:
+        """Set one field of a Redis hash shared by all workers and renew its expiry; not held locally"""
+        await self.init()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(key, field, value)
+        pipe.expire(key, expire)
+        return await self._execute_redis_command(pipe.execute) is not None
+
+    async def get_fields(self, keys: List[str]) -> Optional[List[Dict[str, str]]]:
+        """Every field of several Redis hashes in one pipelined round trip; None on Redis errors"""
+        if not keys:
+            return []
+        await self.init()
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return await self._execute_redis_command(pipe.execute)
+
+    async def eval_script(self, script: str, keys: List[str], args: List[Any]) -> Optional[Any]:
+        """Run a Lua script by SHA, loading it on first use; returns None on Redis errors"""
+        await self.init()
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self.redis.register_script(script)
+        return await self._execute_redis_command(registered, keys=keys, args=args)
+
+    async def acquire_lock(self, key: str, ttl_ms: int) -> Optional[str]:
+        """Take a short-lived lease on key; returns the lease token, or None if held elsewhere"""
+        await self.init()
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis.set(key, token, nx=True, px=ttl_ms)
+        except redis_exceptions.RedisError as e:
+            # Without Redis there is nobody to coordinate with, so proceed as the holder
+            logging.error(f"Redis error acquiring lock {key}: {e}")
+            return token
+        return token if acquired else None
+
+    async def release_lock(self, key: str, token: str) -> bool:
+        """Release a lease taken with acquire_lock if it is still ours"""
+        result = await self.eval_script(_RELEASE_LOCK_SCRIPT, [key], [token])
+        return bool(result)
+
     async def is_whitelisted(self, ip: str) -> bool:
         """Check if IP is whitelisted"""
-        result = await self.get(f"whitelist:{ip}")
+        result = await self.get(whitelist_key(ip))
         return result is not None
-    
+
     async def whitelist_ip(self, ip: str) -> bool:
         """Whitelist an IP address"""
         result = await self.set(
-            f"whitelist:{ip}",
+            whitelist_key(ip),
             True,
             expire=settings.WHITELIST_TTL
         )
-        return result is not None
-    
+        return result
+
+    def start_refresh_ahead(self, refresh: Callable[[str], Awaitable[Any]]):
+        """Periodically hand hot keys that are close to expiry to refresh(key)"""
+        if settings.REFRESH_AHEAD_ENABLED and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_ahead_loop(refresh))
+
+    async def _refresh_ahead_loop(self, refresh: Callable[[str], Awaitable[Any]]):
+        while True:
+            await asyncio.sleep(settings.REFRESH_AHEAD_INTERVAL)
+            keys = self.hot_keys.due(
+                time.time(),
+                settings.REFRESH_AHEAD_WINDOW,
+                settings.REFRESH_AHEAD_MIN_HITS,
+                settings.REFRESH_AHEAD_BATCH
+            )
+            for key in keys:
+                try:
+                    await refresh(key)
+                    MetricsCollector.record_refresh_ahead()
+                except Exception as e:
+                    logging.error(f"Refresh-ahead of {key} failed: {e}")
+            self.hot_keys.decay()
+            MetricsCollector.set_hot_keys(len(self.hot_keys))
+
     async def close(self):
         """Close Redis connection"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.wait([self._refresh_task], timeout=2)
+            self._refresh_task = None
+        if self._listener_task is not None:
+            self._listening = False
+            self._listener_task.cancel()
+            await asyncio.wait([self._listener_task], timeout=2)
+            self._listener_task = None
         try:
             if self.redis:
-                await self.redis.close()
+                await close_redis(self.redis)
         except Exception as e:
             logging.error(f"Error closing Redis connection: {e}")
 
 # Create singleton instance
-cache_service = CacheService() 
\ No newline at end of file
+cache_service = CacheService()
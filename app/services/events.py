@@ -0,0 +1,103 @@
+from typing import Optional, Dict, Any, Iterable, Set
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+
+# Sent to a dashboard that fell behind; it reloads the logs instead of replaying missed events
+_RESYNC_FRAME = "event: resync\ndata: {}\n\n"
+_HEARTBEAT_FRAME = ": ping\n\n"
+
+
+def sse_frame(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class DashboardBroadcaster:
+    """
+    Pushes live updates to every connected admin dashboard over Server-Sent
+    Events. One background task per worker builds each update once, every
+    DASHBOARD_EVENTS_INTERVAL seconds: the metric values that changed and
+    the audit rows written since the last tick. Each update is then queued
+    to all subscribers. A subscriber whose buffer is full is not waited on;
+    its backlog is replaced with a resync event.
+    """
+
+    def __init__(self):
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._audit_rows: deque = deque(maxlen=settings.DASHBOARD_EVENTS_MAX_ROWS)
+        self._last_summary: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        """Register a dashboard; its queue starts with the current metric values"""
+        queue = asyncio.Queue(maxsize=settings.DASHBOARD_EVENTS_CLIENT_BUFFER)
+        summary = MetricsCollector.dashboard_summary()
+        if not self._subscribers:
+            # Ticks skip work while nobody is watching, so restart the deltas from here
+            self._last_summary = summary
+        queue.put_nowait(sse_frame("metrics", summary))
+        self._subscribers.add(queue)
+        MetricsCollector.set_dashboard_subscribers(len(self._subscribers))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        MetricsCollector.set_dashboard_subscribers(len(self._subscribers))
+
+    def add_audit_rows(self, rows: Iterable[Dict[str, Any]]):
+        """Hand newly written audit rows to the next tick; free when nobody is watching"""
+        if self._subscribers:
+            self._audit_rows.extend(rows)
+
+    def publish(self, frame: str):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_RESYNC_FRAME)
+                MetricsCollector.record_dashboard_resync()
+
+    def tick(self):
+        """Build and publish one round of updates"""
+        summary = MetricsCollector.dashboard_summary()
+        changed = {key: value for key, value in summary.items() if self._last_summary.get(key) != value}
+        self._last_summary = summary
+        if changed:
+            self.publish(sse_frame("metrics", changed))
+        if self._audit_rows:
+            rows = list(self._audit_rows)
+            self._audit_rows.clear()
+            self.publish(sse_frame("logs", rows))
+
+    async def _run(self):
+        last_heartbeat = time.monotonic()
+        while True:
+            await asyncio.sleep(settings.DASHBOARD_EVENTS_INTERVAL)
+            if not self._subscribers:
+                self._audit_rows.clear()
+                continue
+            try:
+                self.tick()
+                if time.monotonic() - last_heartbeat >= settings.DASHBOARD_EVENTS_HEARTBEAT:
+                    self.publish(_HEARTBEAT_FRAME)
+                    last_heartbeat = time.monotonic()
+            except Exception as e:
+                logging.error(f"Error publishing dashboard events: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task], timeout=2)
+            self._task = None
+
+
+# Create singleton instance
+dashboard_events = DashboardBroadcaster()
@@ -0,0 +1,162 @@
+from typing import Optional, Dict, Any, Iterable, List, Tuple
+import ipaddress
+import logging
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from ..models.database import database, IPRangeRule
+from .cache import cache_service
+
+ALLOW = "allow"
+DENY = "deny"
+LIST_TYPES = (ALLOW, DENY)
+
+# Published through the cache invalidation channel when the lists change
+RELOAD_KEY = "iplists:version"
+
+
+class PrefixTrie:
+    """Binary radix trie answering longest-prefix-match queries for one address family"""
+
+    __slots__ = ("bits", "max_prefix", "_root")
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.max_prefix = 0
+        # Nodes are [zero child, one child, value]
+        self._root: List[Any] = [None, None, None]
+
+    def insert(self, network: int, prefixlen: int, value: str):
+        node = self._root
+        for i in range(prefixlen):
+            bit = (network >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        # A network present in both lists is denied
+        if node[2] != DENY:
+            node[2] = value
+        self.max_prefix = max(self.max_prefix, prefixlen)
+
+    def lookup(self, address: int) -> Optional[str]:
+        """Return the value of the most specific network containing address"""
+        node = self._root
+        match = node[2]
+        shift = self.bits - 1
+        for i in range(self.max_prefix):
+            node = node[(address >> (shift - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+
+class IPListMatcher:
+    """Immutable allow/deny matcher compiled from a set of CIDR rules"""
+
+    def __init__(self, rules: Iterable[Tuple[str, str]] = ()):
+        self.v4 = PrefixTrie(32)
+        self.v6 = PrefixTrie(128)
+        self.counts = {ALLOW: 0, DENY: 0}
+        for cidr, list_type in rules:
+            network = ipaddress.ip_network(cidr, strict=False)
+            trie = self.v4 if network.version == 4 else self.v6
+            trie.insert(int(network.network_address), network.prefixlen, list_type)
+            self.counts[list_type] += 1
+        self.empty = not any(self.counts.values())
+
+    def match(self, ip: str) -> Optional[str]:
+        """Return "allow", "deny" or None for an IP address string"""
+        if self.empty:
+            return None
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        trie = self.v4 if address.version == 4 else self.v6
+        return trie.lookup(int(address))
+
+
+def normalize_cidr(value: str) -> str:
+    """Validate a CIDR or bare address and return its canonical network form"""
+    return str(ipaddress.ip_network(value.strip(), strict=False))
+
+
+class IPListService:
+    """
+    Holds the compiled allow/deny lists for this worker. Rules live in the
+    ip_range_rules table; every change bumps RELOAD_KEY so all workers
+    recompile and swap in a new matcher.
+    """
+
+    def __init__(self):
+        self.matcher = IPListMatcher()
+
+    async def start(self):
+        cache_service.on_invalidate(RELOAD_KEY, self.load)
+        await self.load()
+
+    async def load(self):
+        """Recompile the matcher from the database and swap it in"""
+        try:
+            rows = await database.fetch_all(
+                IPRangeRule.__table__.select().with_only_columns(IPRangeRule.cidr, IPRangeRule.list_type)
+            )
+            matcher = IPListMatcher((row["cidr"], row["list_type"]) for row in rows)
+        except Exception as e:
+            logging.error(f"Error loading IP lists: {e}")
+            return
+        self.matcher = matcher
+        for list_type in LIST_TYPES:
+            MetricsCollector.set_ip_list_rules(list_type, matcher.counts[list_type])
+
+    def match(self, ip: str) -> Optional[str]:
+        """Return "allow", "deny" or None; never touches Redis or the database"""
+        if not settings.IP_LISTS_ENABLED:
+            return None
+        result = self.matcher.match(ip)
+        if result is not None:
+            MetricsCollector.record_ip_list_match(result)
+        return result
+
+    async def list_rules(self) -> List[Dict[str, Any]]:
+        rows = await database.fetch_all(IPRangeRule.__table__.select().order_by(IPRangeRule.id))
+        return [dict(row._mapping) for row in rows]
+
+    async def add(self, list_type: str, cidrs: Iterable[str], comment: Optional[str] = None) -> Dict[str, Any]:
+        """Bulk-insert networks into a list, skipping duplicates; returns a summary"""
+        networks, invalid = set(), []
+        for cidr in cidrs:
+            if not cidr.strip() or cidr.lstrip().startswith("#"):
+                continue
+            try:
+                networks.add(normalize_cidr(cidr))
+            except ValueError:
+                invalid.append(cidr)
+
+        if networks:
+            query = IPRangeRule.__table__.insert().prefix_with("OR IGNORE")
+            async with database.transaction():
+                await database.execute_many(
+                    query=query,
+                    values=[{"cidr": cidr, "list_type": list_type, "comment": comment} for cidr in networks]
+                )
+            await self._reload_everywhere()
+        return {"accepted": len(networks), "invalid": invalid}
+
+    async def remove(self, list_type: str, cidr: str):
+        query = IPRangeRule.__table__.delete().where(
+            (IPRangeRule.cidr == normalize_cidr(cidr)) & (IPRangeRule.list_type == list_type)
+        )
+        await database.execute(query)
+        await self._reload_everywhere()
+
+    async def _reload_everywhere(self):
+        await self.load()
+        await cache_service.publish_invalidation(RELOAD_KEY)
+
+
+# Create singleton instance
+ip_lists = IPListService()
@@ -1,17 +1,233 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Awaitable, Callable
+import asyncio
+import time
 import httpx
 import logging
 from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service
+from .policy import risk_policy
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key onto one in-flight task"""
+
+    def __init__(self, lookup: str):
+        self.lookup = lookup
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is not None:
+            MetricsCollector.record_coalesced_call(self.lookup, "local")
+        else:
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # Shielded so one waiter disconnecting does not cancel the shared lookup
+        return await asyncio.shield(future)
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling IPQS while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling IPQS after IPQS_BREAKER_FAILURE_THRESHOLD consecutive
+    failures. After IPQS_BREAKER_RESET_TIMEOUT seconds a single probe call is
+    let through; its outcome closes the circuit or opens it again.
+    """
+
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_inflight = False
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logging.warning(f"IPQS circuit breaker {self.state} -> {state}")
+            self.state = state
+            MetricsCollector.set_ipqs_circuit_state(self.STATES[state])
+
+    def is_open(self) -> bool:
+        """True while calls are being refused outright (cool-down not yet over)"""
+        return self.state == "open" and time.monotonic() - self.opened_at < settings.IPQS_BREAKER_RESET_TIMEOUT
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open state only one probe at a time"""
+        if self.state == "closed":
+            return True
+        if self.is_open():
+            return False
+        self._set_state("half_open")
+        if self._probe_inflight:
+            return False
+        self._probe_inflight = True
+        return True
+
+    def release(self):
+        """End a call that says nothing about upstream health; a half-open probe may go out again"""
+        self._probe_inflight = False
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_inflight = False
+        self._set_state("closed")
+
+    def record_failure(self):
+        self._probe_inflight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= settings.IPQS_BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
 
 class IPQSService:
     def __init__(self):
         self.api_key = settings.IPQS_API_KEY
         self.base_url = settings.IPQS_BASE_URL
         self.device_base_url = settings.IPQS_DEVICE_BASE_URL
-        
+        self._ip_lookups = SingleFlight("ip")
+        self._device_lookups = SingleFlight("device")
+        self.client: Optional[httpx.AsyncClient] = None
+        self._inflight = 0
+        self.breaker = CircuitBreaker()
+
+    async def start(self):
+        """Open the pooled HTTP client used for every IPQS call"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=settings.IPQS_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=settings.IPQS_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.IPQS_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.IPQS_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(
+                    connect=settings.IPQS_CONNECT_TIMEOUT,
+                    read=settings.IPQS_READ_TIMEOUT,
+                    write=settings.IPQS_WRITE_TIMEOUT,
+                    pool=settings.IPQS_POOL_TIMEOUT
+                )
+            )
+
+    async def close(self):
+        """Close the pooled HTTP client"""
+        if self.client is not None:
+            try:
+                await self.client.aclose()
+            except Exception as e:
+                logging.error(f"Error closing IPQS client: {e}")
+            self.client = None
+
+    async def _get(self, upstream: str, url: str, params: Optional[Dict[str, Any]] = None) -> httpx.Response:
+        """GET through the pooled client, recording latency, pool usage and breaker outcome"""
+        if not self.breaker.allow():
+            MetricsCollector.record_ipqs_short_circuit(upstream)
+            raise CircuitOpenError("IPQS circuit breaker is open")
+        await self.start()
+        self._inflight += 1
+        MetricsCollector.set_ipqs_pool_usage(self._inflight, settings.IPQS_MAX_CONNECTIONS)
+        outcome = "error"
+        # None for calls that say nothing about upstream health: cancelled, or refused as a client error
+        upstream_failed: Optional[bool] = None
+        start_time = time.perf_counter()
+        try:
+            response = await self.client.get(url, params=params)
+            if response.status_code >= 500 or response.status_code == 429:
+                upstream_failed = True
+            elif response.status_code < 400:
+                upstream_failed = False
+            response.raise_for_status()
+            outcome = "ok"
+            return response
+        except httpx.TransportError as e:
+            upstream_failed = True
+            if isinstance(e, httpx.TimeoutException):
+                outcome = "timeout"
+                if isinstance(e, httpx.PoolTimeout):
+                    MetricsCollector.record_ipqs_pool_timeout()
+            raise
+        finally:
+            if upstream_failed is None:
+                self.breaker.release()
+            elif upstream_failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            self._inflight -= 1
+            MetricsCollector.set_ipqs_pool_usage(self._inflight, settings.IPQS_MAX_CONNECTIONS)
+            MetricsCollector.record_ipqs_latency(upstream, outcome, time.perf_counter() - start_time)
+
+    async def _shared_lookup(self, lookup: str, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Run fetch at most once across workers: the holder of a short Redis
+        lease calls IPQS and publishes the result, everyone else polls for it
+        until the lease runs out and then falls back to calling IPQS itself.
+        """
+        if not settings.IPQS_COALESCE_ACROSS_WORKERS:
+            return await fetch()
+
+        result_key = f"ipqs:{lookup}:{key}"
+        lock_key = f"lock:{result_key}"
+        token = await cache_service.acquire_lock(lock_key, settings.IPQS_LOOKUP_LEASE_MS)
+        if token is None:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + settings.IPQS_LOOKUP_LEASE_MS / 1000
+            while loop.time() < deadline:
+                await asyncio.sleep(settings.IPQS_LOOKUP_POLL_MS / 1000)
+                result = await cache_service.get(result_key, use_local=False)
+                if result is not None:
+                    MetricsCollector.record_coalesced_call(lookup, "remote")
+                    return result
+            return await fetch()
+
+        try:
+            result = await fetch()
+            if "error" not in result and result.get("success", True):
+                await cache_service.set(result_key, result, expire=settings.IPQS_SHARED_RESULT_TTL)
+            else:
+                # Hand the failure to waiting workers briefly so they don't wait out the lease
+                await cache_service.set(result_key, result, expire=1)
+            return result
+        finally:
+            await cache_service.release_lock(lock_key, token)
+
     async def check_ip(self, ip_address: str, user_agent: Optional[str] = None) -> Dict[str, Any]:
         """
-        Check IP reputation using IPQS API
+        Check IP reputation using IPQS API; concurrent lookups for the same IP share one call
+        """
+        if self.breaker.is_open():
+            MetricsCollector.record_ipqs_short_circuit("ip")
+            return {"error": "Circuit open"}
+        return await self._ip_lookups.do(
+            ip_address,
+            lambda: self._shared_lookup("ip", ip_address, lambda: self._fetch_ip(ip_address, user_agent))
+        )
+
+    async def check_device(self, fingerprint: str) -> Dict[str, Any]:
+        """
+        Check device fingerprint using IPQS API; concurrent lookups for the same fingerprint share one call
+        """
+        if self.breaker.is_open():
+            MetricsCollector.record_ipqs_short_circuit("device")
+            return {"error": "Circuit open"}
+        return await self._device_lookups.do(
+            fingerprint,
+            lambda: self._shared_lookup("device", fingerprint, lambda: self._fetch_device(fingerprint))
+        )
+
+    async def _fetch_ip(self, ip_address: str, user_agent: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Call the IPQS IP reputation API
         """
         params = {
             "user_agent": user_agent or "Unknown",
@@ -20,13 +236,14 @@ class IPQSService:
             "mobile": "1"
         }        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.api_key}/{ip_address}",
-                    params=params
-                )
-                response.raise_for_status()
-                return response.json()
+            response = await self._get(
+                "ip",
+                f"{self.base_url}/{self.api_key}/{ip_address}",
+                params=params
+            )
+            return response.json()
+        except CircuitOpenError:
+            return {"error": "Circuit open"}
         except httpx.HTTPError as e:
             logging.error(f"HTTP error occurred: {e}")
             return {"error": "HTTP error", "details": str(e)}
@@ -34,20 +251,28 @@ class IPQSService:
             logging.error(f"An unexpected error occurred: {e}")
             return {"error": "Unexpected error", "details": str(e)}
     
-    async def check_device(self, fingerprint: str) -> Dict[str, Any]:
+    async def _fetch_device(self, fingerprint: str) -> Dict[str, Any]:
         """
-        Check device fingerprint using IPQS API
+        Call the IPQS device fingerprint API
         """
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
+        try:
+            response = await self._get(
+                "device",
                 f"{self.device_base_url}/{self.api_key}/{fingerprint}"
             )
-            response.raise_for_status()
             return response.json()
+        except CircuitOpenError:
+            return {"error": "Circuit open"}
+        except httpx.HTTPError as e:
+            logging.error(f"HTTP error occurred: {e}")
+            return {"error": "HTTP error", "details": str(e)}
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {e}")
+            return {"error": "Unexpected error", "details": str(e)}
     
     def calculate_risk_level(self, ip_data: Dict[str, Any], device_data: Optional[Dict[str, Any]] = None) -> str:
         """
-        Calculate risk level based on IP and device data
+        Calculate risk level from IP and device data with the risk policy in force
         Returns: "high", "medium", or "low"
         """
         risk_score = ip_data.get("fraud_score", 0)
@@ -56,11 +281,8 @@ class IPQSService:
         if device_data and device_data.get("fraud_score", 0) > risk_score:
             risk_score = device_data["fraud_score"]
         
-        if risk_score >= settings.HIGH_RISK_THRESHOLD:
-            return "high"
-        elif risk_score >= settings.MEDIUM_RISK_THRESHOLD:
-            return "medium"
-        return "low"
+        return risk_policy.decide(risk_score, bool(ip_data.get("proxy")), bool(ip_data.get("vpn")),
+                                  bool(ip_data.get("tor")), ip_data.get("country_code"))
 
 # Create singleton instance
 ipqs_service = IPQSService() 
\ No newline at end of file
@@ -0,0 +1,245 @@
+from typing import Optional, Dict, Any, List, Tuple
+import json
+import logging
+import operator
+from collections import Counter
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from ..models.database import database, RiskPolicy
+from .cache import cache_service
+
+# Risk level each rule action yields: the shield blocks high, challenges medium and allows low
+ACTIONS = {"block": "high", "challenge": "medium", "allow": "low"}
+FLAGS = ("proxy", "vpn", "tor")
+SCORE_TESTS = {"score_gt": operator.gt, "score_gte": operator.ge, "score_lt": operator.lt, "score_lte": operator.le}
+RULE_KEYS = {"name", "action", "country", "not_country", *FLAGS, *SCORE_TESTS}
+
+# Integer fraud scores are tabulated; anything else is evaluated against the rules
+MAX_SCORE = 100
+
+# Published through the cache invalidation channel when a new policy is saved
+RELOAD_KEY = "policy:version"
+
+
+class PolicyError(ValueError):
+    """Raised for a policy document that cannot be compiled"""
+
+
+def default_document() -> Dict[str, Any]:
+    """The policy in force until one is published: the RISK_THRESHOLD_* score bands"""
+    return {
+        "rules": [
+            {"name": "high score", "action": "block", "score_gte": settings.RISK_THRESHOLD_HIGH},
+            {"name": "medium score", "action": "challenge", "score_gte": settings.RISK_THRESHOLD_MEDIUM},
+        ],
+        "default": "allow",
+    }
+
+
+def _countries(spec: Dict[str, Any], key: str, name: str) -> Optional[frozenset]:
+    if key not in spec:
+        return None
+    value = spec[key]
+    codes = [value] if isinstance(value, str) else value
+    if not isinstance(codes, list) or not codes or not all(isinstance(code, str) for code in codes):
+        raise PolicyError(f"{name}: {key} must be a country code or a list of them")
+    return frozenset(code.upper() for code in codes)
+
+
+class Rule:
+    """One policy rule: every condition it names must hold for its action to apply"""
+
+    __slots__ = ("name", "level", "flags", "countries", "excluded", "score_tests")
+
+    def __init__(self, spec: Any, position: int):
+        name = f"rule {position}"
+        if not isinstance(spec, dict):
+            raise PolicyError(f"{name} must be an object")
+        name = str(spec.get("name") or name)
+        unknown = set(spec) - RULE_KEYS
+        if unknown:
+            raise PolicyError(f"{name}: unknown keys {', '.join(sorted(unknown))}")
+        if spec.get("action") not in ACTIONS:
+            raise PolicyError(f"{name}: action must be one of {', '.join(ACTIONS)}")
+        self.name = name
+        self.level = ACTIONS[spec["action"]]
+        self.flags = []
+        for index, flag in enumerate(FLAGS):
+            if flag in spec:
+                if not isinstance(spec[flag], bool):
+                    raise PolicyError(f"{name}: {flag} must be true or false")
+                self.flags.append((index, spec[flag]))
+        self.countries = _countries(spec, "country", name)
+        self.excluded = _countries(spec, "not_country", name)
+        self.score_tests = []
+        for key, test in SCORE_TESTS.items():
+            if key in spec:
+                bound = spec[key]
+                if isinstance(bound, bool) or not isinstance(bound, (int, float)):
+                    raise PolicyError(f"{name}: {key} must be a number")
+                self.score_tests.append((test, bound))
+
+    def matches_request(self, flags: Tuple[bool, bool, bool], country: Optional[str]) -> bool:
+        """Whether the flag and country conditions hold; the score is checked separately"""
+        if any(flags[index] != value for index, value in self.flags):
+            return False
+        if self.countries is not None and country not in self.countries:
+            return False
+        return self.excluded is None or country not in self.excluded
+
+
+def _first_level(candidates: Tuple[Tuple[list, str], ...], default: str, score: float) -> str:
+    for score_tests, level in candidates:
+        for test, bound in score_tests:
+            if not test(score, bound):
+                break
+        else:
+            return level
+    return default
+
+
+class CompiledPolicy:
+    """
+    An immutable policy ready for the hot path. Rules apply first match
+    first. For each combination of proxy/vpn/tor flags and country class
+    (each country some rule names, plus all other countries) the rules
+    that can still match are selected up front, and their outcome for
+    every integer score from 0 to MAX_SCORE is tabulated, so a decision
+    is a couple of list lookups.
+    """
+
+    def __init__(self, document: Any, version: int = 0):
+        if not isinstance(document, dict) or not isinstance(document.get("rules"), list):
+            raise PolicyError('A policy is an object with a "rules" list')
+        unknown = set(document) - {"rules", "default"}
+        if unknown:
+            raise PolicyError(f"Unknown policy keys {', '.join(sorted(unknown))}")
+        if document.get("default", "allow") not in ACTIONS:
+            raise PolicyError(f"default must be one of {', '.join(ACTIONS)}")
+        self.document = document
+        self.version = version
+        self.default = ACTIONS[document.get("default", "allow")]
+        rules = [Rule(spec, position) for position, spec in enumerate(document["rules"], 1)]
+        self.rule_count = len(rules)
+
+        countries = sorted({
+            code for rule in rules for codes in (rule.countries, rule.excluded) if codes for code in codes
+        })
+        # Country class 0 is every country no rule mentions
+        self._country_class = {code: index for index, code in enumerate(countries, 1)}
+        self._classes = len(countries) + 1
+        self._candidates: List[Tuple[Tuple[list, str], ...]] = []
+        self._levels: List[Tuple[str, ...]] = []
+        for flag_bits in range(8):
+            flags = (bool(flag_bits & 1), bool(flag_bits & 2), bool(flag_bits & 4))
+            for country in [None] + countries:
+                candidates = []
+                for rule in rules:
+                    if rule.matches_request(flags, country):
+                        candidates.append((rule.score_tests, rule.level))
+                        if not rule.score_tests:
+                            # Always matches here, so later rules never get a say
+                            break
+                candidates = tuple(candidates)
+                self._candidates.append(candidates)
+                self._levels.append(tuple(
+                    _first_level(candidates, self.default, score) for score in range(MAX_SCORE + 1)
+                ))
+
+    def decide(self, score: float, proxy: bool, vpn: bool, tor: bool, country: Optional[str]) -> str:
+        """Risk level for a request's features; flags must be bools"""
+        slot = (proxy + 2 * vpn + 4 * tor) * self._classes
+        if self._classes > 1:
+            slot += self._country_class.get(country, 0)
+        if type(score) is int and 0 <= score <= MAX_SCORE:
+            return self._levels[slot][score]
+        return _first_level(self._candidates[slot], self.default, score)
+
+    def level_for(self, verdict: Dict[str, Any]) -> str:
+        """Risk level for a cached verdict"""
+        return self.decide(verdict.get("risk_score", 0), bool(verdict.get("is_proxy")), bool(verdict.get("is_vpn")),
+                           bool(verdict.get("is_tor")), verdict.get("country_code"))
+
+
+class RiskPolicyService:
+    """
+    Holds the compiled risk policy for this worker: the newest row of
+    risk_policies, or the RISK_THRESHOLD_* bands if none was published.
+    Publishing bumps RELOAD_KEY so all workers recompile and swap in the
+    new policy; a decision always sees one whole policy.
+    """
+
+    def __init__(self):
+        self.policy = CompiledPolicy(default_document())
+
+    async def start(self):
+        cache_service.on_invalidate(RELOAD_KEY, self.load)
+        await self.load()
+
+    async def load(self):
+        """Recompile the policy in force from the database and swap it in"""
+        try:
+            row = await database.fetch_one(
+                RiskPolicy.__table__.select().order_by(RiskPolicy.id.desc()).limit(1)
+            )
+            if row is None:
+                policy = CompiledPolicy(default_document())
+            else:
+                policy = CompiledPolicy(json.loads(row["document"]), row["id"])
+        except Exception as e:
+            logging.error(f"Error loading risk policy: {e}")
+            return
+        self.policy = policy
+        MetricsCollector.set_risk_policy(policy.version, policy.rule_count)
+
+    def decide(self, score: float, proxy: bool, vpn: bool, tor: bool, country: Optional[str]) -> str:
+        return self.policy.decide(score, proxy, vpn, tor, country)
+
+    def describe(self) -> Dict[str, Any]:
+        return {"version": self.policy.version, "policy": self.policy.document}
+
+    async def publish(self, document: Any, comment: Optional[str] = None) -> Dict[str, Any]:
+        """Validate and store a policy, then make every worker use it; raises PolicyError if invalid"""
+        CompiledPolicy(document)
+        query = RiskPolicy.__table__.insert().values(document=json.dumps(document), comment=comment)
+        await database.execute(query)
+        await self.load()
+        await cache_service.publish_invalidation(RELOAD_KEY)
+        return self.describe()
+
+    async def dry_run(self, document: Any, limit: int) -> Dict[str, Any]:
+        """
+        Replay up to limit cached verdicts through a candidate policy and
+        report how their risk levels would change from the policy in force
+        """
+        candidate = CompiledPolicy(document)
+        current = self.policy
+        evaluated = 0
+        transitions: Counter = Counter()
+        current_levels: Counter = Counter()
+        candidate_levels: Counter = Counter()
+        samples = []
+        async for key, verdict in cache_service.scan("ip:*", limit):
+            if not isinstance(verdict, dict) or "risk_score" not in verdict:
+                continue
+            evaluated += 1
+            before = current.level_for(verdict)
+            after = candidate.level_for(verdict)
+            current_levels[before] += 1
+            candidate_levels[after] += 1
+            if before != after:
+                transitions[f"{before}->{after}"] += 1
+                if len(samples) < settings.RISK_POLICY_DRY_RUN_SAMPLES:
+                    samples.append({"ip_address": verdict.get("ip_address"), "current": before, "candidate": after})
+        return {
+            "current_version": current.version,
+            "evaluated": evaluated,
+            "changed": sum(transitions.values()),
+            "transitions": dict(transitions),
+            "levels": {"current": dict(current_levels), "candidate": dict(candidate_levels)},
+            "samples": samples,
+        }
+
+
+# Create singleton instance
+risk_policy = RiskPolicyService()
@@ -0,0 +1,62 @@
+from typing import Dict
+import asyncio
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _frame_name(code) -> str:
+    filename = code.co_filename.rsplit("site-packages/", 1)[-1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    """Count the call stacks of one thread, sampled every interval for seconds"""
+    stacks: Counter = Counter()
+    names: Dict[object, str] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = _frame_name(code)
+            stack.append(name)
+            frame = frame.f_back
+        if stack:
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    """Folded stacks, one "frame;frame;frame count" line each, as read by flamegraph.pl and speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread of this worker from a helper thread, so
+    requests keep being served while it runs. Time the loop spends idle
+    shows up under the selector's select() frame. One profile at a time.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, seconds: float, interval: float) -> str:
+        """Collapsed stacks of the calling event loop's thread over the next seconds"""
+        async with self._lock:
+            stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval)
+        return collapsed(stacks)
+
+
+# Create singleton instance
+profiler = SamplingProfiler()
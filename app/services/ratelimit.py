@@ -0,0 +1,115 @@
+from typing import Optional, Dict
+import math
+import time
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service, subnet_of
+
+# Token buckets for every key in KEYS, consumed all-or-nothing.
+# ARGV: now_ms, then (rate per second, burst) for each key.
+# Returns 0 if allowed, otherwise the milliseconds until a token is available.
+_TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local available = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    available = math.min(burst, available + math.max(0, now - last) * rate / 1000)
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, math.ceil((1 - available) * 1000 / rate))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local available = tokens[i]
+    if wait == 0 then
+        available = available - 1
+    end
+    redis.call("HSET", key, "tokens", available, "ts", now)
+    redis.call("PEXPIRE", key, math.ceil(burst * 1000 / rate))
+end
+return wait
+"""
+
+
+class RateLimiter:
+    """
+    Per-IP and per-subnet token buckets enforced atomically in Redis.
+    Clients already known to be over their limit are rejected from a
+    local table until their retry time passes, without a Redis call.
+    """
+
+    def __init__(self):
+        self._blocked_until: Dict[str, float] = {}
+
+    def _limits(self, risk_level: str) -> Optional[Dict[str, float]]:
+        if not settings.RATE_LIMIT_ENABLED:
+            return None
+        return settings.RATE_LIMITS.get(risk_level)
+
+    def _remember_block(self, key: str, until: float):
+        if len(self._blocked_until) >= settings.RATE_LIMIT_LOCAL_MAX_SIZE:
+            now = time.monotonic()
+            self._blocked_until = {k: v for k, v in self._blocked_until.items() if v > now}
+            if len(self._blocked_until) >= settings.RATE_LIMIT_LOCAL_MAX_SIZE:
+                self._blocked_until.clear()
+        self._blocked_until[key] = until
+
+    def check_nowait(self, ip: str, risk_level: str) -> Optional[float]:
+        """check() when it can be answered without Redis, otherwise None"""
+        limits = self._limits(risk_level)
+        if not limits:
+            return 0
+
+        local_key = f"{risk_level}:{ip}"
+        blocked_until = self._blocked_until.get(local_key)
+        if blocked_until is not None:
+            remaining = blocked_until - time.monotonic()
+            if remaining > 0:
+                MetricsCollector.record_rate_limited(risk_level, "local")
+                return remaining
+            del self._blocked_until[local_key]
+        return None
+
+    async def check(self, ip: str, risk_level: str) -> float:
+        """Take a token for ip; returns 0 if allowed, otherwise seconds until retry"""
+        retry_after = self.check_nowait(ip, risk_level)
+        if retry_after is not None:
+            return retry_after
+
+        limits = self._limits(risk_level)
+        local_key = f"{risk_level}:{ip}"
+        try:
+            subnet = subnet_of(ip)
+        except ValueError:
+            subnet = None
+        # The {subnet} hash tag keeps both buckets on one shard in sharded Redis mode
+        tag = f"{{{subnet or ip}}}"
+        keys = [f"ratelimit:{risk_level}:{tag}:ip:{ip}"]
+        args = [int(time.time() * 1000), limits["ip_rate"], limits["ip_burst"]]
+        if limits.get("subnet_rate") and subnet is not None:
+            keys.append(f"ratelimit:{risk_level}:{tag}:net")
+            args += [limits["subnet_rate"], limits["subnet_burst"]]
+
+        # An unreachable Redis fails open
+        wait_ms = await cache_service.eval_script(_TOKEN_BUCKET_SCRIPT, keys, args)
+        if not wait_ms:
+            return 0
+        retry_after = wait_ms / 1000
+        self._remember_block(local_key, time.monotonic() + retry_after)
+        MetricsCollector.record_rate_limited(risk_level, "redis")
+        return retry_after
+
+    @staticmethod
+    def retry_after_header(retry_after: float) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+# Create singleton instance
+rate_limiter = RateLimiter()
@@ -0,0 +1,241 @@
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import bisect
+import hashlib
+from redis import asyncio as aioredis
+from redis import exceptions as redis_exceptions
+from redis.asyncio.retry import Retry
+from redis.asyncio.sentinel import Sentinel
+from redis.backoff import EqualJitterBackoff
+from ..config.settings import settings
+
+
+def _connection_options() -> Dict[str, Any]:
+    """Timeouts, health checks and retry shared by every Redis connection"""
+    return {
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+        # Connection errors and timeouts are retried on a fresh connection
+        "retry": Retry(
+            EqualJitterBackoff(cap=settings.REDIS_RETRY_BACKOFF_CAP, base=settings.REDIS_RETRY_BACKOFF_BASE),
+            settings.REDIS_RETRY_ATTEMPTS
+        ),
+        "retry_on_error": [redis_exceptions.ConnectionError, redis_exceptions.TimeoutError],
+        "decode_responses": True,
+    }
+
+
+def _pooled(pool: aioredis.ConnectionPool) -> aioredis.Redis:
+    return aioredis.Redis(connection_pool=pool)
+
+
+def _address(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    return host, int(port)
+
+
+def hash_slot_key(key: str) -> str:
+    """The part of key that picks its shard: the first non-empty {hash tag}, as in Redis Cluster"""
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing over shard indexes, with vnodes points per shard.
+    Adding or removing one of N shards moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes: List[str], vnodes: int):
+        points = sorted(
+            (_hash(f"{node}#{i}"), index)
+            for index, node in enumerate(nodes)
+            for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def index_for(self, key: str) -> int:
+        position = bisect.bisect(self._hashes, _hash(hash_slot_key(key)))
+        return self._indexes[position % len(self._indexes)]
+
+
+class _ShardedScript:
+    """A Lua script run on the shard holding its keys, which must all share one"""
+
+    def __init__(self, redis: "ShardedRedis", script: str):
+        self._redis = redis
+        self._script = script
+        self._registered: Dict[int, Any] = {}
+
+    async def __call__(self, keys: List[str] = (), args: List[Any] = ()):
+        indexes = {self._redis.ring.index_for(key) for key in keys}
+        if len(indexes) > 1:
+            raise redis_exceptions.DataError(f"Script keys {list(keys)} map to different shards; give them a common {{hash tag}}")
+        index = indexes.pop() if indexes else 0
+        registered = self._registered.get(index)
+        if registered is None:
+            registered = self._registered[index] = self._redis.shards[index].register_script(self._script)
+        return await registered(keys=keys, args=args)
+
+
+class _ShardedPipeline:
+    """
+    Queues commands and sends each shard its share as one pipeline, all
+    shards concurrently; results come back in the order commands were
+    queued. Every queued command takes its key first, except PUBLISH,
+    which goes to the first shard with the subscribers.
+    """
+
+    def __init__(self, redis: "ShardedRedis"):
+        self._redis = redis
+        self._commands: List[Tuple[int, str, tuple, dict]] = []
+
+    def publish(self, channel: str, message: str):
+        self._commands.append((0, "publish", (channel, message), {}))
+        return self
+
+    def __getattr__(self, name: str):
+        def queue(key, *args, **kwargs):
+            self._commands.append((self._redis.ring.index_for(key), name, (key,) + args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> List[Any]:
+        pipes: Dict[int, Any] = {}
+        positions: Dict[int, List[int]] = {}
+        for position, (index, name, args, kwargs) in enumerate(self._commands):
+            pipe = pipes.get(index)
+            if pipe is None:
+                pipe = pipes[index] = self._redis.shards[index].pipeline(transaction=False)
+            getattr(pipe, name)(*args, **kwargs)
+            positions.setdefault(index, []).append(position)
+        self._commands = []
+        results: List[Any] = [None] * sum(len(p) for p in positions.values())
+        replies = await asyncio.gather(*(pipe.execute() for pipe in pipes.values()))
+        for index, reply in zip(pipes, replies):
+            for position, value in zip(positions[index], reply):
+                results[position] = value
+        return results
+
+
+class ShardedRedis:
+    """
+    Client-side sharding over several independent Redis instances, covering
+    the commands CacheService uses. Keys are placed with a HashRing; pub/sub
+    (cache invalidation) lives on the first shard.
+    """
+
+    def __init__(self, shards: List[aioredis.Redis], names: List[str], vnodes: int):
+        self.shards = shards
+        self.ring = HashRing(names, vnodes)
+
+    def _shard(self, key: str) -> aioredis.Redis:
+        return self.shards[self.ring.index_for(key)]
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._shard(key).get(key)
+
+    async def set(self, key: str, value: Any, **kwargs) -> Any:
+        return await self._shard(key).set(key, value, **kwargs)
+
+    async def mget(self, keys: List[str]) -> List[Optional[str]]:
+        """One MGET per shard involved, sent concurrently"""
+        by_shard: Dict[int, List[int]] = {}
+        for position, key in enumerate(keys):
+            by_shard.setdefault(self.ring.index_for(key), []).append(position)
+        replies = await asyncio.gather(*(
+            self.shards[index].mget([keys[position] for position in positions])
+            for index, positions in by_shard.items()
+        ))
+        results: List[Optional[str]] = [None] * len(keys)
+        for positions, reply in zip(by_shard.values(), replies):
+            for position, value in zip(positions, reply):
+                results[position] = value
+        return results
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None) -> AsyncIterator[str]:
+        """SCAN every shard in turn"""
+        for shard in self.shards:
+            async for key in shard.scan_iter(match=match, count=count):
+                yield key
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self.shards[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.shards[0].pubsub(**kwargs)
+
+    def pipeline(self, transaction: bool = False) -> _ShardedPipeline:
+        if transaction:
+            raise redis_exceptions.DataError("Transactions are not supported across shards")
+        return _ShardedPipeline(self)
+
+    def register_script(self, script: str) -> _ShardedScript:
+        return _ShardedScript(self, script)
+
+    async def ping(self) -> bool:
+        return all(await asyncio.gather(*(shard.ping() for shard in self.shards)))
+
+    async def aclose(self):
+        for shard in self.shards:
+            await close_redis(shard)
+
+
+def create_redis():
+    """Build the Redis client for REDIS_MODE: standalone, sentinel or sharded"""
+    options = _connection_options()
+    if settings.REDIS_MODE == "sentinel":
+        sentinel = Sentinel(
+            [_address(address) for address in settings.REDIS_SENTINELS],
+            sentinel_kwargs={
+                "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+                "socket_connect_timeout": settings.REDIS_CONNECT_TIMEOUT,
+                "password": settings.REDIS_SENTINEL_PASSWORD,
+            }
+        )
+        # The pool asks the sentinels for the current master on every new connection
+        return sentinel.master_for(
+            settings.REDIS_SENTINEL_SERVICE,
+            db=settings.REDIS_DB,
+            password=settings.REDIS_PASSWORD,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            **options
+        )
+    if settings.REDIS_MODE == "sharded":
+        shards = [
+            _pooled(aioredis.BlockingConnectionPool.from_url(
+                url,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                **options
+            ))
+            for url in settings.REDIS_SHARD_URLS
+        ]
+        return ShardedRedis(shards, settings.REDIS_SHARD_URLS, settings.REDIS_SHARD_VNODES)
+    return _pooled(aioredis.BlockingConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        **options
+    ))
+
+
+async def close_redis(redis):
+    """Close a client from create_redis along with its connection pool"""
+    await redis.aclose()
+    pool = getattr(redis, "connection_pool", None)
+    if pool is not None:
+        await pool.disconnect()
@@ -0,0 +1,166 @@
+from typing import Optional, Dict, Any, Iterable, List, Tuple
+from collections import Counter
+from datetime import datetime, timezone
+from sqlalchemy import MetaData, Table, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from ..models.database import database, AuditLog, AuditRollup, AuditIPRollup
+
+GRANULARITIES = ("minute", "hour")
+GROUP_BY = ("action_taken", "country_code", "risk_bucket")
+
+
+def risk_bucket(score: Any) -> int:
+    """Lower bound of the 25-point band a risk score falls in: 0, 25, 50 or 75"""
+    try:
+        return min(max(int(score), 0) // 25 * 25, 75)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _utc(ts: Optional[datetime]) -> datetime:
+    """Naive UTC datetime, the form timestamps are stored in"""
+    if ts is None:
+        ts = datetime.now(timezone.utc)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _upsert(table, keys: Tuple[str, ...]):
+    query = sqlite_insert(table)
+    return query.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={"count": table.c.count + query.excluded.count}
+    )
+
+
+_ROLLUP_KEYS = ("granularity", "bucket_start", "action_taken", "country_code", "risk_bucket")
+_IP_ROLLUP_KEYS = ("bucket_start", "ip_address", "action_taken")
+
+
+class AuditReports:
+    """
+    Keeps per-minute and per-hour rollups of the audit log up to date as
+    batches are written, and answers dashboard queries from them. Raw rows
+    are read with keyset pagination, so every page costs the same.
+    """
+
+    def __init__(self):
+        self._rollup_upsert = _upsert(AuditRollup.__table__, _ROLLUP_KEYS)
+        self._ip_rollup_upsert = _upsert(AuditIPRollup.__table__, _IP_ROLLUP_KEYS)
+        self._archives: Dict[str, Table] = {}
+
+    def _archive(self, name: str) -> Table:
+        """An archive table of audit_logs rows, described with audit_logs' columns"""
+        table = self._archives.get(name)
+        if table is None:
+            table = self._archives[name] = AuditLog.__table__.to_metadata(MetaData(), name=name)
+        return table
+
+    async def record(self, batch: Iterable[Dict[str, Any]]):
+        """Add a batch of audit rows to the rollups; call inside the batch's transaction"""
+        rollups, ip_rollups = Counter(), Counter()
+        for row in batch:
+            ts = _utc(row.get("timestamp"))
+            minute = ts.replace(second=0, microsecond=0)
+            hour = minute.replace(minute=0)
+            action = row.get("action_taken") or "unknown"
+            country = row.get("country_code") or "Unknown"
+            bucket = risk_bucket(row.get("risk_score"))
+            rollups["minute", minute, action, country, bucket] += 1
+            rollups["hour", hour, action, country, bucket] += 1
+            ip_rollups[hour, row.get("ip_address"), action] += 1
+
+        if rollups:
+            await database.execute_many(
+                query=self._rollup_upsert,
+                values=[{**dict(zip(_ROLLUP_KEYS, key)), "count": count} for key, count in rollups.items()]
+            )
+        if ip_rollups:
+            await database.execute_many(
+                query=self._ip_rollup_upsert,
+                values=[{**dict(zip(_IP_ROLLUP_KEYS, key)), "count": count} for key, count in ip_rollups.items()]
+            )
+
+    async def logs(self, ip: Optional[str] = None, action: Optional[str] = None, country: Optional[str] = None,
+                   since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   cursor: Optional[int] = None, limit: int = 100, archives: Iterable[str] = ()) -> Dict[str, Any]:
+        """
+        Newest audit rows first; pass the returned next_cursor to get the following page.
+        The archive tables given, newest first, are read in turn once audit_logs runs out;
+        archived rows keep their ids, so the cursor carries across.
+        """
+        rows = []
+        for table in [AuditLog.__table__] + [self._archive(name) for name in archives]:
+            query = select(table).order_by(table.c.id.desc()).limit(limit + 1 - len(rows))
+            if cursor is not None:
+                query = query.where(table.c.id < cursor)
+            if ip:
+                query = query.where(table.c.ip_address == ip)
+            if action:
+                query = query.where(table.c.action_taken == action)
+            if country:
+                query = query.where(table.c.country_code == country)
+            if since:
+                query = query.where(table.c.timestamp >= _utc(since))
+            if until:
+                query = query.where(table.c.timestamp < _utc(until))
+            rows += await database.fetch_all(query)
+            if len(rows) > limit:
+                break
+        logs = [dict(row._mapping) for row in rows[:limit]]
+        next_cursor = logs[-1]["id"] if len(rows) > limit else None
+        return {"logs": logs, "next_cursor": next_cursor}
+
+    async def timeseries(self, granularity: str, group_by: str, since: datetime, until: Optional[datetime] = None,
+                         action: Optional[str] = None, country: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Counts per time bucket, split by one of GROUP_BY"""
+        table = AuditRollup.__table__
+        dimension = table.c[group_by]
+        query = (
+            select(table.c.bucket_start, dimension, func.sum(table.c.count).label("count"))
+            .where(table.c.granularity == granularity)
+            .where(table.c.bucket_start >= _utc(since))
+            .group_by(table.c.bucket_start, dimension)
+            .order_by(table.c.bucket_start, dimension)
+        )
+        if until:
+            query = query.where(table.c.bucket_start < _utc(until))
+        if action:
+            query = query.where(table.c.action_taken == action)
+        if country:
+            query = query.where(table.c.country_code == country)
+        return [dict(row._mapping) for row in await database.fetch_all(query)]
+
+    async def top_ips(self, since: datetime, until: Optional[datetime] = None, action: Optional[str] = None,
+                      limit: int = 10) -> List[Dict[str, Any]]:
+        """IPs with the most audit rows in an hour-aligned time range"""
+        table = AuditIPRollup.__table__
+        total = func.sum(table.c.count).label("count")
+        query = (
+            select(table.c.ip_address, total)
+            .where(table.c.bucket_start >= _utc(since).replace(minute=0, second=0, microsecond=0))
+            .group_by(table.c.ip_address)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        if until:
+            query = query.where(table.c.bucket_start < _utc(until))
+        if action:
+            query = query.where(table.c.action_taken == action)
+        return [dict(row._mapping) for row in await database.fetch_all(query)]
+
+    async def prune(self, minute_cutoff: datetime, hour_cutoff: datetime):
+        """Delete rollup buckets older than the cutoffs"""
+        rollups, ip_rollups = AuditRollup.__table__, AuditIPRollup.__table__
+        await database.execute(rollups.delete().where(
+            (rollups.c.granularity == "minute") & (rollups.c.bucket_start < _utc(minute_cutoff))
+        ))
+        await database.execute(rollups.delete().where(
+            (rollups.c.granularity == "hour") & (rollups.c.bucket_start < _utc(hour_cutoff))
+        ))
+        await database.execute(ip_rollups.delete().where(ip_rollups.c.bucket_start < _utc(hour_cutoff)))
+
+
+# Create singleton instance
+audit_reports = AuditReports()
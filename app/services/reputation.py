@@ -0,0 +1,225 @@
+from typing import Optional, Dict, Any, Iterable, List, Tuple
+import asyncio
+import ipaddress
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service
+
+# Published through the cache invalidation channel when the snapshot is replaced
+RELOAD_KEY = "reputation:version"
+
+FLAGS = ("proxy", "vpn", "tor", "datacenter")
+
+# File layout: header, then IPv4 records, then IPv6 records, each sorted by
+# start address and non-overlapping. Addresses are big-endian so IPv6
+# records compare correctly as bytes.
+_MAGIC = b"SSREP001"
+_HEADER = struct.Struct(">8sII")  # magic, IPv4 record count, IPv6 record count
+_V4_RECORD = struct.Struct(">IIBB2x")  # start, end, score, flags
+_V6_RECORD = struct.Struct(">16s16sBB2x")
+
+
+def _flag_bits(flags: Iterable[str]) -> int:
+    bits = 0
+    for flag in flags:
+        flag = flag.strip().lower()
+        if flag:
+            bits |= 1 << FLAGS.index(flag)
+    return bits
+
+
+def parse_feed_line(line: str) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Parse one feed line into (version, start, end, score, flags), or None for
+    blanks and comments. Accepts CSV rows of "network,score,flags" where network
+    is an address, a CIDR or "first-last", and flags are separated by "|", or an
+    exported IPQS result as a JSON object with "ip" (or "host") and "fraud_score".
+    Raises ValueError for anything else.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        data = json.loads(line)
+        network = data.get("ip") or data.get("host")
+        score = data.get("fraud_score", 0)
+        flags = [flag for flag in FLAGS if data.get(flag) or data.get(f"is_{flag}")]
+    else:
+        fields = [field.strip() for field in line.split(",")]
+        network = fields[0]
+        score = fields[1] if len(fields) > 1 and fields[1] else 0
+        flags = fields[2].split("|") if len(fields) > 2 else []
+
+    if not network:
+        raise ValueError(f"No address in feed line: {line}")
+    if "-" in network:
+        first, last = (ipaddress.ip_address(part.strip()) for part in network.split("-", 1))
+    else:
+        net = ipaddress.ip_network(network, strict=False)
+        first, last = net.network_address, net.broadcast_address
+    if first.version != last.version or first > last:
+        raise ValueError(f"Invalid range in feed line: {line}")
+    score = int(float(score))
+    if not 0 <= score <= 100:
+        raise ValueError(f"Score out of range in feed line: {line}")
+    return first.version, int(first), int(last), score, _flag_bits(flags)
+
+
+def _without_overlaps(ranges: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+    """Sort ranges by start; where ranges overlap, the one starting first keeps the overlap"""
+    result = []
+    for start, end, score, flags in sorted(ranges):
+        if result and start <= result[-1][1]:
+            start = result[-1][1] + 1
+            if start > end:
+                continue
+        result.append((start, end, score, flags))
+    return result
+
+
+def write_snapshot(path: str, lines: Iterable[str]) -> Dict[str, Any]:
+    """
+    Build a snapshot file from feed lines, replacing path atomically so
+    readers see either the old or the new file. Returns an import summary.
+    """
+    ranges = {4: [], 6: []}
+    invalid = []
+    for line in lines:
+        try:
+            parsed = parse_feed_line(line)
+        except (ValueError, TypeError):
+            invalid.append(line.strip())
+            continue
+        if parsed:
+            version, start, end, score, flags = parsed
+            ranges[version].append((start, end, score, flags))
+    v4, v6 = _without_overlaps(ranges[4]), _without_overlaps(ranges[6])
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".reputation-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(v4), len(v6)))
+            for start, end, score, flags in v4:
+                f.write(_V4_RECORD.pack(start, end, score, flags))
+            for start, end, score, flags in v6:
+                f.write(_V6_RECORD.pack(start.to_bytes(16, "big"), end.to_bytes(16, "big"), score, flags))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return {"ranges": len(v4) + len(v6), "invalid": invalid[:100], "invalid_count": len(invalid)}
+
+
+class ReputationSnapshot:
+    """
+    Read-only view of a snapshot file. The file is memory-mapped, so every
+    worker shares the same page-cache copy; lookups binary-search the
+    records in place without loading them.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.v4_count, self.v6_count = _HEADER.unpack_from(self._mm, 0)
+        expected = _HEADER.size + self.v4_count * _V4_RECORD.size + self.v6_count * _V6_RECORD.size
+        if magic != _MAGIC or len(self._mm) != expected:
+            self._mm.close()
+            raise ValueError(f"{path} is not a valid reputation snapshot")
+        self._v6_offset = _HEADER.size + self.v4_count * _V4_RECORD.size
+
+    def __len__(self) -> int:
+        return self.v4_count + self.v6_count
+
+    def close(self):
+        self._mm.close()
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        """Return {"fraud_score", flags...} for the range containing ip, or None"""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if address.version == 4:
+            record, offset, count, key = _V4_RECORD, _HEADER.size, self.v4_count, int(address)
+        else:
+            record, offset, count, key = _V6_RECORD, self._v6_offset, self.v6_count, address.packed
+
+        # Last record starting at or before the address
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record.unpack_from(self._mm, offset + mid * record.size)[0] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        start, end, score, flags = record.unpack_from(self._mm, offset + (lo - 1) * record.size)
+        if key > end:
+            return None
+        result = {"fraud_score": score}
+        for bit, flag in enumerate(FLAGS):
+            result[flag] = bool(flags & (1 << bit))
+        return result
+
+
+class ReputationStore:
+    """
+    Answers reputation lookups for known ranges from the local snapshot at
+    REPUTATION_SNAPSHOT_PATH. Imports write a new file and bump RELOAD_KEY
+    so every worker maps the new file and swaps it in.
+    """
+
+    def __init__(self):
+        self.snapshot: Optional[ReputationSnapshot] = None
+
+    async def start(self):
+        cache_service.on_invalidate(RELOAD_KEY, self.load)
+        await self.load()
+
+    async def load(self):
+        """Map the snapshot file, if there is one, and swap it in"""
+        if not settings.REPUTATION_SNAPSHOT_ENABLED:
+            return
+        try:
+            snapshot = ReputationSnapshot(settings.REPUTATION_SNAPSHOT_PATH)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Error loading reputation snapshot: {e}")
+            return
+        old, self.snapshot = self.snapshot, snapshot
+        if old is not None:
+            old.close()
+        MetricsCollector.set_reputation_ranges(len(snapshot))
+
+    def lookup(self, ip: str) -> Optional[Dict[str, Any]]:
+        """IPQS-shaped data for ip if a local range covers it; never touches the network"""
+        if self.snapshot is None:
+            return None
+        result = self.snapshot.lookup(ip)
+        MetricsCollector.record_reputation_lookup(result is not None)
+        return result
+
+    async def import_feed(self, lines: Iterable[str]) -> Dict[str, Any]:
+        """Replace the snapshot with the ranges in a feed and reload it in every worker"""
+        summary = await asyncio.to_thread(write_snapshot, settings.REPUTATION_SNAPSHOT_PATH, list(lines))
+        await self.load()
+        await cache_service.publish_invalidation(RELOAD_KEY)
+        return summary
+
+
+# Create singleton instance
+reputation_store = ReputationStore()
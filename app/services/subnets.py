@@ -0,0 +1,77 @@
+from typing import Optional, Dict, Any
+from collections import Counter
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service, subnet_key, subnet_of
+
+# Remember ip's latest risk level in its prefix's tally, unless the tally is full.
+# KEYS: the tally hash, the prefix verdict. ARGV: ip, risk level, window_ms, max_ips.
+# Returns whether a prefix verdict exists (0 or 1), then the risk level of every remembered IP.
+_TALLY_SCRIPT = """
+if redis.call("HEXISTS", KEYS[1], ARGV[1]) == 1 or redis.call("HLEN", KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+local result = redis.call("HVALS", KEYS[1])
+table.insert(result, 1, redis.call("EXISTS", KEYS[2]))
+return result
+"""
+
+
+def promoted_level(levels: Counter) -> Optional[str]:
+    """The risk level the first SUBNET_PROMOTION_RULES rule met gives a prefix, or None"""
+    seen = sum(levels.values())
+    for rule in settings.SUBNET_PROMOTION_RULES:
+        count = levels[rule["risk_level"]]
+        if count >= rule["min_ips"] and count >= rule.get("min_share", 0) * seen:
+            return rule["risk_level"]
+    return None
+
+
+class SubnetVerdicts:
+    """
+    The aggregated verdict tier: every IPQS verdict is tallied against its
+    /24 (IPv4) or /64 (IPv6), and once the prefix meets a promotion rule
+    the verdict is cached for the whole prefix under subnet:{network}.
+    CacheService.get_decision returns it for IPs of the prefix without a
+    verdict of their own, so rotating clients stop costing IPQS lookups.
+    """
+
+    async def record(self, verdict: Dict[str, Any]):
+        """Tally a verdict just looked up, promoting or demoting its prefix"""
+        if not settings.SUBNET_VERDICTS_ENABLED or verdict.get("degraded"):
+            return
+        try:
+            network = subnet_of(verdict["ip_address"])
+        except ValueError:
+            return
+        key = subnet_key(network)
+        reply = await cache_service.eval_script(
+            _TALLY_SCRIPT,
+            [f"{key}:ips", key],
+            [verdict["ip_address"], verdict["risk_level"], settings.SUBNET_TALLY_WINDOW * 1000,
+             settings.SUBNET_TALLY_MAX_IPS]
+        )
+        if not reply:
+            return
+        held, levels = reply[0], Counter(reply[1:])
+        level = promoted_level(levels)
+        if level == verdict["risk_level"]:
+            # This IP's verdict stands for the prefix; it keeps its own address for audit
+            aggregated = {name: value for name, value in verdict.items() if name != "expires_at"}
+            aggregated["subnet"] = network
+            await cache_service.set(key, aggregated, expire=settings.SUBNET_VERDICT_TTL)
+            MetricsCollector.record_subnet_verdict("promoted")
+        elif level is None and held:
+            await cache_service.delete(key)
+            MetricsCollector.record_subnet_verdict("demoted")
+
+    @staticmethod
+    def for_ip(ip_address: str, aggregated: Dict[str, Any]) -> Dict[str, Any]:
+        """A prefix verdict as served to one of its IPs"""
+        MetricsCollector.record_subnet_verdict("hit")
+        return dict(aggregated, ip_address=ip_address)
+
+
+# Create singleton instance
+subnet_verdicts = SubnetVerdicts()
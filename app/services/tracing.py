@@ -0,0 +1,189 @@
+from typing import Optional, Dict, Any, List, Tuple
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+import httpx
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+
+# Trace of the request being handled, if it was sampled
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("sentinel_trace", default=None)
+
+_SPAN_KIND_INTERNAL = 1
+_SPAN_KIND_SERVER = 2
+_STATUS_ERROR = 2
+
+
+class Trace:
+    """Spans recorded for one sampled request, timed against one clock reading"""
+
+    __slots__ = ("trace_id", "span_id", "start_ns", "start", "spans", "closed")
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, float, bool]] = []
+        self.closed = False
+
+    def unix_ns(self, perf: float) -> int:
+        return self.start_ns + int((perf - self.start) * 1e9)
+
+
+class Stage:
+    """Times one step of request handling: `with tracer.stage("cache_redis"):`"""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if settings.STAGE_METRICS_ENABLED:
+            MetricsCollector.record_stage(self.name, end - self.start)
+        trace = _current_trace.get()
+        if trace is not None and not trace.closed:
+            trace.spans.append((self.name, self.start, end, exc_type is not None))
+        return False
+
+
+def _attributes(values: Dict[str, Any]) -> List[Dict[str, Any]]:
+    attributes = []
+    for key, value in values.items():
+        if isinstance(value, bool):
+            attributes.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            attributes.append({"key": key, "value": {"intValue": str(value)}})
+        else:
+            attributes.append({"key": key, "value": {"stringValue": str(value)}})
+    return attributes
+
+
+class Tracer:
+    """
+    Per-stage timing for the request path. Every stage feeds the
+    sentinel_stage_duration_seconds histogram; when TRACING_ENABLED, a
+    TRACING_SAMPLE_RATE share of requests is also recorded as spans and
+    exported in OTLP/JSON, to TRACING_FILE (one export request per line)
+    or to an OpenTelemetry collector at TRACING_OTLP_ENDPOINT.
+    """
+
+    def __init__(self):
+        self._finished: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def stage(self, name: str) -> Stage:
+        return Stage(name)
+
+    def start_request(self) -> Optional[contextvars.Token]:
+        """Sample the current request; returns a token for finish_request if it is traced"""
+        if not settings.TRACING_ENABLED or random.random() >= settings.TRACING_SAMPLE_RATE:
+            return None
+        return _current_trace.set(Trace())
+
+    def finish_request(self, token: contextvars.Token, name: str, attributes: Dict[str, Any]):
+        """Close the current request's trace and queue it for export"""
+        trace = _current_trace.get()
+        _current_trace.reset(token)
+        if trace is None:
+            return
+        trace.closed = True
+        if len(self._finished) >= settings.TRACING_MAX_QUEUE:
+            MetricsCollector.record_trace("dropped")
+            return
+        self._finished.append((trace, name, time.perf_counter(), attributes))
+
+    def start(self):
+        if settings.TRACING_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task], timeout=2)
+            self._task = None
+            await self.export()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.TRACING_EXPORT_INTERVAL)
+            try:
+                await self.export()
+            except Exception as e:
+                logging.error(f"Error exporting traces: {e}")
+
+    def _spans(self, trace: Trace, name: str, end: float, attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        spans = [{
+            "traceId": trace.trace_id,
+            "spanId": trace.span_id,
+            "name": name,
+            "kind": _SPAN_KIND_SERVER,
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(trace.unix_ns(end)),
+            "attributes": _attributes(attributes),
+        }]
+        for stage, start, stage_end, failed in trace.spans:
+            span = {
+                "traceId": trace.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": trace.span_id,
+                "name": stage,
+                "kind": _SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(trace.unix_ns(start)),
+                "endTimeUnixNano": str(trace.unix_ns(stage_end)),
+            }
+            if failed:
+                span["status"] = {"code": _STATUS_ERROR}
+            spans.append(span)
+        return spans
+
+    async def export(self) -> int:
+        """Send every finished trace as one OTLP/JSON export request"""
+        if not self._finished:
+            return 0
+        finished = [self._finished.popleft() for _ in range(len(self._finished))]
+        spans = [span for trace, name, end, attributes in finished for span in self._spans(trace, name, end, attributes)]
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": _attributes({"service.name": settings.APP_NAME})},
+            "scopeSpans": [{"scope": {"name": "sentinelshield"}, "spans": spans}],
+        }]}
+        try:
+            if settings.TRACING_EXPORT == "otlp":
+                if self._client is None:
+                    self._client = httpx.AsyncClient(timeout=settings.TRACING_EXPORT_TIMEOUT)
+                response = await self._client.post(settings.TRACING_OTLP_ENDPOINT, json=payload)
+                response.raise_for_status()
+            else:
+                await asyncio.to_thread(self._append, json.dumps(payload))
+        except (httpx.HTTPError, OSError) as e:
+            logging.error(f"Error exporting {len(finished)} traces: {e}")
+            MetricsCollector.record_trace("failed", len(finished))
+            return 0
+        MetricsCollector.record_trace("exported", len(finished))
+        return len(finished)
+
+    @staticmethod
+    def _append(line: str):
+        directory = os.path.dirname(os.path.abspath(settings.TRACING_FILE))
+        os.makedirs(directory, exist_ok=True)
+        with open(settings.TRACING_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+# Create singleton instance
+tracer = Tracer()
@@ -0,0 +1,333 @@
+from typing import Optional, Dict, Any, List, Tuple
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
+import sys
+import time
+import zlib
+from array import array
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service, subnet_of
+
+_MASK64 = (1 << 64) - 1
+
+# Closed buckets kept for a later flush while Redis is unreachable
+MAX_UNFLUSHED = 6
+
+
+def _hash(key: str) -> Tuple[int, int]:
+    """Two 64-bit hashes of key, the same in every worker"""
+    value = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+    return value & _MASK64, value >> 64
+
+
+def _pack(values: array) -> str:
+    return base64.b64encode(zlib.compress(values.tobytes(), 1)).decode()
+
+
+def _unpack(typecode: str, data: str, length: int) -> array:
+    values = array(typecode, zlib.decompress(base64.b64decode(data)))
+    if len(values) != length:
+        raise ValueError(f"expected {length} values, got {len(values)}")
+    return values
+
+
+class CountMinSketch:
+    """
+    Approximate counts per key in depth rows of width counters. Estimates
+    never undercount, and overcount by at most e/width of all counts with
+    probability 1 - e^-depth. Sketches of one shape add up exactly.
+    """
+
+    __slots__ = ("width", "depth", "counts", "_offsets")
+
+    def __init__(self, width: int, depth: int, counts: Optional[array] = None):
+        self.width = width
+        self.depth = depth
+        self.counts = counts if counts is not None else array("Q", bytes(8 * width * depth))
+        self._offsets = tuple(row * width for row in range(depth))
+
+    def add(self, h1: int, h2: int) -> int:
+        """Count one occurrence of the key with hashes h1, h2; returns its new estimate"""
+        counts, width = self.counts, self.width
+        estimate = _MASK64
+        # Row i uses h1 + i * h2 (double hashing)
+        for offset in self._offsets:
+            cell = offset + h1 % width
+            value = counts[cell] + 1
+            counts[cell] = value
+            if value < estimate:
+                estimate = value
+            h1 += h2
+        return estimate
+
+    def estimate(self, h1: int, h2: int) -> int:
+        counts, width = self.counts, self.width
+        return min(counts[offset + (h1 + row * h2) % width] for row, offset in enumerate(self._offsets))
+
+    def merge(self, other: "CountMinSketch"):
+        # Counters are added as one big integer; no counter comes near 2^64, so none carries into the next
+        total = int.from_bytes(self.counts, sys.byteorder) + int.from_bytes(other.counts, sys.byteorder)
+        self.counts = array("Q", total.to_bytes(8 * len(self.counts), sys.byteorder))
+
+
+class HyperLogLog:
+    """Distinct-key estimate from 2^precision one-byte registers; merging keeps each register's maximum"""
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int, registers: Optional[array] = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else array("B", bytes(1 << precision))
+
+    def add(self, h: int):
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = array("B", map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        registers = self.registers
+        m = len(registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in registers)
+        zeros = registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+class KeySketch:
+    """Counts, heavy-hitter candidates and distinct count for one kind of key (client IPs or subnets)"""
+
+    __slots__ = ("cms", "hll", "candidates", "capacity", "_floor")
+
+    def __init__(self, cms: CountMinSketch, hll: HyperLogLog, candidates: Dict[str, int], capacity: int):
+        self.cms = cms
+        self.hll = hll
+        self.candidates = candidates
+        self.capacity = capacity
+        # A lower bound on the smallest candidate estimate, so most keys are turned away without a scan
+        self._floor = 0
+
+    @classmethod
+    def empty(cls) -> "KeySketch":
+        return cls(
+            CountMinSketch(settings.TRAFFIC_CMS_WIDTH, settings.TRAFFIC_CMS_DEPTH),
+            HyperLogLog(settings.TRAFFIC_HLL_PRECISION),
+            {},
+            4 * settings.TRAFFIC_TOP_K
+        )
+
+    def add(self, key: str):
+        h1, h2 = _hash(key)
+        self.hll.add(h1)
+        estimate = self.cms.add(h1, h2)
+        candidates = self.candidates
+        if key in candidates or len(candidates) < self.capacity:
+            candidates[key] = estimate
+            return
+        if estimate <= self._floor:
+            return
+        smallest = min(candidates, key=candidates.get)
+        if estimate > candidates[smallest]:
+            del candidates[smallest]
+            candidates[key] = estimate
+        self._floor = min(candidates.values())
+
+    def merge(self, other: "KeySketch"):
+        """Add other's counts; candidates are pooled and re-ranked by top()"""
+        self.cms.merge(other.cms)
+        self.hll.merge(other.hll)
+        for key in other.candidates:
+            self.candidates.setdefault(key, 0)
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        """The k candidates with the highest estimated counts"""
+        ranked = [(key, self.cms.estimate(*_hash(key))) for key in self.candidates]
+        ranked.sort(key=lambda item: item[1], reverse=True)
+        return ranked[:k]
+
+    def dumps(self) -> Dict[str, Any]:
+        return {"cms": _pack(self.cms.counts), "hll": _pack(self.hll.registers), "top": self.candidates}
+
+    @classmethod
+    def loads(cls, data: Dict[str, Any]) -> "KeySketch":
+        """Raises ValueError if the sketch was made with other TRAFFIC_* dimensions"""
+        sketch = cls.empty()
+        sketch.cms.counts = _unpack("Q", data["cms"], len(sketch.cms.counts))
+        sketch.hll.registers = _unpack("B", data["hll"], len(sketch.hll.registers))
+        sketch.candidates = {key: int(count) for key, count in data["top"].items()}
+        return sketch
+
+
+class TrafficSketch:
+    """The traffic of one time bucket: a request count plus a KeySketch for client IPs and one for subnets"""
+
+    __slots__ = ("requests", "ips", "subnets")
+
+    def __init__(self, requests: int = 0, ips: Optional[KeySketch] = None, subnets: Optional[KeySketch] = None):
+        self.requests = requests
+        self.ips = ips or KeySketch.empty()
+        self.subnets = subnets or KeySketch.empty()
+
+    def add(self, ip: str):
+        self.requests += 1
+        self.ips.add(ip)
+        try:
+            self.subnets.add(subnet_of(ip))
+        except ValueError:
+            pass
+
+    def merge(self, other: "TrafficSketch"):
+        self.requests += other.requests
+        self.ips.merge(other.ips)
+        self.subnets.merge(other.subnets)
+
+    def dumps(self) -> str:
+        return json.dumps({"requests": self.requests, "ips": self.ips.dumps(), "subnets": self.subnets.dumps()})
+
+    @classmethod
+    def loads(cls, data: str) -> "TrafficSketch":
+        value = json.loads(data)
+        return cls(int(value["requests"]), KeySketch.loads(value["ips"]), KeySketch.loads(value["subnets"]))
+
+
+class TrafficAnalytics:
+    """
+    Top talkers and distinct client counts over sliding windows, at a fixed
+    cost per request and fixed memory. Each worker counts the current
+    TRAFFIC_BUCKET_SECONDS bucket into a TrafficSketch and writes it to the
+    Redis hash traffic:<bucket>, one field per worker. A window is answered
+    by merging every worker's sketches for the buckets it covers.
+    """
+
+    KEY_PREFIX = "traffic:"
+    LOCK_KEY = "lock:traffic-gauges"
+
+    def __init__(self):
+        self._bucket: Optional[int] = None
+        self._current: Optional[TrafficSketch] = None
+        self._flushed_requests = 0
+        self._unflushed: List[Tuple[int, TrafficSketch]] = []
+        # Buckets old enough that every worker has written its final sketch, merged once
+        self._settled: Dict[int, TrafficSketch] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, ip: str):
+        """Count one request from ip; never waits"""
+        if not settings.TRAFFIC_ANALYTICS_ENABLED:
+            return
+        bucket = int(time.time()) // settings.TRAFFIC_BUCKET_SECONDS
+        if bucket != self._bucket:
+            if self._current is not None and self._current.requests != self._flushed_requests:
+                self._unflushed.append((self._bucket, self._current))
+                del self._unflushed[:-MAX_UNFLUSHED]
+            self._bucket = bucket
+            self._current = TrafficSketch()
+            self._flushed_requests = 0
+        self._current.add(ip)
+
+    def start(self):
+        if settings.TRAFFIC_ANALYTICS_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task], timeout=5)
+            self._task = None
+            await self.flush()
+
+    async def _run(self):
+        next_gauges = 0.0
+        while True:
+            await asyncio.sleep(settings.TRAFFIC_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                if time.monotonic() >= next_gauges:
+                    next_gauges = time.monotonic() + settings.TRAFFIC_GAUGE_INTERVAL
+                    await self.update_gauges()
+            except Exception as e:
+                logging.error(f"Error updating traffic analytics: {e}")
+
+    async def flush(self):
+        """Write this worker's closed buckets and its current one to Redis"""
+        pending, self._unflushed = self._unflushed, []
+        current = self._current
+        if current is not None and current.requests != self._flushed_requests:
+            pending.append((self._bucket, current))
+            self._flushed_requests = current.requests
+        ttl = max(settings.TRAFFIC_WINDOWS) + 3 * settings.TRAFFIC_BUCKET_SECONDS
+        failed = []
+        for bucket, sketch in pending:
+            # After one failed write the rest are kept for the next flush without trying
+            if failed or not await cache_service.set_field(
+                f"{self.KEY_PREFIX}{bucket}", cache_service.instance_id, sketch.dumps(), ttl
+            ):
+                failed.append((bucket, sketch))
+        if failed:
+            if any(sketch is self._current for _, sketch in failed):
+                self._flushed_requests = -1
+            closed = [(bucket, sketch) for bucket, sketch in failed if sketch is not self._current]
+            self._unflushed = (closed + self._unflushed)[-MAX_UNFLUSHED:]
+
+    async def update_gauges(self):
+        """Refresh the traffic gauges; one worker per TRAFFIC_GAUGE_INTERVAL does the merging"""
+        # The lease is left to expire rather than released, so other workers skip this interval
+        token = await cache_service.acquire_lock(self.LOCK_KEY, int(settings.TRAFFIC_GAUGE_INTERVAL * 1000))
+        if token is None:
+            return
+        for window in settings.TRAFFIC_WINDOWS:
+            MetricsCollector.set_traffic_summary(await self.summary(window), settings.TRAFFIC_TOP_K)
+
+    async def summary(self, window: int) -> Dict[str, Any]:
+        """Requests, distinct IPs and subnets, and the top IPs and subnets over the last window seconds, from all workers"""
+        await self.flush()
+        size = settings.TRAFFIC_BUCKET_SECONDS
+        now = time.time()
+        last = int(now) // size
+        buckets = range(last - max(1, math.ceil(window / size)) + 1, last + 1)
+        fetch = [bucket for bucket in buckets if bucket not in self._settled]
+        stored = await cache_service.get_fields([f"{self.KEY_PREFIX}{bucket}" for bucket in fetch])
+
+        total = TrafficSketch()
+        for bucket, fields in zip(fetch, stored or []):
+            merged = TrafficSketch()
+            for worker, data in fields.items():
+                try:
+                    merged.merge(TrafficSketch.loads(data))
+                except (ValueError, KeyError, TypeError, zlib.error) as e:
+                    logging.error(f"Skipping traffic sketch {bucket} from {worker}: {e}")
+            if (bucket + 1) * size <= now - 2 * settings.TRAFFIC_FLUSH_INTERVAL:
+                self._settled[bucket] = merged
+            total.merge(merged)
+        for bucket in buckets:
+            if bucket in self._settled and bucket not in fetch:
+                total.merge(self._settled[bucket])
+
+        oldest = last - math.ceil(max(settings.TRAFFIC_WINDOWS) / size)
+        for bucket in [bucket for bucket in self._settled if bucket < oldest]:
+            del self._settled[bucket]
+
+        k = settings.TRAFFIC_TOP_K
+        return {
+            "window": window,
+            "requests": total.requests,
+            "distinct_ips": total.ips.hll.estimate(),
+            "distinct_subnets": total.subnets.hll.estimate(),
+            "top_ips": [{"ip": ip, "requests": count} for ip, count in total.ips.top(k)],
+            "top_subnets": [{"subnet": subnet, "requests": count} for subnet, count in total.subnets.top(k)],
+        }
+
+
+# Create singleton instance
+traffic_analytics = TrafficAnalytics()
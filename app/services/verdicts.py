@@ -0,0 +1,263 @@
+from typing import Optional, Dict, Any, Set
+import asyncio
+import logging
+import random
+import time
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from .cache import cache_service, verdict_key
+from .ipqs import ipqs_service, SingleFlight
+from .policy import risk_policy
+from .reputation import reputation_store
+from .subnets import subnet_verdicts
+from .tracing import tracer
+
+
+def is_failed_lookup(data: Optional[Dict[str, Any]]) -> bool:
+    """True for IPQS responses that must not be treated as a real verdict"""
+    return not data or "error" in data or data.get("success") is False
+
+
+def is_stale(verdict: Dict[str, Any]) -> bool:
+    """True once a cached verdict is past its fresh TTL and should be refreshed"""
+    return verdict.get("expires_at", float("inf")) <= time.time()
+
+
+def verdict_ttl(verdict: Dict[str, Any]) -> int:
+    """Fresh TTL for a verdict from its flags or risk level, with jitter"""
+    ttl = None
+    for flag, flag_ttl in settings.CACHE_TTL_BY_FLAG.items():
+        if verdict.get(f"is_{flag}"):
+            ttl = flag_ttl
+            break
+    if ttl is None:
+        ttl = settings.CACHE_TTL_BY_RISK_LEVEL.get(verdict.get("risk_level"), settings.CACHE_TTL)
+    jitter = settings.CACHE_TTL_JITTER
+    return max(1, int(ttl * random.uniform(1 - jitter, 1 + jitter)))
+
+
+def _log_background_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background reputation lookup failed: {task.exception()}")
+
+
+class VerdictService:
+    """
+    Builds per-IP verdicts from IPQS data and keeps them cached. Verdicts
+    outlive their TTL by CACHE_STALE_TTL so the last known answer can be
+    served immediately while a background task refreshes it.
+    """
+
+    def __init__(self):
+        self._refreshing: Set[str] = set()
+        self._device_lookups = SingleFlight("device_cache")
+
+    def build(self, ip_address: str, ip_data: Dict[str, Any], device_data: Optional[Dict[str, Any]],
+              device_fingerprint: Optional[str], request_path: str, user_agent: str) -> Dict[str, Any]:
+        risk_score = ip_data.get("fraud_score", 0)
+        if not isinstance(risk_score, (int, float)):
+            logging.error(f"Invalid risk_score type received: {type(risk_score)}. Setting to 100.")
+            risk_score = 100
+        return {
+            "ip_address": ip_address,
+            "device_fingerprint": device_fingerprint,
+            "risk_score": risk_score,
+            "is_proxy": ip_data.get("proxy", False),
+            "is_vpn": ip_data.get("vpn", False),
+            "is_tor": ip_data.get("tor", False),
+            "country_code": ip_data.get("country_code", "Unknown"),
+            "city": ip_data.get("city", None),
+            "risk_level": ipqs_service.calculate_risk_level(ip_data, device_data),
+            "policy_version": risk_policy.policy.version,
+            "request_path": request_path,
+            "user_agent": user_agent
+        }
+
+    def fallback(self, ip_address: str, device_fingerprint: Optional[str],
+                 request_path: str, user_agent: str) -> Dict[str, Any]:
+        """Verdict used when IPQS is unavailable and nothing is cached; never cached itself"""
+        fail_closed = settings.IPQS_FAILURE_POLICY == "closed"
+        return {
+            "ip_address": ip_address,
+            "device_fingerprint": device_fingerprint,
+            "risk_score": 100 if fail_closed else 0,
+            "is_proxy": False,
+            "is_vpn": False,
+            "is_tor": False,
+            "country_code": "Unknown",
+            "city": None,
+            "risk_level": "high" if fail_closed else "low",
+            "request_path": request_path,
+            "user_agent": user_agent,
+            "degraded": True
+        }
+
+    async def store(self, verdict: Dict[str, Any]):
+        """Cache a verdict, keeping it past its fresh TTL for stale serving"""
+        ttl = verdict_ttl(verdict)
+        verdict["expires_at"] = time.time() + ttl
+        await cache_service.set(verdict_key(verdict["ip_address"]), verdict, expire=ttl + settings.CACHE_STALE_TTL)
+
+    async def _fetch_verdict(self, ip_address: str, user_agent: str, request_path: str) -> Optional[Dict[str, Any]]:
+        """Look the IP up and cache its verdict; returns None if IPQS failed"""
+        with tracer.stage("ipqs_ip"):
+            ip_data = await ipqs_service.check_ip(ip_address, user_agent)
+        if is_failed_lookup(ip_data):
+            return None
+        verdict = self.build(ip_address, ip_data, None, None, request_path, user_agent)
+        await self.store(verdict)
+        await subnet_verdicts.record(verdict)
+        return verdict
+
+    async def device_data(self, device_fingerprint: str) -> Optional[Dict[str, Any]]:
+        """IPQS data for a device fingerprint from the device:<fingerprint> cache, looked up once on a miss"""
+        return await self._device_lookups.do(device_fingerprint, lambda: self._load_device(device_fingerprint))
+
+    async def _load_device(self, device_fingerprint: str) -> Optional[Dict[str, Any]]:
+        key = f"device:{device_fingerprint}"
+        cached = await cache_service.get(key)
+        if cached is not None:
+            return cached
+        with tracer.stage("ipqs_device"):
+            device_data = await ipqs_service.check_device(device_fingerprint)
+        if is_failed_lookup(device_data):
+            return None
+        await cache_service.set(key, device_data, expire=settings.DEVICE_CACHE_TTL)
+        return device_data
+
+    def merge_device(self, verdict: Dict[str, Any], device_data: Optional[Dict[str, Any]],
+                     device_fingerprint: str) -> Dict[str, Any]:
+        """A request's verdict: the cached IP verdict with its device's score folded into the risk level"""
+        merged = dict(verdict)
+        merged["device_fingerprint"] = device_fingerprint
+        if device_data:
+            ip_data = {
+                "fraud_score": verdict["risk_score"],
+                "proxy": verdict.get("is_proxy"),
+                "vpn": verdict.get("is_vpn"),
+                "tor": verdict.get("is_tor"),
+                "country_code": verdict.get("country_code"),
+            }
+            merged["risk_level"] = ipqs_service.calculate_risk_level(ip_data, device_data)
+            if merged["risk_level"] != verdict["risk_level"]:
+                # No longer the IP's own verdict; audit rows record it as device-derived
+                merged["device_adjusted"] = True
+        return merged
+
+    @staticmethod
+    def _finished(task: asyncio.Task) -> Optional[Dict[str, Any]]:
+        """A lookup's result if it beat the deadline; otherwise it is left to finish and cache in the background"""
+        if task.done():
+            return task.result()
+        task.add_done_callback(_log_background_failure)
+        return None
+
+    async def with_device(self, verdict: Dict[str, Any], device_fingerprint: str) -> Dict[str, Any]:
+        """merge_device() for an IP verdict already in hand, waiting up to IPQS_LOOKUP_DEADLINE for the device"""
+        device_data = cache_service.local_get(f"device:{device_fingerprint}")
+        if device_data is None:
+            task = asyncio.ensure_future(self.device_data(device_fingerprint))
+            await asyncio.wait([task], timeout=settings.IPQS_LOOKUP_DEADLINE)
+            device_data = self._finished(task)
+        return self.merge_device(verdict, device_data, device_fingerprint)
+
+    async def lookup(self, ip_address: str, user_agent: str, device_fingerprint: Optional[str] = None,
+                     request_path: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Fetch reputation data and cache the verdict; returns None if IPQS
+        failed. The IP and device lookups run concurrently under one
+        IPQS_LOOKUP_DEADLINE, so a request pays the slower of the two.
+        """
+        if not device_fingerprint:
+            return await self._fetch_verdict(ip_address, user_agent, request_path)
+
+        ip_task = asyncio.ensure_future(self._fetch_verdict(ip_address, user_agent, request_path))
+        device_task = asyncio.ensure_future(self.device_data(device_fingerprint))
+        await asyncio.wait([ip_task, device_task], timeout=settings.IPQS_LOOKUP_DEADLINE)
+        verdict = self._finished(ip_task)
+        device_data = self._finished(device_task)
+        if verdict is None:
+            return None
+        return self.merge_device(verdict, device_data, device_fingerprint)
+
+    def resolve_cached(self, ip_address: str, cached: Optional[Dict[str, Any]], user_agent: str,
+                       device_fingerprint: Optional[str] = None, request_path: str = "",
+                       refresh: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        The verdict from the local snapshot or the cache, without awaiting; None if IPQS must be asked.
+        A stale verdict is refreshed in the background unless refresh is False.
+        """
+        local_data = reputation_store.lookup(ip_address)
+        if local_data is not None:
+            # Not cached: the snapshot answers without the network and follows reloads
+            verdict = self.build(ip_address, local_data, None, device_fingerprint, request_path, user_agent)
+            verdict["source"] = "local"
+            return verdict
+
+        if cached and "subnet" in cached:
+            if cached.get("policy_version", 0) != risk_policy.policy.version:
+                # Promoted under an earlier policy: look this IP up, which tallies the prefix again
+                return None
+            MetricsCollector.record_cache_hit()
+            return subnet_verdicts.for_ip(ip_address, cached)
+
+        if cached:
+            MetricsCollector.record_cache_hit()
+            if "expires_at" in cached:
+                cache_service.hot_keys.record(verdict_key(ip_address), cached["expires_at"])
+            if is_stale(cached):
+                MetricsCollector.record_stale_served()
+                if refresh:
+                    self.refresh_in_background(ip_address, cached.get("user_agent") or user_agent,
+                                               cached.get("request_path", ""))
+            policy = risk_policy.policy
+            # Verdicts without a version predate policies and were decided by the thresholds (version 0)
+            if cached.get("policy_version", 0) != policy.version:
+                # The cached copy is shared, so apply the policy in force to a copy
+                cached = dict(cached, risk_level=policy.level_for(cached), policy_version=policy.version)
+            return cached
+        return None
+
+    async def resolve(self, ip_address: str, cached: Optional[Dict[str, Any]], user_agent: str,
+                      device_fingerprint: Optional[str] = None, request_path: str = "") -> Dict[str, Any]:
+        """Return the verdict to act on now: local snapshot, cached (refreshing if stale), looked up, or the fallback"""
+        verdict = self.resolve_cached(ip_address, cached, user_agent, device_fingerprint, request_path)
+        if verdict is not None:
+            return verdict
+        return await self.resolve_miss(ip_address, user_agent, device_fingerprint, request_path)
+
+    async def resolve_miss(self, ip_address: str, user_agent: str, device_fingerprint: Optional[str] = None,
+                           request_path: str = "") -> Dict[str, Any]:
+        """resolve() once resolve_cached() has come up empty: look the IP up, or fall back"""
+        MetricsCollector.record_cache_miss()
+        MetricsCollector.increment_total_requests()
+        MetricsCollector.increment_requests_by_status("200")
+        MetricsCollector.set_average_latency(0)
+        verdict = await self.lookup(ip_address, user_agent, device_fingerprint, request_path)
+        if verdict is None:
+            return self.fallback(ip_address, device_fingerprint, request_path, user_agent)
+        return verdict
+
+    def refresh_in_background(self, ip_address: str, user_agent: str, request_path: str = ""):
+        """Start one background refresh per IP; the stale verdict stays cached if it fails"""
+        if ip_address in self._refreshing:
+            return
+        self._refreshing.add(ip_address)
+        task = asyncio.create_task(self._fetch_verdict(ip_address, user_agent, request_path))
+        task.add_done_callback(lambda t: self._refresh_done(ip_address, t))
+
+    async def refresh_key(self, key: str):
+        """Refresh-ahead hook: re-fetch the verdict cached under an ip:<address> key"""
+        cached = await cache_service.get(key)
+        if cached:
+            self.refresh_in_background(cached["ip_address"], cached.get("user_agent") or "Unknown",
+                                       cached.get("request_path", ""))
+
+    def _refresh_done(self, ip_address: str, task: asyncio.Task):
+        self._refreshing.discard(ip_address)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Background refresh of {ip_address} failed: {task.exception()}")
+
+
+# Create singleton instance
+verdict_service = VerdictService()
@@ -0,0 +1,181 @@
+from typing import Optional, Dict, Any, Deque, List, Tuple
+from collections import deque
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, func, select
+from ..config.settings import settings
+from ..config.monitoring import MetricsCollector
+from ..models.database import database, AuditLog, WhitelistedIP
+from .cache import cache_service, canonical_ip, verdict_key, whitelist_key
+from .verdicts import verdict_service, verdict_ttl
+
+# Held in Redis once it has been warmed; finding it gone means Redis lost its data
+WARMED_KEY = "warm-start:warmed"
+
+
+def _epoch(ts: datetime) -> float:
+    """Seconds since the epoch for a stored timestamp, which comes back naive in UTC"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+def verdict_from_audit(row: Any) -> Dict[str, Any]:
+    """The IP verdict an audit row was logged from, under the policy in force"""
+    ip_data = {
+        "fraud_score": row["risk_score"],
+        "proxy": bool(row["is_proxy"]),
+        "vpn": bool(row["is_vpn"]),
+        "tor": bool(row["is_tor"]),
+        "country_code": row["country_code"],
+        "city": row["city"],
+    }
+    return verdict_service.build(canonical_ip(row["ip_address"]), ip_data, None, None,
+                                 row["request_path"] or "", row["user_agent"] or "Unknown")
+
+
+class CacheWarmer:
+    """
+    Refills Redis from the database when it comes back empty after a flush
+    or failover: active whitelist entries from whitelisted_ips, and the
+    latest verdict of each IP seen in audit_logs. Verdicts past their TTL
+    are revalidated with IPQS at WARM_START_REVALIDATE_RATE, so a cold
+    cache does not send every recent IP to IPQS at once. The whitelist is
+    re-synced and expired rows purged every WHITELIST_RECONCILE_INTERVAL,
+    by one worker at a time under a Redis lease.
+    """
+
+    LOCK_KEY = "lock:warm-start"
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._revalidate_task: Optional[asyncio.Task] = None
+        self._pending: Deque[Dict[str, Any]] = deque()
+
+    async def start(self):
+        """Warm the cache before serving if this worker holds the lease, then keep reconciling"""
+        if not settings.WARM_START_ENABLED or self._task is not None:
+            return
+        # Also run when the invalidation listener reconnects, which is how a failover shows up
+        cache_service.on_invalidate(WARMED_KEY, self.run_leased)
+        await self.run_leased()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [task for task in (self._task, self._revalidate_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+        self._task = self._revalidate_task = None
+        self._pending.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.WHITELIST_RECONCILE_INTERVAL)
+            await self.run_leased()
+
+    async def run_leased(self):
+        """reconcile() unless another worker holds the lease"""
+        # Not released: the lease lapses after an interval, so one worker runs per interval
+        token = await cache_service.acquire_lock(self.LOCK_KEY, int(settings.WHITELIST_RECONCILE_INTERVAL * 1000))
+        if token is None:
+            return
+        try:
+            await self.reconcile()
+        except Exception as e:
+            logging.error(f"Error reconciling the cache with the database: {e}")
+
+    async def reconcile(self) -> Dict[str, int]:
+        """Re-sync the whitelist, warm verdicts if Redis lost them and purge expired whitelist rows; returns counts"""
+        now = datetime.now(timezone.utc)
+        counts = {"whitelist": await self.warm_whitelist(now), "verdicts": 0}
+        if await cache_service.get(WARMED_KEY, use_local=False) is None:
+            counts["verdicts"] = await self.warm_verdicts(now)
+            await cache_service.fill([(WARMED_KEY, True, settings.CACHE_STALE_TTL)])
+        counts["purged"] = await self.purge_whitelist(now)
+        return counts
+
+    async def warm_whitelist(self, now: datetime) -> int:
+        """Write active whitelist rows missing from Redis with their remaining TTL; returns how many"""
+        rows = await database.fetch_all(
+            select(WhitelistedIP.ip_address, WhitelistedIP.expires_at).where(WhitelistedIP.expires_at > now)
+        )
+        clock = now.timestamp()
+        written = await cache_service.fill(
+            [(whitelist_key(row["ip_address"]), True, _epoch(row["expires_at"]) - clock) for row in rows],
+            settings.WARM_START_BATCH
+        )
+        MetricsCollector.set_whitelisted_ips(len(rows))
+        MetricsCollector.record_cache_warm("whitelist", len(written))
+        return len(written)
+
+    async def warm_verdicts(self, now: datetime) -> int:
+        """Write the latest verdict of recently seen IPs missing from Redis; returns how many"""
+        audit = AuditLog.__table__
+        latest = (
+            select(func.max(audit.c.id).label("id"))
+            .where(audit.c.timestamp >= now - timedelta(hours=settings.WARM_START_LOOKBACK_HOURS))
+            # Only the IP's own lookups: prefix, snapshot, device-adjusted and fallback verdicts were borrowed
+            .where(audit.c.verdict_source == "ipqs")
+            .group_by(audit.c.ip_address)
+            .order_by(func.max(audit.c.id).desc())
+            .limit(settings.WARM_START_MAX_IPS)
+            .subquery()
+        )
+        rows = await database.fetch_all(
+            select(audit).join(latest, audit.c.id == latest.c.id).order_by(audit.c.id.desc())
+        )
+        entries, stale = self._entries(rows, time.time())
+        # Most recently seen last, so they are the ones the bounded local cache keeps
+        written = set(await cache_service.fill(entries[::-1], settings.WARM_START_BATCH))
+        self._revalidate([verdict for verdict in stale if verdict_key(verdict["ip_address"]) in written])
+        MetricsCollector.record_cache_warm("verdict", len(written))
+        return len(written)
+
+    def _entries(self, rows: List[Any], clock: float) -> Tuple[List[Tuple[str, Any, float]], List[Dict[str, Any]]]:
+        """Cache entries for audit rows, most recently seen first, and the verdicts among them past their TTL"""
+        rate = settings.WARM_START_REVALIDATE_RATE
+        entries, stale = [], []
+        for row in rows:
+            verdict = verdict_from_audit(row)
+            expires_at = _epoch(row["timestamp"]) + verdict_ttl(verdict)
+            if expires_at <= clock:
+                if expires_at + settings.CACHE_STALE_TTL <= clock:
+                    continue
+                # Fresh until its turn to be revalidated, so requests don't all refresh it at once
+                expires_at = clock + (len(stale) + 1) / rate if rate > 0 else clock
+                stale.append(verdict)
+            verdict["expires_at"] = expires_at
+            entries.append((verdict_key(verdict["ip_address"]), verdict, expires_at - clock + settings.CACHE_STALE_TTL))
+        return entries, stale
+
+    def _revalidate(self, verdicts: List[Dict[str, Any]]):
+        if settings.WARM_START_REVALIDATE_RATE <= 0 or not verdicts:
+            return
+        self._pending.extend(verdicts)
+        if self._revalidate_task is None or self._revalidate_task.done():
+            self._revalidate_task = asyncio.create_task(self._run_revalidation())
+
+    async def _run_revalidation(self):
+        """Refresh warmed verdicts from IPQS in turn, at WARM_START_REVALIDATE_RATE"""
+        while self._pending:
+            verdict = self._pending.popleft()
+            verdict_service.refresh_in_background(verdict["ip_address"], verdict["user_agent"], verdict["request_path"])
+            MetricsCollector.record_cache_warm("revalidated")
+            await asyncio.sleep(1 / settings.WARM_START_REVALIDATE_RATE)
+
+    async def purge_whitelist(self, now: datetime) -> int:
+        """Delete expired whitelist rows; returns how many"""
+        expired = WhitelistedIP.expires_at <= now
+        count = await database.fetch_val(select(func.count()).select_from(WhitelistedIP.__table__).where(expired))
+        if count:
+            await database.execute(delete(WhitelistedIP.__table__).where(expired))
+            MetricsCollector.record_cache_warm("purged", count)
+        return count or 0
+
+
+# Create singleton instance
+cache_warmer = CacheWarmer()
@@ -0,0 +1,105 @@
+from typing import Optional, Dict, Tuple
+import asyncio
+import json
+import random
+import zlib
+from urllib.parse import urlsplit
+
+# Score band per risk level, matching the default RISK_THRESHOLD_* settings
+SCORE_BANDS = {"low": (0, 49), "medium": (50, 74), "high": (75, 100)}
+
+
+class FakeIPQS:
+    """
+    Local stand-in for the IPQS IP and device APIs, served over plain
+    HTTP/1.1 with keep-alive. Every address gets the same answer on every
+    run: its risk level is drawn from risk_mix by a hash of the address.
+    Latency and the share of 503 responses are set per instance and can be
+    changed while the server runs.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 risk_mix: Optional[Dict[str, float]] = None, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.risk_mix = risk_mix or {"low": 1.0}
+        self.calls = {"ip": 0, "device": 0, "errors": 0}
+        self._random = random.Random(seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.port: Optional[int] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/json"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def reset_counts(self):
+        self.calls = {"ip": 0, "device": 0, "errors": 0}
+
+    def risk_level(self, subject: str) -> str:
+        point = zlib.crc32(subject.encode()) / 2 ** 32 * sum(self.risk_mix.values())
+        for level, weight in self.risk_mix.items():
+            point -= weight
+            if point < 0:
+                return level
+        return level
+
+    def answer(self, subject: str) -> Dict[str, object]:
+        """IPQS-shaped result for an address or device fingerprint"""
+        level = self.risk_level(subject)
+        low, high = SCORE_BANDS[level]
+        score = low + zlib.adler32(subject.encode()) % (high - low + 1)
+        return {
+            "success": True,
+            "fraud_score": score,
+            "proxy": level == "high",
+            "vpn": False,
+            "tor": False,
+            "country_code": "US",
+            "city": "Benchmark"
+        }
+
+    async def _respond(self, path: str) -> Tuple[int, bytes]:
+        # /api/json/ip/<key>/<address> or /api/json/device/<key>/<fingerprint>
+        parts = urlsplit(path).path.strip("/").split("/")
+        if len(parts) != 5 or parts[2] not in ("ip", "device"):
+            return 404, b'{"success": false, "message": "Not found"}'
+        self.calls[parts[2]] += 1
+        if self.latency_ms or self.jitter_ms:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            await asyncio.sleep(max(delay, 0) / 1000)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return 503, b'{"success": false, "message": "Service unavailable"}'
+        return 200, json.dumps(self.answer(parts[4])).encode()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                # Headers are read and ignored; the APIs are GET-only
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                status, body = await self._respond(request_line.split()[1].decode())
+                reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[status]
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
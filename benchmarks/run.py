@@ -0,0 +1,424 @@
+"""
+Load-test the shield in-process against a local IPQS stand-in.
+
+    python -m benchmarks.run                       # every built-in scenario
+    python -m benchmarks.run -s mixed -s cold --output results.json
+    python -m benchmarks.run --baseline results.json --max-regression 0.1
+
+Each scenario runs in a fresh Python process: the app is started with its
+normal startup hook, pointed at benchmarks.fake_ipqs and at an in-memory
+Redis (fakeredis) or --redis-url, warmed up, and then driven with raw ASGI
+requests so the load generator adds no socket or HTTP client cost. The
+report is JSON; with --baseline, a drop in req/s or a rise in p99 beyond
+--max-regression is reported and the exit status is 1.
+"""
+from typing import Optional, Dict, Any, List, Tuple
+import argparse
+import asyncio
+import gc
+import importlib
+import ipaddress
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from .fake_ipqs import FakeIPQS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PATH = "/__bench__"
+
+# Addresses per request type; 198.18.0.0/15 is reserved for benchmarking
+HOT_NETWORK = ipaddress.ip_network("198.18.0.0/15")
+MISS_NETWORK = ipaddress.ip_network("100.64.0.0/10")
+WHITELIST_NETWORK = ipaddress.ip_network("192.0.2.0/24")
+
+DEFAULTS: Dict[str, Any] = {
+    "requests": 20000,
+    "concurrency": 50,
+    "seed": 1,
+    # Traffic mix
+    "whitelisted_ratio": 0.0,  # share of requests from whitelisted IPs
+    "whitelisted_ips": 100,
+    "hit_ratio": 1.0,  # share of the remaining requests from IPs whose verdict is cached during warm-up
+    "hot_ips": 1000,  # distinct cached IPs; every other request comes from a never-seen IP
+    "fingerprint_ratio": 0.0,  # share of requests carrying x-device-fingerprint
+    "fingerprints": 1000,
+    "risk_mix": {"low": 0.9, "medium": 0.07, "high": 0.03},
+    # IPQS stand-in
+    "ipqs_latency_ms": 20.0,
+    "ipqs_jitter_ms": 5.0,
+    "ipqs_error_rate": 0.0,
+    # Extra app settings, as environment variables
+    "settings": {},
+    "redis_url": None,
+    "stages": True,
+}
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "cached": {"hit_ratio": 1.0},
+    "whitelisted": {"whitelisted_ratio": 1.0},
+    "mixed": {
+        "whitelisted_ratio": 0.05, "hit_ratio": 0.9, "hot_ips": 10000, "fingerprint_ratio": 0.1,
+        "ipqs_latency_ms": 40.0, "ipqs_jitter_ms": 20.0, "ipqs_error_rate": 0.01
+    },
+    "cold": {"requests": 5000, "hit_ratio": 0.0, "ipqs_latency_ms": 50.0, "ipqs_jitter_ms": 20.0},
+    "ipqs_degraded": {"requests": 5000, "hit_ratio": 0.5, "ipqs_error_rate": 0.5, "ipqs_latency_ms": 200.0},
+}
+
+# (stage, object path, attribute): timed by wrapping the attribute for the measured run.
+# Times are wall-clock, so async stages include waiting on I/O and on other requests
+# sharing the event loop. Stages nest: resolve_miss includes ipqs_ip and ipqs_device.
+STAGES: Tuple[Tuple[str, str, str], ...] = (
+    ("ip_lists", "app.middleware:ip_lists", "match"),
+    ("local_decision", "app.services.cache:cache_service", "local_decision"),
+    ("redis_decision", "app.services.cache:cache_service", "get_decision"),
+    ("resolve_cached", "app.services.verdicts:verdict_service", "resolve_cached"),
+    ("resolve_miss", "app.services.verdicts:verdict_service", "resolve_miss"),
+    ("ipqs_ip", "app.services.ipqs:ipqs_service", "check_ip"),
+    ("ipqs_device", "app.services.ipqs:ipqs_service", "check_device"),
+    ("audit_enqueue", "app.middleware", "log_request_nowait"),
+    ("audit_enqueue_wait", "app.middleware", "log_request"),
+    ("rate_limit_local", "app.services.ratelimit:rate_limiter", "check_nowait"),
+    ("rate_limit_redis", "app.services.ratelimit:rate_limiter", "check"),
+    ("audit_write", "app.services.audit:audit_writer", "_write"),
+)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(round(fraction * len(sorted_values), 6))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class StageTimer:
+    """Call counts and time spent per stage, collected by wrapping the stage functions"""
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self.seconds: Counter = Counter()
+
+    def wrap(self, stage: str, fn):
+        if asyncio.iscoroutinefunction(fn):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.calls[stage] += 1
+                    self.seconds[stage] += time.perf_counter() - start
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.calls[stage] += 1
+                    self.seconds[stage] += time.perf_counter() - start
+        return timed
+
+    def install(self):
+        for stage, path, attribute in STAGES:
+            module_name, _, object_name = path.partition(":")
+            target = importlib.import_module(module_name)
+            if object_name:
+                target = getattr(target, object_name)
+            setattr(target, attribute, self.wrap(stage, getattr(target, attribute)))
+
+    def report(self, requests: int) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                "calls": self.calls[stage],
+                "mean_us": round(self.seconds[stage] / self.calls[stage] * 1e6, 2),
+                "per_request_us": round(self.seconds[stage] / requests * 1e6, 2),
+            }
+            for stage, _, _ in STAGES if self.calls[stage]
+        }
+
+
+def plan_requests(config: Dict[str, Any]) -> Tuple[List[Tuple[str, Optional[str]]], List[str], List[str]]:
+    """(client IP, device fingerprint) per request, plus the hot and whitelisted IPs to warm up"""
+    rng = random.Random(config["seed"])
+    hot = [str(HOT_NETWORK[i]) for i in range(config["hot_ips"])]
+    whitelisted = [str(WHITELIST_NETWORK[i + 1]) for i in range(min(config["whitelisted_ips"], 254))]
+    plan, misses = [], 0
+    for _ in range(config["requests"]):
+        if rng.random() < config["whitelisted_ratio"]:
+            ip = rng.choice(whitelisted)
+        elif hot and rng.random() < config["hit_ratio"]:
+            ip = rng.choice(hot)
+        else:
+            ip = str(MISS_NETWORK[misses])
+            misses += 1
+        fingerprint = None
+        if rng.random() < config["fingerprint_ratio"]:
+            fingerprint = f"bench-{rng.randrange(config['fingerprints'])}"
+        plan.append((ip, fingerprint))
+    return plan, hot, whitelisted
+
+
+async def call(app, ip: str, fingerprint: Optional[str]) -> int:
+    """Send one GET through the app as raw ASGI and return the response status"""
+    headers = [(b"host", b"bench"), (b"user-agent", b"sentinel-bench")]
+    if fingerprint:
+        headers.append((b"x-device-fingerprint", fingerprint.encode()))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": BENCH_PATH, "raw_path": BENCH_PATH.encode(), "query_string": b"", "root_path": "",
+        "headers": headers, "client": (ip, 40000), "server": ("bench", 80),
+    }
+    status = 500
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        status = 500
+    return status
+
+
+async def drive(app, plan: List[Tuple[str, Optional[str]]], concurrency: int,
+                latencies: Optional[List[float]] = None) -> Counter:
+    """Send every planned request with at most concurrency in flight"""
+    statuses: Counter = Counter()
+    pending = iter(plan)
+
+    async def worker():
+        for ip, fingerprint in pending:
+            start = time.perf_counter()
+            statuses[await call(app, ip, fingerprint)] += 1
+            if latencies is not None:
+                latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return statuses
+
+
+async def run_scenario(name: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Start the app against a fresh IPQS stand-in, Redis and database, warm it up and measure it"""
+    ipqs = FakeIPQS(risk_mix=config["risk_mix"], seed=config["seed"])
+    await ipqs.start()
+    workdir = tempfile.mkdtemp(prefix="sentinel-bench-")
+    # Settings are read when app modules are first imported
+    os.environ.update({
+        "IPQS_API_KEY": "bench",
+        "IPQS_BASE_URL": f"{ipqs.base_url}/ip",
+        "IPQS_DEVICE_BASE_URL": f"{ipqs.base_url}/device",
+        "ADMIN_PASSWORD": "bench",
+        "SECRET_KEY": "bench",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "REPUTATION_SNAPSHOT_PATH": os.path.join(workdir, "reputation.bin"),
+    })
+    for key, value in config["settings"].items():
+        os.environ[key] = value if isinstance(value, str) else json.dumps(value)
+
+    from starlette.responses import PlainTextResponse
+    from app import main
+    from app.services.cache import cache_service
+
+    main.app.add_route(BENCH_PATH, lambda request: PlainTextResponse("ok"))
+    if config["redis_url"]:
+        import redis.asyncio as aioredis
+        cache_service.redis = aioredis.from_url(config["redis_url"], decode_responses=True)
+        await cache_service.redis.flushdb()
+    else:
+        import fakeredis
+        cache_service.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    plan, hot, whitelisted = plan_requests(config)
+    await main.startup()
+    try:
+        # Warm-up: whitelist, then cache a verdict for every hot IP and device through the normal request path
+        for ip in whitelisted:
+            await cache_service.whitelist_ip(ip)
+        await drive(main.app, [(ip, None) for ip in hot], config["concurrency"])
+        if hot and config["fingerprint_ratio"]:
+            devices = [(hot[i % len(hot)], f"bench-{i}") for i in range(config["fingerprints"])]
+            await drive(main.app, devices, config["concurrency"])
+
+        stages = StageTimer()
+        if config["stages"]:
+            stages.install()
+        ipqs.latency_ms, ipqs.jitter_ms, ipqs.error_rate = (
+            config["ipqs_latency_ms"], config["ipqs_jitter_ms"], config["ipqs_error_rate"]
+        )
+        ipqs.reset_counts()
+        gc.collect()
+
+        latencies: List[float] = []
+        start = time.perf_counter()
+        statuses = await drive(main.app, plan, config["concurrency"], latencies)
+        elapsed = time.perf_counter() - start
+    finally:
+        await main.shutdown()
+        await ipqs.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "name": name,
+        "config": config,
+        "requests": len(plan),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(plan) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "status": {str(status): count for status, count in sorted(statuses.items())},
+        "upstream_calls": dict(ipqs.calls),
+        "stages": stages.report(len(plan)),
+    }
+
+
+def scenario_config(name: str, custom: Dict[str, Dict[str, Any]], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    if name in custom:
+        scenario = custom[name]
+    elif name in SCENARIOS:
+        scenario = SCENARIOS[name]
+    else:
+        raise SystemExit(f"Unknown scenario: {name}")
+    unknown = set(scenario) - set(DEFAULTS)
+    if unknown:
+        raise SystemExit(f"Unknown options in scenario {name}: {', '.join(sorted(unknown))}")
+    return {**DEFAULTS, **scenario, **overrides}
+
+
+def run_isolated(name: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one scenario in a child process so no state carries over between scenarios"""
+    fd, result_path = tempfile.mkstemp(prefix="sentinel-bench-", suffix=".json")
+    os.close(fd)
+    try:
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--child", name, json.dumps(config), result_path],
+            cwd=ROOT
+        )
+        if completed.returncode != 0:
+            return {"name": name, "config": config, "error": f"exited with status {completed.returncode}"}
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], max_regression: float) -> List[Dict[str, Any]]:
+    """Scenarios whose req/s fell or whose p99 rose by more than max_regression against the baseline"""
+    previous = {result["name"]: result for result in baseline.get("scenarios", []) if "error" not in result}
+    regressions = []
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None or "error" in result:
+            continue
+        checks = (
+            ("rps", old["rps"], result["rps"], result["rps"] < old["rps"] * (1 - max_regression)),
+            ("p99_ms", old["latency_ms"]["p99"], result["latency_ms"]["p99"],
+             result["latency_ms"]["p99"] > old["latency_ms"]["p99"] * (1 + max_regression)),
+        )
+        for metric, before, after, regressed in checks:
+            if regressed:
+                regressions.append({"scenario": result["name"], "metric": metric, "baseline": before, "current": after})
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("-s", "--scenario", action="append",
+                        help=f"scenario to run, repeatable (built in: {', '.join(SCENARIOS)}); default all")
+    parser.add_argument("--scenario-file", help="JSON object of extra scenarios: name -> options overriding DEFAULTS")
+    parser.add_argument("--requests", type=int, help="override the request count of every scenario")
+    parser.add_argument("--concurrency", type=int, help="override the concurrency of every scenario")
+    parser.add_argument("--redis-url", help="use this Redis instead of an in-memory one; its database is FLUSHED")
+    parser.add_argument("--no-stages", action="store_true", help="skip per-stage timing, which costs a little")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="allowed fractional drop in req/s or rise in p99 against --baseline")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        name, config, result_path = args.child
+        logging.disable(logging.CRITICAL)
+        result = asyncio.run(run_scenario(name, json.loads(config)))
+        with open(result_path, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    custom = {}
+    if args.scenario_file:
+        with open(args.scenario_file) as f:
+            custom = json.load(f)
+    overrides = {"redis_url": args.redis_url, "stages": not args.no_stages}
+    if args.requests:
+        overrides["requests"] = args.requests
+    if args.concurrency:
+        overrides["concurrency"] = args.concurrency
+
+    results = []
+    for name in args.scenario or list(SCENARIOS) + [name for name in custom if name not in SCENARIOS]:
+        result = run_isolated(name, scenario_config(name, custom, overrides))
+        results.append(result)
+        if "error" in result:
+            print(f"{name}: {result['error']}", file=sys.stderr)
+        else:
+            latency = result["latency_ms"]
+            print(f"{name}: {result['rps']} req/s, p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+                  f"p99 {latency['p99']} ms, status {result['status']}", file=sys.stderr)
+
+    report = {
+        "format": 1,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scenarios": results,
+    }
+    failed = any("error" in result for result in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.max_regression)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['scenario']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}", file=sys.stderr)
+        failed = failed or bool(report["regressions"])
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
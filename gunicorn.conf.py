@@ -0,0 +1,37 @@
+"""
+Multi-worker mode: gunicorn app.main:app (this file is picked up from the
+working directory). Runs WEB_CONCURRENCY uvicorn workers, one per core by
+default. Each worker writes its Prometheus metrics to files in
+PROMETHEUS_MULTIPROC_DIR; /metrics and /admin/metrics in any worker sum them.
+"""
+import glob
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+graceful_timeout = 30
+
+# Must be set before a worker imports prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/sentinel-metrics")
+
+
+def on_starting(server):
+    # Metric files left by a previous run would be added to this one
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+
+    # Schema creation and the whitelist count run once here, in a short-lived
+    # process so the master imports none of the app before forking
+    subprocess.run([sys.executable, "-m", "app.bootstrap"], check=True)
+    os.environ["STARTUP_PREPARED"] = "true"
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import pytest
+
+# Required settings without defaults; set before any app module is imported
+os.environ.setdefault("IPQS_API_KEY", "test_api_key")
+os.environ.setdefault("ADMIN_PASSWORD", "test_password")
+os.environ.setdefault("SECRET_KEY", "test_secret")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+
+@pytest.fixture
+def fake_cache():
+    """A CacheService on an in-memory fakeredis, without the invalidation listener"""
+    fakeredis = pytest.importorskip("fakeredis")
+    from app.services.cache import CacheService
+
+    service = CacheService()
+    service.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    service._listener_task = object()
+    return service
+
+
+@pytest.fixture
+def run_with_db(tmp_path, monkeypatch):
+    """Run body(db) on a fresh SQLite database with the schema, patched in as the modules' `database`"""
+    from databases import Database
+    from sqlalchemy import create_engine
+    from app.models.database import Base
+
+    def run(body, *modules):
+        url = f"sqlite:///{tmp_path / 'test.db'}"
+        Base.metadata.create_all(bind=create_engine(url))
+        db = Database(url)
+        for module in modules:
+            monkeypatch.setattr(module, "database", db)
+
+        async def main():
+            await db.connect()
+            try:
+                return await body(db)
+            finally:
+                await db.disconnect()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,173 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from app.services import audit, reports
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.batches = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute_many(self, query, values):
+        # Rollup upserts are covered in test_reports
+        if query.table.name == "audit_logs":
+            self.batches.append(list(values))
+
+
+def make_record(n):
+    return {"ip_address": f"192.0.2.{n}", "risk_score": 10, "action_taken": "low"}
+
+
+def test_writer_flushes_in_batches_and_on_stop(monkeypatch):
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(audit, "database", fake_db)
+    monkeypatch.setattr(audit.settings, "AUDIT_BATCH_SIZE", 4)
+    monkeypatch.setattr(audit.settings, "AUDIT_FLUSH_INTERVAL", 60)
+    writer = audit.AuditWriter()
+
+    async def run():
+        for n in range(10):
+            await writer.submit(make_record(n))
+        await asyncio.sleep(0)  # let the size trigger fire
+        await writer.stop()
+
+    asyncio.run(run())
+
+    assert [len(batch) for batch in fake_db.batches] == [4, 4, 2]
+    assert [row["ip_address"] for batch in fake_db.batches for row in batch] == \
+        [f"192.0.2.{n}" for n in range(10)]
+
+
+def test_writer_drop_policy_discards_when_full(monkeypatch):
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(audit, "database", fake_db)
+    monkeypatch.setattr(audit.settings, "AUDIT_QUEUE_SIZE", 3)
+    monkeypatch.setattr(audit.settings, "AUDIT_BATCH_SIZE", 100)
+    monkeypatch.setattr(audit.settings, "AUDIT_FLUSH_INTERVAL", 60)
+    monkeypatch.setattr(audit.settings, "AUDIT_OVERFLOW_POLICY", "drop")
+    writer = audit.AuditWriter()
+
+    async def run():
+        accepted = [await writer.submit(make_record(n)) for n in range(5)]
+        await writer.stop()
+        return accepted
+
+    accepted = asyncio.run(run())
+
+    assert accepted == [True, True, True, False, False]
+    assert sum(len(batch) for batch in fake_db.batches) == 3
+
+
+def test_submit_many_queues_in_one_call(monkeypatch):
+    fake_db = FakeDatabase()
+    monkeypatch.setattr(audit, "database", fake_db)
+    monkeypatch.setattr(audit.settings, "AUDIT_BATCH_SIZE", 100)
+    writer = audit.AuditWriter()
+
+    async def run():
+        queued = await writer.submit_many([make_record(n) for n in range(5)])
+        await writer.stop()
+        return queued
+
+    assert asyncio.run(run()) == 5
+    assert [len(batch) for batch in fake_db.batches] == [5]
+
+
+def test_archiver_moves_old_days_and_drops_expired_tables(tmp_path, monkeypatch):
+    from datetime import date, datetime
+    from databases import Database
+    from sqlalchemy import create_engine
+
+    url = f"sqlite:///{tmp_path / 'audit.db'}"
+    audit.AuditLog.metadata.create_all(bind=create_engine(url))
+    db = Database(url)
+    monkeypatch.setattr(audit, "database", db)
+    monkeypatch.setattr(reports, "database", db)
+    monkeypatch.setattr(audit.settings, "AUDIT_LIVE_DAYS", 1)
+    monkeypatch.setattr(audit.settings, "AUDIT_RETENTION_DAYS", 3)
+    monkeypatch.setattr(audit.settings, "AUDIT_COMPACT_BATCH", 2)
+    days = [datetime(2026, 5, 7, 12), datetime(2026, 5, 9, 1), datetime(2026, 5, 9, 23), datetime(2026, 5, 10, 8)]
+
+    async def run():
+        await db.connect()
+        rows = [{**make_record(n), "timestamp": ts} for n, ts in enumerate(days)]
+        await db.execute_many(query=audit.AuditLog.__table__.insert(), values=rows)
+        await db.execute("CREATE TABLE audit_logs_20260501 (id INTEGER)")
+        result = await audit.AuditArchiver().run_once(today=date(2026, 5, 10))
+        live = await db.fetch_val("SELECT COUNT(*) FROM audit_logs")
+        archived = await db.fetch_val("SELECT COUNT(*) FROM audit_logs_20260509")
+        tables = await audit.AuditArchiver().archive_tables()
+        await db.disconnect()
+        return result, live, archived, tables
+
+    result, live, archived, tables = asyncio.run(run())
+
+    assert result == {"archived": 3, "dropped_tables": 1}
+    assert live == 1
+    assert archived == 2
+    assert tables == ["audit_logs_20260507", "audit_logs_20260509"]
+
+
+def test_logs_page_from_the_live_table_into_archives(run_with_db, monkeypatch):
+    from datetime import date, datetime
+
+    monkeypatch.setattr(audit.settings, "AUDIT_LIVE_DAYS", 1)
+    days = [datetime(2026, 5, 7, 12), datetime(2026, 5, 8, 1), datetime(2026, 5, 9, 23), datetime(2026, 5, 10, 8)]
+    archiver, service = audit.AuditArchiver(), reports.AuditReports()
+
+    async def body(db):
+        rows = [{**make_record(n), "timestamp": ts} for n, ts in enumerate(days)]
+        await db.execute_many(query=audit.AuditLog.__table__.insert(), values=rows)
+        await archiver.run_once(today=date(2026, 5, 10))
+        archives = await archiver.archives_between(None, None)
+        pages, cursor = [], None
+        while True:
+            page = await service.logs(cursor=cursor, limit=3, archives=archives)
+            pages.append([log["id"] for log in page["logs"]])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        since = datetime(2026, 5, 8, 12)
+        recent = await service.logs(since=since, archives=await archiver.archives_between(since, None))
+        return archives, pages, [log["id"] for log in recent["logs"]]
+
+    archives, pages, recent = run_with_db(body, audit, reports)
+
+    assert archives == ["audit_logs_20260509", "audit_logs_20260508", "audit_logs_20260507"]
+    assert pages == [[4, 3, 2], [1]]
+    assert recent == [4, 3]
+
+
+def test_audit_rows_record_where_the_verdict_came_from():
+    verdict = {"ip_address": "192.0.2.1", "risk_score": 10, "is_proxy": False, "is_vpn": False, "is_tor": False,
+               "country_code": "US", "request_path": "/", "user_agent": "ua"}
+
+    sources = [audit.audit_row(dict(verdict, **extra), "low")["verdict_source"] for extra in (
+        {}, {"subnet": "192.0.2.0/24"}, {"source": "local"}, {"device_fingerprint": "fp", "device_adjusted": True},
+        {"degraded": True}
+    )]
+
+    assert sources == ["ipqs", "subnet", "local", "device", "fallback"]
+
+
+def test_fingerprinted_verdicts_stay_ipqs_unless_device_data_changes_the_level(monkeypatch):
+    from app.services import verdicts
+    from app.services.policy import CompiledPolicy
+
+    monkeypatch.setattr(verdicts.risk_policy, "policy", CompiledPolicy(
+        {"rules": [{"name": "high", "action": "block", "score_gte": 75.0}], "default": "allow"}
+    ))
+    verdict = {"ip_address": "192.0.2.1", "risk_score": 10, "is_proxy": False, "is_vpn": False, "is_tor": False,
+               "country_code": "US", "risk_level": "low", "request_path": "/", "user_agent": "ua"}
+    service = verdicts.VerdictService()
+
+    sources = [
+        audit.verdict_source(service.merge_device(verdict, device_data, "fp"))
+        for device_data in (None, {"fraud_score": 20}, {"fraud_score": 90})
+    ]
+
+    assert sources == ["ipqs", "ipqs", "device"]
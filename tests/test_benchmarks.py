@@ -0,0 +1,71 @@
+import asyncio
+
+import httpx
+
+from benchmarks import run
+from benchmarks.fake_ipqs import FakeIPQS, SCORE_BANDS
+
+
+def test_fake_ipqs_answers_consistently_by_risk_mix():
+    async def fetch():
+        server = FakeIPQS(error_rate=0.0, risk_mix={"low": 0.5, "high": 0.5})
+        await server.start()
+        try:
+            async with httpx.AsyncClient() as client:
+                first = await client.get(f"{server.base_url}/ip/key/198.18.0.1")
+                second = await client.get(f"{server.base_url}/ip/key/198.18.0.1")
+                missing = await client.get(f"{server.base_url}/unknown")
+            return server, first.json(), second.json(), missing.status_code
+        finally:
+            await server.stop()
+
+    server, first, second, missing = asyncio.run(fetch())
+
+    assert first == second
+    low, high = SCORE_BANDS[server.risk_level("198.18.0.1")]
+    assert first["success"] is True and low <= first["fraud_score"] <= high
+    assert missing == 404
+    assert server.calls == {"ip": 2, "device": 0, "errors": 0}
+    levels = [server.risk_level(f"198.18.{i // 256}.{i % 256}") for i in range(2000)]
+    assert 800 < levels.count("high") < 1200
+
+
+def test_fake_ipqs_error_rate():
+    async def fetch():
+        server = FakeIPQS(error_rate=1.0)
+        await server.start()
+        try:
+            async with httpx.AsyncClient() as client:
+                return (await client.get(f"{server.base_url}/device/key/abc")).status_code, server.calls
+        finally:
+            await server.stop()
+
+    assert asyncio.run(fetch()) == (503, {"ip": 0, "device": 1, "errors": 1})
+
+
+def test_plan_requests_follows_traffic_mix():
+    config = {**run.DEFAULTS, "requests": 10000, "hit_ratio": 0.8, "hot_ips": 50, "fingerprint_ratio": 0.25}
+    plan, hot, whitelisted = run.plan_requests(config)
+
+    assert plan == run.plan_requests(config)[0]
+    hot_requests = sum(1 for ip, _ in plan if ip in set(hot))
+    assert 7600 < hot_requests < 8400
+    misses = [ip for ip, _ in plan if ip not in set(hot)]
+    assert len(set(misses)) == len(misses)
+    assert 2200 < sum(1 for _, fingerprint in plan if fingerprint) < 2800
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert run.percentile(values, 0.5) == 50.0
+    assert run.percentile(values, 0.99) == 99.0
+    assert run.percentile([], 0.99) == 0.0
+
+
+def test_compare_flags_throughput_and_tail_latency_regressions():
+    baseline = {"scenarios": [{"name": "cached", "rps": 1000.0, "latency_ms": {"p99": 10.0}}]}
+    steady = [{"name": "cached", "rps": 950.0, "latency_ms": {"p99": 10.5}}]
+    slower = [{"name": "cached", "rps": 800.0, "latency_ms": {"p99": 12.0}}]
+
+    assert run.compare(steady, baseline, 0.1) == []
+    assert [r["metric"] for r in run.compare(slower, baseline, 0.1)] == ["rps", "p99_ms"]
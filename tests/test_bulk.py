@@ -0,0 +1,81 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+from app.services import bulk
+
+
+def make_verdict(ip, risk_level="low"):
+    return {"ip_address": ip, "risk_score": 10, "is_proxy": False, "is_vpn": False, "is_tor": False,
+            "country_code": "US", "risk_level": risk_level, "request_path": "/", "user_agent": "ua"}
+
+
+def collect(checker, ips):
+    async def run():
+        return [result async for result in checker.check(bulk.iterate(ips), "ua")]
+    return asyncio.run(run())
+
+
+def test_bulk_dedupes_and_serves_cache_hits_from_one_mget(monkeypatch):
+    cached = make_verdict("192.0.2.1")
+    get_many = AsyncMock(side_effect=lambda keys: [None, cached, None, None])
+    monkeypatch.setattr(bulk.cache_service, "get_many", get_many)
+    resolve = AsyncMock(side_effect=lambda ip, cached, *args, **kwargs: cached or make_verdict(ip, "high"))
+    monkeypatch.setattr(bulk.verdict_service, "resolve", resolve)
+    submit_many = AsyncMock()
+    monkeypatch.setattr(bulk.audit_writer, "submit_many", submit_many)
+
+    results = collect(bulk.BulkChecker(), ["192.0.2.1", "192.0.2.2", "192.0.2.1", "not-an-ip"])
+
+    assert get_many.await_count == 1
+    assert get_many.await_args.args[0] == ["whitelist:192.0.2.1", "ip:192.0.2.1",
+                                           "whitelist:192.0.2.2", "ip:192.0.2.2"]
+    assert sorted(result["ip"] for result in results) == ["192.0.2.1", "192.0.2.2", "not-an-ip"]
+    # Only the lookup is audited, in one bulk submit
+    rows = [row for call in submit_many.await_args_list for row in call.args[0]]
+    assert [row["ip_address"] for row in rows] == ["192.0.2.2"]
+
+
+def test_bulk_lookups_respect_concurrency_cap(monkeypatch):
+    monkeypatch.setattr(bulk.settings, "BULK_CHECK_CONCURRENCY", 3)
+    monkeypatch.setattr(bulk.cache_service, "get_many", AsyncMock(side_effect=lambda keys: [None] * len(keys)))
+    monkeypatch.setattr(bulk.audit_writer, "submit_many", AsyncMock())
+    in_flight, peak = 0, 0
+
+    async def resolve(ip, cached, *args, **kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        return make_verdict(ip)
+
+    monkeypatch.setattr(bulk.verdict_service, "resolve", resolve)
+
+    results = collect(bulk.BulkChecker(), [f"198.51.100.{n}" for n in range(20)])
+
+    assert len(results) == 20
+    assert peak == 3
+
+
+def test_bulk_serves_stale_hits_without_refreshing(monkeypatch):
+    stale = dict(make_verdict("192.0.2.1"), expires_at=0)
+    monkeypatch.setattr(bulk.cache_service, "get_many", AsyncMock(side_effect=lambda keys: [None, stale]))
+    refreshed = []
+    monkeypatch.setattr(bulk.verdict_service, "refresh_in_background", lambda *args, **kwargs: refreshed.append(args))
+    resolve = AsyncMock()
+    monkeypatch.setattr(bulk.verdict_service, "resolve", resolve)
+
+    results = collect(bulk.BulkChecker(), ["192.0.2.1"])
+
+    assert [result["ip"] for result in results] == ["192.0.2.1"]
+    assert refreshed == [] and resolve.await_count == 0
+
+
+def test_bulk_stops_at_max_ips(monkeypatch):
+    monkeypatch.setattr(bulk.settings, "BULK_CHECK_MAX_IPS", 2)
+    monkeypatch.setattr(bulk.ip_lists, "match", lambda ip: "deny")
+
+    results = collect(bulk.BulkChecker(), ["192.0.2.1", "192.0.2.2", "192.0.2.3"])
+
+    assert [result.get("status") for result in results[:2]] == ["blocked", "blocked"]
+    assert "error" in results[2]
@@ -1,26 +1,191 @@
 import pytest
-from unittest.mock import MagicMock
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
 from app.services import cache
-from app.config import settings
+from app.config.settings import settings
 
-@pytest.fixture
-def mock_redis():
-    mock = MagicMock()
-    cache.redis_client = mock
-    return mock
-
-def test_cache_set_and_get(mock_redis):
+def test_cache_set_and_get(fake_cache):
     key = "test_key"
-    value = "test_value"
-    cache.set_value(key, value)
-    mock_redis.set.assert_called_once_with(key, value, ex=settings.CACHE_TTL)
+    value = {"risk_score": 10}
+
+    async def run():
+        assert await fake_cache.set(key, value)
+        return await fake_cache.redis.ttl(key), await fake_cache.get(key, use_local=False)
 
-    retrieved_value = cache.get_value(key)
-    mock_redis.get.assert_called_once_with(key)
+    ttl, retrieved_value = asyncio.run(run())
 
-    assert retrieved_value == mock_redis.get.return_value
+    assert ttl == settings.CACHE_TTL
+    assert retrieved_value == value
+    assert fake_cache.local_get(key) == value
 
-def test_cache_delete(mock_redis):
+def test_cache_delete(fake_cache):
     key = "test_key"
-    cache.delete_value(key)
-    mock_redis.delete.assert_called_once_with(key)
\ No newline at end of file
+
+    async def run():
+        await fake_cache.set(key, "test_value")
+        deleted = await fake_cache.delete(key)
+        return deleted, await fake_cache.delete(key), await fake_cache.redis.exists(key)
+
+    assert asyncio.run(run()) == (True, False, 0)
+    assert fake_cache.local_get(key) is None
+
+def test_local_cache_lru_eviction():
+    local = cache.LocalCache(max_size=2, ttl=60)
+    local.set("a", 1)
+    local.set("b", 2)
+    assert local.get("a") == 1  # "a" is now most recently used
+    local.set("c", 3)
+
+    assert local.get("b") is cache._MISSING
+    assert local.get("a") == 1
+    assert local.get("c") == 3
+
+
+def test_local_cache_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    local = cache.LocalCache(max_size=10, ttl=30)
+    local.set("short", "x", ttl=5)
+    local.set("capped", "y", ttl=3600)
+
+    now[0] += 6
+    assert local.get("short") is cache._MISSING
+    assert local.get("capped") == "y"
+    now[0] += 25
+    assert local.get("capped") is cache._MISSING
+
+
+def test_local_cache_holds_negative_results():
+    local = cache.LocalCache(max_size=10, ttl=60)
+    local.set("whitelist:10.0.0.1", None)
+    assert local.get("whitelist:10.0.0.1") is None
+    local.delete("whitelist:10.0.0.1")
+    assert local.get("whitelist:10.0.0.1") is cache._MISSING
+
+
+def test_cache_service_get_served_locally():
+    service = cache.CacheService()
+    service.redis = MagicMock()
+    service.redis.get = AsyncMock(return_value='{"risk_level": "low"}')
+    service._listener_task = MagicMock()
+
+    first = asyncio.run(service.get("ip:10.0.0.1"))
+    second = asyncio.run(service.get("ip:10.0.0.1"))
+
+    assert first == second == {"risk_level": "low"}
+    service.redis.get.assert_awaited_once_with("ip:10.0.0.1")
+
+
+def test_cache_service_get_does_not_hold_redis_errors_locally():
+    service = cache.CacheService()
+    service.redis = MagicMock()
+    service.redis.get = AsyncMock(side_effect=[cache.redis_exceptions.TimeoutError("slow"), "true"])
+    service._listener_task = MagicMock()
+
+    assert asyncio.run(service.get("whitelist:10.0.0.1")) is None
+    assert service.local.get("whitelist:10.0.0.1") is cache._MISSING
+    assert asyncio.run(service.get("whitelist:10.0.0.1")) is True
+
+
+def test_get_decision_uses_single_mget():
+    service = cache.CacheService()
+    service.local = None
+    service.redis = MagicMock()
+    service.redis.mget = AsyncMock(return_value=[None, '{"risk_level": "high"}'])
+    service._listener_task = MagicMock()
+
+    whitelisted, verdict = asyncio.run(service.get_decision("10.0.0.2"))
+
+    assert whitelisted is False
+    assert verdict == {"risk_level": "high"}
+    service.redis.mget.assert_awaited_once_with(["whitelist:10.0.0.2", "ip:10.0.0.2"])
+
+
+def test_get_many_skips_locally_held_keys():
+    service = cache.CacheService()
+    service.local = cache.LocalCache(max_size=10, ttl=60)
+    service.local.set("ip:10.0.0.3", {"risk_level": "low"})
+    service.redis = MagicMock()
+    service.redis.mget = AsyncMock(return_value=[None])
+    service._listener_task = MagicMock()
+
+    whitelisted, verdict = asyncio.run(service.get_many(["whitelist:10.0.0.3", "ip:10.0.0.3"]))
+
+    assert whitelisted is None
+    assert verdict == {"risk_level": "low"}
+    service.redis.mget.assert_awaited_once_with(["whitelist:10.0.0.3"])
+
+
+def test_get_many_does_not_hold_redis_errors_locally():
+    service = cache.CacheService()
+    service.local = cache.LocalCache(max_size=10, ttl=60)
+    service.redis = MagicMock()
+    service.redis.mget = AsyncMock(side_effect=cache.redis_exceptions.ConnectionError("down"))
+    service._listener_task = MagicMock()
+
+    decisions = asyncio.run(service.get_decisions(["10.0.0.4"]))
+
+    assert decisions == [(False, None)]
+    assert service.local_decision("10.0.0.4") is None
+
+
+def test_local_decision_needs_no_redis_when_held_locally():
+    service = cache.CacheService()
+    service.local = cache.LocalCache(max_size=10, ttl=60)
+    service.local.set("whitelist:10.0.0.4", True)
+    service.local.set("whitelist:10.0.0.5", None)
+    service.local.set("ip:10.0.0.5", {"risk_level": "low"})
+
+    assert service.local_decision("10.0.0.4") == (True, None)
+    assert service.local_decision("10.0.0.5") == (False, {"risk_level": "low"})
+    assert service.local_decision("10.0.0.6") is None
+
+
+def test_hot_key_tracker_picks_hot_keys_near_expiry():
+    tracker = cache.HotKeyTracker(max_keys=10)
+    now = 1000.0
+    for _ in range(5):
+        tracker.record("ip:hot", now + 10)
+        tracker.record("ip:fresh", now + 3600)
+    tracker.record("ip:cold", now + 10)
+
+    assert tracker.due(now, window=60, min_hits=3, limit=10) == ["ip:hot"]
+    # Marked as refreshing until a hit reports the new expiry
+    assert tracker.due(now, window=60, min_hits=3, limit=10) == []
+
+
+def test_hot_key_tracker_decay_and_bound():
+    tracker = cache.HotKeyTracker(max_keys=2)
+    tracker.record("a", 0)
+    tracker.record("a", 0)
+    tracker.record("b", 0)
+    tracker.record("c", 0)
+
+    assert len(tracker) == 2
+    tracker.decay()
+    assert len(tracker) == 1
+
+
+def test_addresses_are_keyed_in_canonical_form():
+    assert cache.canonical_ip("::ffff:192.0.2.7") == "192.0.2.7"
+    assert cache.canonical_ip("2001:DB8:0:0:0:0:0:1") == "2001:db8::1"
+    assert cache.canonical_ip("2001:0db8::0001") == "2001:db8::1"
+    assert cache.canonical_ip("unknown") == "unknown"
+    assert cache.verdict_key("::FFFF:192.0.2.7") == "ip:192.0.2.7"
+    assert cache.whitelist_key("2001:db8:0::1") == "whitelist:2001:db8::1"
+    assert cache.subnet_of("::ffff:192.0.2.7") == "192.0.2.0/24"
+
+
+def test_get_decision_falls_back_to_the_prefix_verdict(monkeypatch):
+    monkeypatch.setattr(cache.settings, "SUBNET_VERDICTS_ENABLED", True)
+    service = cache.CacheService()
+    service.local = None
+    service.redis = MagicMock()
+    service.redis.mget = AsyncMock(return_value=[None, None, '{"risk_level": "high", "subnet": "2001:db8::/64"}'])
+    service._listener_task = MagicMock()
+
+    whitelisted, verdict = asyncio.run(service.get_decision("2001:DB8::5"))
+
+    assert whitelisted is False
+    assert verdict["subnet"] == "2001:db8::/64"
+    service.redis.mget.assert_awaited_once_with(["whitelist:2001:db8::5", "ip:2001:db8::5", "subnet:{2001:db8::/64}"])
@@ -1,54 +1,38 @@
 import pytest
 from app.config.settings import validate_settings, settings
 
-def test_validate_settings_valid():
-    settings.IPQS_API_KEY = "test_key"
-    settings.REDIS_HOST = "localhost"
-    settings.REDIS_PORT = 6379
-    settings.RISK_THRESHOLD_HIGH = 80.0
-    settings.RISK_THRESHOLD_MEDIUM = 50.0
-    settings.RISK_THRESHOLD_LOW = 20.0
-    
-    validate_settings() 
-
-def test_validate_settings_invalid_api_key():
-    settings.IPQS_API_KEY = ""
-    settings.REDIS_HOST = "localhost"
-    settings.REDIS_PORT = 6379
-    settings.RISK_THRESHOLD_HIGH = 80.0
-    settings.RISK_THRESHOLD_MEDIUM = 50.0
-    settings.RISK_THRESHOLD_LOW = 20.0
+
+@pytest.fixture
+def valid_settings(monkeypatch):
+    monkeypatch.setattr(settings, "IPQS_API_KEY", "test_key")
+    monkeypatch.setattr(settings, "REDIS_HOST", "localhost")
+    monkeypatch.setattr(settings, "REDIS_PORT", 6379)
+    monkeypatch.setattr(settings, "RISK_THRESHOLD_HIGH", 80.0)
+    monkeypatch.setattr(settings, "RISK_THRESHOLD_MEDIUM", 50.0)
+    monkeypatch.setattr(settings, "RISK_THRESHOLD_LOW", 20.0)
+    return settings
+
+def test_validate_settings_valid(valid_settings):
+    validate_settings(valid_settings)
+
+def test_validate_settings_invalid_api_key(valid_settings, monkeypatch):
+    monkeypatch.setattr(valid_settings, "IPQS_API_KEY", "")
 
     with pytest.raises(ValueError):
-        validate_settings()
+        validate_settings(valid_settings)
 
-def test_validate_settings_invalid_redis_host():
-    settings.IPQS_API_KEY = "test_key"
-    settings.REDIS_HOST = ""
-    settings.REDIS_PORT = 6379
-    settings.RISK_THRESHOLD_HIGH = 80.0
-    settings.RISK_THRESHOLD_MEDIUM = 50.0
-    settings.RISK_THRESHOLD_LOW = 20.0
+def test_validate_settings_invalid_redis_host(valid_settings, monkeypatch):
+    monkeypatch.setattr(valid_settings, "REDIS_HOST", "")
 
     with pytest.raises(ValueError):
-        validate_settings()
-
-def test_validate_settings_invalid_redis_port():
-    settings.IPQS_API_KEY = "test_key"
-    settings.REDIS_HOST = "localhost"
-    settings.REDIS_PORT = "invalid"
-    settings.RISK_THRESHOLD_HIGH = 80.0
-    settings.RISK_THRESHOLD_MEDIUM = 50.0
-    settings.RISK_THRESHOLD_LOW = 20.0
+        validate_settings(valid_settings)
+
+def test_validate_settings_invalid_redis_port(valid_settings, monkeypatch):
+    monkeypatch.setattr(valid_settings, "REDIS_PORT", "invalid")
     with pytest.raises(ValueError):
-        validate_settings()
-        
-def test_validate_settings_invalid_risk_threshold():
-    settings.IPQS_API_KEY = "test_key"
-    settings.REDIS_HOST = "localhost"
-    settings.REDIS_PORT = 6379
-    settings.RISK_THRESHOLD_HIGH = "invalid"
-    settings.RISK_THRESHOLD_MEDIUM = 50.0
-    settings.RISK_THRESHOLD_LOW = 20.0
+        validate_settings(valid_settings)
+
+def test_validate_settings_invalid_risk_threshold(valid_settings, monkeypatch):
+    monkeypatch.setattr(valid_settings, "RISK_THRESHOLD_HIGH", "invalid")
     with pytest.raises(ValueError):
-        validate_settings()
\ No newline at end of file
+        validate_settings(valid_settings)
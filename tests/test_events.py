@@ -0,0 +1,50 @@
+import asyncio
+
+from app.services import events
+
+
+def drain(queue):
+    frames = []
+    while not queue.empty():
+        frames.append(queue.get_nowait())
+    return frames
+
+
+def test_tick_publishes_changed_metrics_and_new_rows(monkeypatch):
+    summaries = iter([{"total_requests": 1, "requests_200": 1}, {"total_requests": 2, "requests_200": 1}])
+    monkeypatch.setattr(events.MetricsCollector, "dashboard_summary", lambda: next(summaries))
+
+    async def run():
+        broadcaster = events.DashboardBroadcaster()
+        queue = broadcaster.subscribe()
+        broadcaster.add_audit_rows([{"ip_address": "192.0.2.1"}])
+        broadcaster.tick()
+        await broadcaster.stop()
+        return drain(queue)
+
+    initial, metrics, logs = asyncio.run(run())
+
+    assert initial.startswith("event: metrics")
+    assert metrics == events.sse_frame("metrics", {"total_requests": 2})
+    assert logs == events.sse_frame("logs", [{"ip_address": "192.0.2.1"}])
+
+
+def test_slow_subscriber_gets_resync_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(events.settings, "DASHBOARD_EVENTS_CLIENT_BUFFER", 2)
+    monkeypatch.setattr(events.MetricsCollector, "dashboard_summary", lambda: {})
+
+    async def run():
+        broadcaster = events.DashboardBroadcaster()
+        slow = broadcaster.subscribe()
+        for n in range(5):
+            broadcaster.publish(events.sse_frame("logs", [n]))
+        await broadcaster.stop()
+        return drain(slow)
+
+    assert asyncio.run(run()) == [events._RESYNC_FRAME, events.sse_frame("logs", [4])]
+
+
+def test_audit_rows_ignored_without_subscribers():
+    broadcaster = events.DashboardBroadcaster()
+    broadcaster.add_audit_rows([{"ip_address": "192.0.2.1"}])
+    assert not broadcaster._audit_rows
@@ -0,0 +1,37 @@
+from app.services.iplists import IPListMatcher, PrefixTrie, normalize_cidr
+
+
+def test_trie_longest_prefix_wins():
+    trie = PrefixTrie(32)
+    trie.insert(0x0A000000, 8, "deny")    # 10.0.0.0/8
+    trie.insert(0x0A010000, 16, "allow")  # 10.1.0.0/16
+
+    assert trie.lookup(0x0A010203) == "allow"
+    assert trie.lookup(0x0A020304) == "deny"
+    assert trie.lookup(0x0B000001) is None
+
+
+def test_matcher_ipv4_and_ipv6():
+    matcher = IPListMatcher([
+        ("198.51.100.0/22", "allow"),
+        ("2001:db8::/32", "deny"),
+        ("2001:db8:1::/48", "allow"),
+    ])
+
+    assert matcher.match("198.51.103.255") == "allow"
+    assert matcher.match("198.51.104.0") is None
+    assert matcher.match("2001:db8:2::1") == "deny"
+    assert matcher.match("2001:db8:1::1") == "allow"
+    assert matcher.match("::ffff:198.51.100.7") == "allow"
+    assert matcher.match("not-an-ip") is None
+
+
+def test_deny_wins_for_identical_network():
+    matcher = IPListMatcher([("203.0.113.0/24", "allow"), ("203.0.113.0/24", "deny")])
+
+    assert matcher.match("203.0.113.9") == "deny"
+
+
+def test_normalize_cidr():
+    assert normalize_cidr(" 203.0.113.77/24 ") == "203.0.113.0/24"
+    assert normalize_cidr("2001:DB8::1") == "2001:db8::1/128"
@@ -0,0 +1,169 @@
+import asyncio
+
+import httpx
+
+from app.services import ipqs
+
+
+def test_concurrent_check_ip_calls_are_coalesced(monkeypatch):
+    monkeypatch.setattr(ipqs.settings, "IPQS_COALESCE_ACROSS_WORKERS", False)
+    service = ipqs.IPQSService()
+    calls = []
+
+    async def fake_fetch(ip_address, user_agent=None):
+        calls.append(ip_address)
+        await asyncio.sleep(0.01)
+        return {"success": True, "fraud_score": 42}
+
+    monkeypatch.setattr(service, "_fetch_ip", fake_fetch)
+
+    async def burst():
+        return await asyncio.gather(*[service.check_ip("203.0.113.7") for _ in range(30)])
+
+    results = asyncio.run(burst())
+
+    assert calls == ["203.0.113.7"]
+    assert all(result["fraud_score"] == 42 for result in results)
+    assert service._ip_lookups._inflight == {}
+
+
+def test_fetch_ip_reuses_pooled_client():
+    service = ipqs.IPQSService()
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.path)
+        return httpx.Response(200, json={"success": True, "fraud_score": 10})
+
+    async def run():
+        service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client = service.client
+        first = await service._fetch_ip("198.51.100.1")
+        second = await service._fetch_ip("198.51.100.2")
+        assert service.client is client
+        await service.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first["fraud_score"] == second["fraud_score"] == 10
+    assert len(requested) == 2
+    assert service.client is None
+    assert service._inflight == 0
+
+
+def test_fetch_ip_timeout_returns_error():
+    service = ipqs.IPQSService()
+
+    def handler(request):
+        raise httpx.ReadTimeout("upstream too slow", request=request)
+
+    async def run():
+        service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await service._fetch_ip("198.51.100.1")
+        finally:
+            await service.close()
+
+    result = asyncio.run(run())
+
+    assert result["error"] == "HTTP error"
+    assert service._inflight == 0
+
+
+def test_fetch_device_errors_are_returned_not_raised():
+    service = ipqs.IPQSService()
+
+    def handler(request):
+        return httpx.Response(503, json={"success": False})
+
+    async def run():
+        service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await service._fetch_device("fp-1")
+        finally:
+            await service.close()
+
+    result = asyncio.run(run())
+
+    assert result["error"] == "HTTP error"
+    assert service._inflight == 0
+
+
+def test_circuit_breaker_opens_and_probes(monkeypatch):
+    monkeypatch.setattr(ipqs.settings, "IPQS_BREAKER_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(ipqs.settings, "IPQS_BREAKER_RESET_TIMEOUT", 30)
+    now = [100.0]
+    monkeypatch.setattr(ipqs.time, "monotonic", lambda: now[0])
+    breaker = ipqs.CircuitBreaker()
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now[0] += 31
+    assert breaker.allow()  # the single half-open probe
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_check_ip_short_circuits_while_open(monkeypatch):
+    service = ipqs.IPQSService()
+    service.breaker.state = "open"
+    service.breaker.opened_at = ipqs.time.monotonic()
+
+    async def unexpected_fetch(*args, **kwargs):
+        raise AssertionError("IPQS must not be called while the circuit is open")
+
+    monkeypatch.setattr(service, "_fetch_ip", unexpected_fetch)
+
+    assert asyncio.run(service.check_ip("198.51.100.1")) == {"error": "Circuit open"}
+
+
+def test_calculate_risk_level_uses_configured_thresholds():
+    service = ipqs.IPQSService()
+
+    assert service.calculate_risk_level({"fraud_score": 80}) == "high"
+    assert service.calculate_risk_level({"fraud_score": 60}) == "medium"
+    assert service.calculate_risk_level({"fraud_score": 10}, {"fraud_score": 55}) == "medium"
+    assert service.calculate_risk_level({}) == "low"
+
+
+def test_breaker_ignores_client_errors_and_cancelled_calls(monkeypatch):
+    monkeypatch.setattr(ipqs.settings, "IPQS_BREAKER_FAILURE_THRESHOLD", 1)
+    service = ipqs.IPQSService()
+    statuses = [403]
+
+    async def handler(request):
+        if not statuses:
+            await asyncio.sleep(10)
+        return httpx.Response(statuses.pop(0), json={"success": False})
+
+    async def run():
+        service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            # Half-open: the probe's 403 neither closes nor reopens the circuit
+            service.breaker.state = "half_open"
+            rejected = await service._fetch_ip("198.51.100.1")
+            probe_freed = service.breaker.allow()
+            service.breaker.release()
+            # Cancelled past the lookup deadline, not an upstream failure
+            try:
+                await asyncio.wait_for(service._fetch_ip("198.51.100.2"), timeout=0.01)
+            except asyncio.TimeoutError:
+                pass
+            return rejected, probe_freed
+        finally:
+            await service.close()
+
+    rejected, probe_freed = asyncio.run(run())
+
+    assert rejected["error"] == "HTTP error"
+    assert probe_freed
+    assert service.breaker.state == "half_open"
+    assert service.breaker.failures == 0
+    assert service._inflight == 0
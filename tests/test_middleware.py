@@ -0,0 +1,124 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app import middleware
+from app.services import ratelimit
+
+
+async def _call(app, path="/hello", client="203.0.113.9"):
+    scope = {
+        "type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [(b"host", b"testserver")], "client": (client, 1234), "server": ("testserver", 80),
+        "scheme": "http", "root_path": "",
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+
+async def _ok(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def test_locally_held_low_risk_verdict_needs_no_awaited_lookup(monkeypatch):
+    verdict = {"ip_address": "203.0.113.9", "risk_level": "low"}
+    monkeypatch.setattr(middleware.ip_lists, "match", lambda ip: None)
+    monkeypatch.setattr(middleware.cache_service, "local_decision", lambda ip: (False, {"fraud_score": 0}))
+    monkeypatch.setattr(middleware.cache_service, "get_decision", AsyncMock())
+    monkeypatch.setattr(middleware.verdict_service, "resolve_cached", lambda *args: verdict)
+    monkeypatch.setattr(middleware.verdict_service, "resolve_miss", AsyncMock())
+    monkeypatch.setattr(middleware, "log_request_nowait", lambda verdict, action: True)
+    monkeypatch.setattr(middleware.rate_limiter, "check_nowait", lambda ip, level: 0)
+
+    assert asyncio.run(_call(middleware.ShieldMiddleware(_ok))) == 200
+    middleware.cache_service.get_decision.assert_not_awaited()
+    middleware.verdict_service.resolve_miss.assert_not_awaited()
+
+
+def test_high_risk_verdict_is_denied(monkeypatch):
+    verdict = {"ip_address": "203.0.113.9", "risk_level": "high"}
+    monkeypatch.setattr(middleware.ip_lists, "match", lambda ip: None)
+    monkeypatch.setattr(middleware.cache_service, "local_decision", lambda ip: None)
+    monkeypatch.setattr(middleware.cache_service, "get_decision", AsyncMock(return_value=(False, None)))
+    monkeypatch.setattr(middleware.verdict_service, "resolve_cached", lambda *args: None)
+    monkeypatch.setattr(middleware.verdict_service, "resolve_miss", AsyncMock(return_value=verdict))
+    monkeypatch.setattr(middleware, "log_request_nowait", lambda verdict, action: True)
+    app = AsyncMock()
+
+    assert asyncio.run(_call(middleware.ShieldMiddleware(app))) == 403
+    app.assert_not_awaited()
+
+
+def test_admin_paths_are_not_shielded(monkeypatch):
+    monkeypatch.setattr(middleware.ip_lists, "match", lambda ip: "deny")
+
+    assert asyncio.run(_call(middleware.ShieldMiddleware(_ok), path="/admin/logs")) == 200
+
+
+def _scope(app, path):
+    return {"type": "http", "method": "GET", "path": path, "root_path": "", "app": app}
+
+
+def test_endpoint_labels_use_route_templates_even_before_routing():
+    from fastapi import FastAPI
+
+    app = FastAPI()
+    app.post("/admin/whitelist/{ip_address}")(lambda ip_address: None)
+    labels = middleware.EndpointLabels(max_labels=10)
+
+    assert labels.label(_scope(app, "/admin/whitelist/203.0.113.9")) == "/admin/whitelist/{ip_address}"
+    assert labels.label(_scope(app, "/admin/whitelist/2001:db8::1")) == "/admin/whitelist/{ip_address}"
+
+
+def test_endpoint_labels_normalize_unrouted_paths():
+    labels = middleware.EndpointLabels(max_labels=10)
+
+    assert labels.label(_scope(None, "/users/12345/orders")) == "/users/{id}/orders"
+    assert labels.label(_scope(None, "/lookup/203.0.113.9")) == "/lookup/{ip}"
+    assert labels.label(_scope(None, "/s/3f2b9c1e-7d4a-4b8e-9f00-1a2b3c4d5e6f")) == "/s/{token}"
+    assert labels.label(_scope(None, "/a/b/c/d/e")) == "/a/b/c/*"
+
+
+def test_endpoint_labels_are_capped(monkeypatch):
+    overflow = []
+    monkeypatch.setattr(middleware.MetricsCollector, "record_endpoint_overflow", lambda: overflow.append(1))
+    labels = middleware.EndpointLabels(max_labels=2)
+
+    assert labels.label(_scope(None, "/a")) == "/a"
+    assert labels.label(_scope(None, "/b")) == "/b"
+    assert labels.label(_scope(None, "/c")) == middleware.OVERFLOW_ENDPOINT
+    assert labels.label(_scope(None, "/c")) == middleware.OVERFLOW_ENDPOINT
+    assert labels.label(_scope(None, "/a")) == "/a"
+    assert len(overflow) == 2
+
+
+def test_challenged_clients_are_rate_limited_with_the_default_config(monkeypatch, fake_cache):
+    pytest.importorskip("lupa")
+    verdict = {"ip_address": "203.0.113.9", "risk_level": "medium"}
+    monkeypatch.setattr(middleware.ip_lists, "match", lambda ip: None)
+    monkeypatch.setattr(middleware.cache_service, "local_decision", lambda ip: (False, verdict))
+    monkeypatch.setattr(middleware.verdict_service, "resolve_cached", lambda *args: verdict)
+    monkeypatch.setattr(middleware, "log_request_nowait", lambda verdict, action: True)
+    monkeypatch.setattr(ratelimit, "cache_service", fake_cache)
+    monkeypatch.setattr(middleware, "rate_limiter", ratelimit.RateLimiter())
+    burst = middleware.settings.RATE_LIMITS["medium"]["ip_burst"]
+    app = AsyncMock()
+
+    async def run():
+        return [await _call(middleware.ShieldMiddleware(app)) for _ in range(int(burst) + 1)]
+
+    statuses = asyncio.run(run())
+
+    assert middleware.settings.CHALLENGE_ENABLED
+    assert statuses == [200] * int(burst) + [429]
+    app.assert_not_awaited()
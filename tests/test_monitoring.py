@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+from app.config import monitoring
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RECORD = """
+from app.config.monitoring import MetricsCollector
+MetricsCollector.record_request("GET", "/", 200)
+MetricsCollector.record_request("GET", "/", 403)
+MetricsCollector.record_latency("/", 0.5)
+MetricsCollector.record_cache_hit()
+MetricsCollector.set_whitelisted_ips(3)
+"""
+
+SUMMARY = """
+import json
+from app.config.monitoring import MetricsCollector
+print(json.dumps(MetricsCollector.admin_summary()))
+"""
+
+
+def _python(code, env):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def test_admin_summary_reads_this_process():
+    before = monitoring.MetricsCollector.admin_summary()
+    monitoring.MetricsCollector.record_request("GET", "/", 403)
+    monitoring.MetricsCollector.record_blocked_ip()
+    after = monitoring.MetricsCollector.admin_summary()
+
+    assert after["requests"]["total"] == before["requests"]["total"] + 1
+    assert after["requests"]["by_status"]["403"] == before["requests"]["by_status"]["403"] + 1
+    assert after["security"]["blocked_ips"] == before["security"]["blocked_ips"] + 1
+
+
+def test_admin_summary_sums_workers_in_multiprocess_mode(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    _python(RECORD, env)
+    _python(RECORD, env)
+
+    summary = json.loads(_python(SUMMARY, env))
+
+    assert summary["requests"]["total"] == 4
+    assert summary["requests"]["by_status"] == {"200": 2, "403": 2, "500": 0}
+    assert summary["performance"]["avg_latency"] == 0.5
+    assert summary["performance"]["cache_hit_rate"] == 1
+    # Every worker reports the same whitelist size; it is not summed
+    assert summary["security"]["whitelisted_ips"] == 3
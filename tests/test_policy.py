@@ -0,0 +1,168 @@
+import asyncio
+import json
+import random
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.services import policy
+
+POLICY = {
+    "rules": [
+        {"name": "tor", "action": "block", "tor": True},
+        {"name": "vpn from RU", "action": "challenge", "vpn": True, "country": ["ru", "KP"]},
+        {"name": "risky proxy", "action": "block", "proxy": True, "score_gt": 85},
+        {"name": "trusted home", "action": "allow", "country": "NZ", "score_lt": 90},
+        {"name": "high score", "action": "block", "score_gte": 75},
+        {"name": "medium score outside US", "action": "challenge", "not_country": "US", "score_gte": 50},
+    ],
+    "default": "allow",
+}
+
+
+def reference(document, score, proxy, vpn, tor, country):
+    """Straightforward first-match evaluation the compiled policy must agree with"""
+    features = {"proxy": proxy, "vpn": vpn, "tor": tor}
+    for rule in document["rules"]:
+        if any(features[flag] != rule[flag] for flag in policy.FLAGS if flag in rule):
+            continue
+        if "country" in rule:
+            codes = [rule["country"]] if isinstance(rule["country"], str) else rule["country"]
+            if country not in [code.upper() for code in codes]:
+                continue
+        if "not_country" in rule:
+            codes = [rule["not_country"]] if isinstance(rule["not_country"], str) else rule["not_country"]
+            if country in [code.upper() for code in codes]:
+                continue
+        if not all(policy.SCORE_TESTS[key](score, rule[key]) for key in policy.SCORE_TESTS if key in rule):
+            continue
+        return policy.ACTIONS[rule["action"]]
+    return policy.ACTIONS[document.get("default", "allow")]
+
+
+def test_rules_apply_first_match_first():
+    compiled = policy.CompiledPolicy(POLICY)
+
+    assert compiled.decide(0, False, False, True, "US") == "high"
+    assert compiled.decide(10, False, True, False, "RU") == "medium"
+    assert compiled.decide(10, False, True, False, "DE") == "low"
+    assert compiled.decide(86, True, False, False, "US") == "high"
+    assert compiled.decide(70, True, False, False, "US") == "low"
+    assert compiled.decide(80, False, False, False, "NZ") == "low"
+    assert compiled.decide(80, False, False, False, "US") == "high"
+    assert compiled.decide(60, False, False, False, "US") == "low"
+    assert compiled.decide(60, False, False, False, None) == "medium"
+
+
+def test_compiled_policy_matches_reference_evaluation():
+    compiled = policy.CompiledPolicy(POLICY)
+    rng = random.Random(7)
+    countries = ["US", "RU", "KP", "NZ", "DE", None]
+    for _ in range(5000):
+        score = rng.choice([rng.randint(-5, 110), round(rng.uniform(0, 100), 2), 85, 85.5, 75.0])
+        features = (score, rng.random() < 0.3, rng.random() < 0.3, rng.random() < 0.2, rng.choice(countries))
+        assert compiled.decide(*features) == reference(POLICY, *features), features
+
+
+def test_default_policy_is_the_threshold_bands(monkeypatch):
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_HIGH", 80.0)
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_MEDIUM", 40.0)
+    compiled = policy.CompiledPolicy(policy.default_document())
+
+    assert [compiled.decide(score, False, False, False, "US") for score in (39, 40, 79, 80)] == \
+        ["low", "medium", "medium", "high"]
+    assert compiled.version == 0
+
+
+@pytest.mark.parametrize("document", [
+    [],
+    {"rules": [{"action": "deny"}]},
+    {"rules": [{"action": "block", "tor": "yes"}]},
+    {"rules": [{"action": "block", "score_gt": "85"}]},
+    {"rules": [{"action": "block", "country": []}]},
+    {"rules": [{"action": "block", "asn": 13335}]},
+    {"rules": [], "default": "drop"},
+])
+def test_invalid_policies_are_rejected(document):
+    with pytest.raises(policy.PolicyError):
+        policy.CompiledPolicy(document)
+
+
+def test_decisions_are_table_lookups():
+    compiled = policy.CompiledPolicy(POLICY)
+    decide = compiled.decide
+    rounds = 200000
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decide(60, False, True, False, "RU")
+    per_decision = (time.perf_counter() - start) / rounds
+
+    # Generous bound for slow CI machines; typically well under a microsecond
+    assert per_decision < 5e-6
+
+
+def test_publish_stores_validates_and_reloads(monkeypatch):
+    # The default document is compiled from the global thresholds, which other tests reassign
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_HIGH", 75.0)
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_MEDIUM", 50.0)
+    rows = []
+
+    async def execute(query):
+        rows.append(query.compile().params["document"])
+        return len(rows)
+
+    async def fetch_one(query):
+        return {"id": len(rows), "document": rows[-1]} if rows else None
+
+    monkeypatch.setattr(policy.database, "execute", execute)
+    monkeypatch.setattr(policy.database, "fetch_one", fetch_one)
+    publish = AsyncMock()
+    monkeypatch.setattr(policy.cache_service, "publish_invalidation", publish)
+    service = policy.RiskPolicyService()
+
+    async def run():
+        await service.load()
+        before = service.policy
+        with pytest.raises(policy.PolicyError):
+            await service.publish({"rules": [{"action": "explode"}]})
+        described = await service.publish(POLICY, comment="block tor")
+        return before, described
+
+    before, described = asyncio.run(run())
+
+    assert before.version == 0 and len(rows) == 1
+    assert described == {"version": 1, "policy": POLICY}
+    assert json.loads(rows[0]) == POLICY
+    assert service.decide(0, False, False, True, "US") == "high"
+    publish.assert_awaited_once_with(policy.RELOAD_KEY)
+
+
+def test_dry_run_replays_cached_verdicts(monkeypatch):
+    # The default document is compiled from the global thresholds, which other tests reassign
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_HIGH", 75.0)
+    monkeypatch.setattr(policy.settings, "RISK_THRESHOLD_MEDIUM", 50.0)
+    cached = [
+        ("ip:198.51.100.1", {"ip_address": "198.51.100.1", "risk_score": 10, "is_tor": True, "country_code": "US"}),
+        ("ip:198.51.100.2", {"ip_address": "198.51.100.2", "risk_score": 80, "country_code": "NZ"}),
+        ("ip:198.51.100.3", {"ip_address": "198.51.100.3", "risk_score": 20, "country_code": "US"}),
+        ("ip:198.51.100.4", None),
+    ]
+
+    async def scan(pattern, limit):
+        assert pattern == "ip:*"
+        for item in cached[:limit]:
+            yield item
+
+    monkeypatch.setattr(policy.cache_service, "scan", scan)
+    service = policy.RiskPolicyService()
+
+    report = asyncio.run(service.dry_run(POLICY, 10))
+
+    assert report["current_version"] == 0
+    assert report["evaluated"] == 3
+    assert report["changed"] == 2
+    assert report["transitions"] == {"low->high": 1, "high->low": 1}
+    assert report["levels"]["candidate"] == {"high": 1, "low": 2}
+    assert {sample["ip_address"] for sample in report["samples"]} == {"198.51.100.1", "198.51.100.2"}
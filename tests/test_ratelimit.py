@@ -0,0 +1,44 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+from app.services import ratelimit
+
+
+def test_subnet_of():
+    assert ratelimit.subnet_of("203.0.113.77") == "203.0.113.0/24"
+    assert ratelimit.subnet_of("2001:db8:1:2:3::4") == "2001:db8:1:2::/64"
+
+
+def test_unconfigured_risk_level_is_not_limited(monkeypatch):
+    eval_script = AsyncMock()
+    monkeypatch.setattr(ratelimit.cache_service, "eval_script", eval_script)
+    limiter = ratelimit.RateLimiter()
+
+    assert asyncio.run(limiter.check("203.0.113.1", "low")) == 0
+    eval_script.assert_not_awaited()
+
+
+def test_over_limit_client_is_rejected_locally(monkeypatch):
+    eval_script = AsyncMock(side_effect=[0, 1500])
+    monkeypatch.setattr(ratelimit.cache_service, "eval_script", eval_script)
+    limiter = ratelimit.RateLimiter()
+
+    async def run():
+        return [await limiter.check("203.0.113.1", "medium") for _ in range(3)]
+
+    allowed, limited, limited_locally = asyncio.run(run())
+
+    assert allowed == 0
+    assert limited == 1.5
+    assert 0 < limited_locally <= 1.5
+    assert eval_script.await_count == 2
+    keys = eval_script.await_args.args[1]
+    assert keys == ["ratelimit:medium:{203.0.113.0/24}:ip:203.0.113.1", "ratelimit:medium:{203.0.113.0/24}:net"]
+    assert limiter.retry_after_header(limited) == {"Retry-After": "2"}
+
+
+def test_redis_unavailable_fails_open(monkeypatch):
+    monkeypatch.setattr(ratelimit.cache_service, "eval_script", AsyncMock(return_value=None))
+    limiter = ratelimit.RateLimiter()
+
+    assert asyncio.run(limiter.check("203.0.113.1", "medium")) == 0
@@ -0,0 +1,180 @@
+import asyncio
+import os
+
+import pytest
+from redis import asyncio as aioredis
+from redis import exceptions as redis_exceptions
+
+from app.services import redis_client
+from app.services.cache import CacheService
+from app.services.ratelimit import RateLimiter
+
+
+def fake_shards(count):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return [fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True) for _ in range(count)]
+
+
+def test_hash_slot_key_uses_first_non_empty_tag():
+    assert redis_client.hash_slot_key("ratelimit:medium:{203.0.113.0/24}:net") == "203.0.113.0/24"
+    assert redis_client.hash_slot_key("ip:203.0.113.1") == "ip:203.0.113.1"
+    assert redis_client.hash_slot_key("a:{}:b") == "a:{}:b"
+
+
+def test_hash_ring_spreads_keys_and_moves_few_when_a_shard_is_added():
+    keys = [f"ip:10.0.{i // 256}.{i % 256}" for i in range(20000)]
+    three = redis_client.HashRing(["a", "b", "c"], 160)
+    four = redis_client.HashRing(["a", "b", "c", "d"], 160)
+
+    placed = [three.index_for(key) for key in keys]
+    for index in range(3):
+        assert 0.25 < placed.count(index) / len(keys) < 0.42
+    moved = sum(1 for key, index in zip(keys, placed) if four.index_for(key) != index)
+    # Only keys taken over by the new shard move
+    assert 0.17 < moved / len(keys) < 0.33
+    assert all(four.index_for(key) in (index, 3) for key, index in zip(keys, placed))
+
+
+def test_standalone_client_uses_a_bounded_pool_with_timeouts_and_retry(monkeypatch):
+    monkeypatch.setattr(redis_client.settings, "REDIS_MODE", "standalone")
+    monkeypatch.setattr(redis_client.settings, "REDIS_MAX_CONNECTIONS", 7)
+    monkeypatch.setattr(redis_client.settings, "REDIS_SOCKET_TIMEOUT", 0.2)
+    monkeypatch.setattr(redis_client.settings, "REDIS_RETRY_ATTEMPTS", 4)
+
+    client = redis_client.create_redis()
+    pool = client.connection_pool
+    assert isinstance(pool, aioredis.BlockingConnectionPool)
+    assert pool.max_connections == 7
+    assert pool.connection_kwargs["socket_timeout"] == 0.2
+    assert pool.connection_kwargs["health_check_interval"] == redis_client.settings.REDIS_HEALTH_CHECK_INTERVAL
+    assert pool.connection_kwargs["retry"]._retries == 4
+    asyncio.run(redis_client.close_redis(client))
+
+
+def test_unreachable_redis_is_retried_then_reported(monkeypatch):
+    monkeypatch.setattr(redis_client.settings, "REDIS_MODE", "standalone")
+    monkeypatch.setattr(redis_client.settings, "REDIS_HOST", "127.0.0.1")
+    monkeypatch.setattr(redis_client.settings, "REDIS_PORT", 1)
+    monkeypatch.setattr(redis_client.settings, "REDIS_RETRY_ATTEMPTS", 2)
+    monkeypatch.setattr(redis_client.settings, "REDIS_RETRY_BACKOFF_BASE", 0.001)
+    errors = []
+    monkeypatch.setattr("app.services.cache.MetricsCollector.record_redis_error", errors.append)
+
+    async def run():
+        service = CacheService()
+        service.redis = redis_client.create_redis()
+        attempts = 0
+        connection_class = service.redis.connection_pool.connection_class
+        connect = connection_class._connect
+
+        async def counting_connect(connection):
+            nonlocal attempts
+            attempts += 1
+            return await connect(connection)
+
+        monkeypatch.setattr(connection_class, "_connect", counting_connect)
+        value = await service._execute_redis_command(service.redis.get, "ip:203.0.113.1")
+        await redis_client.close_redis(service.redis)
+        return value, attempts
+
+    value, attempts = asyncio.run(run())
+    assert value is None
+    assert attempts == 3
+    assert errors == ["connection"]
+
+
+def test_sharded_commands_are_routed_by_key():
+    shards = fake_shards(3)
+    redis = redis_client.ShardedRedis(shards, ["a", "b", "c"], 160)
+    keys = [f"ip:203.0.113.{i}" for i in range(30)]
+
+    async def run():
+        pipe = redis.pipeline(transaction=False)
+        for i, key in enumerate(keys):
+            pipe.set(key, str(i), ex=60)
+        pipe.publish("channel", "message")
+        results = await pipe.execute()
+        values = await redis.mget(keys + ["ip:missing"])
+        held = [await shard.dbsize() for shard in shards]
+        on_own_shard = [await redis.shards[redis.ring.index_for(key)].get(key) for key in keys]
+        return results, values, held, on_own_shard
+
+    results, values, held, on_own_shard = asyncio.run(run())
+    assert results == [True] * 30 + [0]
+    assert values == [str(i) for i in range(30)] + [None]
+    assert sum(held) == 30 and all(held)
+    assert on_own_shard == [str(i) for i in range(30)]
+
+
+def test_sharded_scripts_need_keys_on_one_shard():
+    redis = redis_client.ShardedRedis(fake_shards(4), ["a", "b", "c", "d"], 160)
+    script = redis.register_script("return #KEYS")
+    tagged = ["ratelimit:medium:{203.0.113.0/24}:ip:203.0.113.1", "ratelimit:medium:{203.0.113.0/24}:net"]
+    spread = [f"key:{i}" for i in range(20)]
+
+    assert asyncio.run(script(keys=tagged, args=[])) == 2
+    with pytest.raises(redis_exceptions.DataError):
+        asyncio.run(script(keys=spread, args=[]))
+
+
+def test_rate_limiter_over_sharded_redis(monkeypatch):
+    service = CacheService()
+    service.redis = redis_client.ShardedRedis(fake_shards(3), ["a", "b", "c"], 160)
+    service._listener_task = object()
+    monkeypatch.setattr("app.services.ratelimit.cache_service", service)
+    limiter = RateLimiter()
+
+    async def run():
+        return [await limiter.check(f"203.0.113.{i % 3}", "medium") for i in range(15)]
+
+    results = asyncio.run(run())
+    # ip_burst is 5 per IP; the subnet bucket (burst 50) is shared
+    assert results.count(0) == 15
+    assert asyncio.run(limiter.check("203.0.113.0", "medium")) > 0
+
+
+@pytest.mark.skipif(not os.environ.get("REDIS_TEST_SHARD_URLS"), reason="set REDIS_TEST_SHARD_URLS to comma-separated redis:// URLs")
+def test_cache_service_against_local_redis_shards(monkeypatch):
+    """e.g. redis-server --port 7001 & redis-server --port 7002, then
+    REDIS_TEST_SHARD_URLS=redis://localhost:7001/15,redis://localhost:7002/15"""
+    urls = os.environ["REDIS_TEST_SHARD_URLS"].split(",")
+    monkeypatch.setattr(redis_client.settings, "REDIS_MODE", "sharded")
+    monkeypatch.setattr(redis_client.settings, "REDIS_SHARD_URLS", urls)
+
+    async def run():
+        writer, reader = CacheService(), CacheService()
+        await writer.init()
+        await reader.init()
+        # Let both invalidation listeners subscribe
+        await asyncio.sleep(0.2)
+        items = {f"ip:198.51.100.{i}": {"fraud_score": i} for i in range(50)}
+        assert await writer.set_many(items, expire=60)
+        assert await reader.get_many(list(items)) == list(items.values())
+        await writer.set("ip:198.51.100.1", {"fraud_score": 99}, expire=60)
+        await asyncio.sleep(0.2)
+        fresh = await reader.get("ip:198.51.100.1")
+        for key in items:
+            await writer.delete(key)
+        await writer.close()
+        await reader.close()
+        return fresh
+
+    assert asyncio.run(run()) == {"fraud_score": 99}
+
+
+def test_scan_reads_every_shard_up_to_the_limit():
+    service = CacheService()
+    service.redis = redis_client.ShardedRedis(fake_shards(3), ["a", "b", "c"], 160)
+    service._listener_task = object()
+
+    async def run():
+        await service.set_many({f"ip:203.0.113.{i}": {"risk_score": i} for i in range(40)}, expire=60)
+        await service.set("device:fp", {"fraud_score": 1}, expire=60)
+        everything = [item async for item in service.scan("ip:*", 100, batch=7)]
+        limited = [item async for item in service.scan("ip:*", 25, batch=7)]
+        return everything, limited
+
+    everything, limited = asyncio.run(run())
+    assert sorted(value["risk_score"] for _, value in everything) == list(range(40))
+    assert len(limited) == 25
@@ -0,0 +1,49 @@
+import asyncio
+from datetime import datetime, timezone
+
+from app.services import reports
+
+
+def make_row(ip, action, country, score, minute):
+    return {"ip_address": ip, "action_taken": action, "country_code": country, "risk_score": score,
+            "timestamp": datetime(2026, 5, 9, 10, minute, 30, tzinfo=timezone.utc)}
+
+
+def test_risk_bucket():
+    assert [reports.risk_bucket(score) for score in (0, 24, 25, 74.9, 75, 100, None)] == [0, 0, 25, 50, 75, 75, 0]
+
+
+def test_rollups_accumulate_across_batches(run_with_db):
+    async def body(db):
+        service = reports.AuditReports()
+        await service.record([make_row("192.0.2.1", "high", "US", 90, 1), make_row("192.0.2.1", "high", "US", 95, 1)])
+        await service.record([make_row("192.0.2.2", "low", "DE", 10, 2), make_row("192.0.2.1", "high", "US", 80, 59)])
+        since = datetime(2026, 5, 9, tzinfo=timezone.utc)
+        return (
+            await service.timeseries("minute", "action_taken", since),
+            await service.timeseries("hour", "country_code", since),
+            await service.top_ips(since, action="high"),
+        )
+
+    minutes, hours, top = run_with_db(body, reports)
+
+    assert [(row["bucket_start"].minute, row["action_taken"], row["count"]) for row in minutes] == \
+        [(1, "high", 2), (2, "low", 1), (59, "high", 1)]
+    assert [(row["country_code"], row["count"]) for row in hours] == [("DE", 1), ("US", 3)]
+    assert top == [{"ip_address": "192.0.2.1", "count": 3}]
+
+
+def test_logs_keyset_pagination_with_filters(run_with_db):
+    async def body(db):
+        rows = [make_row(f"192.0.2.{n % 2}", "high", "US", 90, n) for n in range(7)]
+        await db.execute_many(query=reports.AuditLog.__table__.insert(), values=rows)
+        service = reports.AuditReports()
+        pages, cursor = [], None
+        while True:
+            page = await service.logs(ip="192.0.2.0", cursor=cursor, limit=2)
+            pages.append([log["id"] for log in page["logs"]])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return pages
+
+    assert run_with_db(body, reports) == [[7, 5], [3, 1]]
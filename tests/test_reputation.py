@@ -0,0 +1,68 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+from app.services import reputation, verdicts
+
+FEED = [
+    "# datacenter ranges",
+    "203.0.113.0/24,90,datacenter|proxy",
+    "198.51.100.10-198.51.100.20,70,vpn",
+    "198.51.100.15,10,",
+    '{"ip": "192.0.2.7", "fraud_score": 100, "tor": true}',
+    "2001:db8::/48,80,tor",
+    "not-a-network,50,",
+    "192.0.2.0/24,50,unknownflag",
+]
+
+
+def test_snapshot_range_lookups(tmp_path):
+    path = str(tmp_path / "reputation.bin")
+    summary = reputation.write_snapshot(path, FEED)
+    snapshot = reputation.ReputationSnapshot(path)
+
+    assert summary["ranges"] == 4
+    assert summary["invalid_count"] == 2
+    assert snapshot.lookup("203.0.113.77") == {"fraud_score": 90, "proxy": True, "vpn": False,
+                                                "tor": False, "datacenter": True}
+    # Overlapping ranges: the one starting first keeps the overlap
+    assert snapshot.lookup("198.51.100.15")["fraud_score"] == 70
+    assert snapshot.lookup("198.51.100.21") is None
+    assert snapshot.lookup("192.0.2.7")["tor"] is True
+    assert snapshot.lookup("192.0.2.8") is None
+    assert snapshot.lookup("2001:db8:0:ffff::1")["fraud_score"] == 80
+    assert snapshot.lookup("::ffff:203.0.113.1")["fraud_score"] == 90
+    assert snapshot.lookup("2001:db9::1") is None
+    assert snapshot.lookup("garbage") is None
+
+
+def test_store_swaps_in_new_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(reputation.settings, "REPUTATION_SNAPSHOT_PATH", str(tmp_path / "reputation.bin"))
+    monkeypatch.setattr(reputation.cache_service, "publish_invalidation", AsyncMock())
+    store = reputation.ReputationStore()
+
+    async def run():
+        await store.load()
+        assert store.lookup("203.0.113.1") is None
+        await store.import_feed(["203.0.113.0/24,90,"])
+        first = store.lookup("203.0.113.1")
+        await store.import_feed(["203.0.113.0/24,20,"])
+        return first, store.lookup("203.0.113.1")
+
+    first, second = asyncio.run(run())
+
+    assert first["fraud_score"] == 90
+    assert second["fraud_score"] == 20
+
+
+def test_resolve_prefers_local_snapshot(monkeypatch):
+    monkeypatch.setattr(verdicts.reputation_store, "lookup", lambda ip: {"fraud_score": 95, "tor": True})
+    monkeypatch.setattr(verdicts.ipqs_service, "calculate_risk_level", lambda ip_data, device_data: "high")
+    check_ip = AsyncMock()
+    monkeypatch.setattr(verdicts.ipqs_service, "check_ip", check_ip)
+
+    verdict = asyncio.run(verdicts.VerdictService().resolve("192.0.2.7", None, "ua"))
+
+    assert verdict["risk_level"] == "high"
+    assert verdict["is_tor"] is True
+    assert verdict["source"] == "local"
+    check_ip.assert_not_awaited()
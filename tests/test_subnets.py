@@ -0,0 +1,87 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from app.services import subnets, verdicts
+from app.services.policy import CompiledPolicy, default_document
+
+RULES = [
+    {"risk_level": "high", "min_ips": 3, "min_share": 0.5},
+    {"risk_level": "low", "min_ips": 4, "min_share": 1.0},
+]
+
+
+def make_verdict(ip, risk_level):
+    return {"ip_address": ip, "risk_score": 90 if risk_level == "high" else 10, "is_proxy": False,
+            "is_vpn": False, "is_tor": False, "country_code": "US", "risk_level": risk_level,
+            "policy_version": 0, "expires_at": 0}
+
+
+@pytest.fixture
+def fake_service(fake_cache, monkeypatch):
+    pytest.importorskip("lupa")
+    monkeypatch.setattr(subnets, "cache_service", fake_cache)
+    monkeypatch.setattr(subnets.settings, "SUBNET_VERDICTS_ENABLED", True)
+    monkeypatch.setattr(subnets.settings, "SUBNET_PROMOTION_RULES", RULES)
+    return fake_cache
+
+
+def test_promotion_rules_apply_first_match_first(monkeypatch):
+    monkeypatch.setattr(subnets.settings, "SUBNET_PROMOTION_RULES", RULES)
+
+    assert subnets.promoted_level(Counter(high=3, low=3)) == "high"
+    assert subnets.promoted_level(Counter(high=3, low=4)) is None
+    assert subnets.promoted_level(Counter(high=2)) is None
+    assert subnets.promoted_level(Counter(low=4)) == "low"
+    assert subnets.promoted_level(Counter(low=4, medium=1)) is None
+
+
+def test_prefix_is_promoted_then_demoted(fake_service):
+    async def run():
+        for host in (1, 2):
+            await subnets.subnet_verdicts.record(make_verdict(f"203.0.113.{host}", "high"))
+        before = await fake_service.get_decision("203.0.113.200")
+        await subnets.subnet_verdicts.record(make_verdict("203.0.113.3", "high"))
+        promoted = await fake_service.get_decision("203.0.113.200")
+        for host in range(4, 11):
+            await subnets.subnet_verdicts.record(make_verdict(f"203.0.113.{host}", "low"))
+        demoted = await fake_service.get_decision("203.0.113.201")
+        ttl = await fake_service.redis.pttl("subnet:{203.0.113.0/24}:ips")
+        return before, promoted, demoted, ttl
+
+    before, promoted, demoted, ttl = asyncio.run(run())
+    assert before == (False, None)
+    assert promoted[1]["subnet"] == "203.0.113.0/24"
+    assert promoted[1]["risk_level"] == "high"
+    assert "expires_at" not in promoted[1]
+    assert demoted == (False, None)
+    assert 0 < ttl <= subnets.settings.SUBNET_TALLY_WINDOW * 1000
+
+
+def test_tally_is_bounded_and_counts_each_ip_once(fake_service, monkeypatch):
+    monkeypatch.setattr(subnets.settings, "SUBNET_TALLY_MAX_IPS", 2)
+
+    async def run():
+        for _ in range(5):
+            await subnets.subnet_verdicts.record(make_verdict("2001:db8::1", "high"))
+        for host in (2, 3):
+            await subnets.subnet_verdicts.record(make_verdict(f"2001:db8::{host}", "high"))
+        return await fake_service.redis.hgetall("subnet:{2001:db8::/64}:ips")
+
+    assert asyncio.run(run()) == {"2001:db8::1": "high", "2001:db8::2": "high"}
+
+
+def test_prefix_verdict_is_served_for_its_ips_under_the_same_policy(monkeypatch):
+    # The default document is compiled from the global thresholds, which other tests reassign
+    monkeypatch.setattr(verdicts.settings, "RISK_THRESHOLD_HIGH", 75.0)
+    monkeypatch.setattr(verdicts.settings, "RISK_THRESHOLD_MEDIUM", 50.0)
+    aggregated = dict(make_verdict("203.0.113.1", "high"), subnet="203.0.113.0/24")
+    service = verdicts.VerdictService()
+
+    served = service.resolve_cached("203.0.113.77", aggregated, "ua")
+    assert served["ip_address"] == "203.0.113.77" and served["risk_level"] == "high"
+    assert aggregated["ip_address"] == "203.0.113.1"
+
+    monkeypatch.setattr(verdicts.risk_policy, "policy", CompiledPolicy(default_document(), 3))
+    assert service.resolve_cached("203.0.113.77", aggregated, "ua") is None
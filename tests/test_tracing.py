@@ -0,0 +1,70 @@
+import asyncio
+import json
+import time
+
+from app.services import profiler, tracing
+
+
+def test_sampled_request_is_exported_as_otlp_json(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing.settings, "TRACING_ENABLED", True)
+    monkeypatch.setattr(tracing.settings, "TRACING_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(tracing.settings, "TRACING_EXPORT", "file")
+    monkeypatch.setattr(tracing.settings, "TRACING_FILE", str(tmp_path / "traces.jsonl"))
+    stages = []
+    monkeypatch.setattr(tracing.MetricsCollector, "record_stage", lambda stage, duration: stages.append(stage))
+    tracer = tracing.Tracer()
+
+    async def run():
+        token = tracer.start_request()
+        with tracer.stage("cache_local"):
+            pass
+        with tracer.stage("cache_redis"):
+            await asyncio.sleep(0)
+        tracer.finish_request(token, "GET /", {"http.response.status_code": 200})
+        return await tracer.export()
+
+    assert asyncio.run(run()) == 1
+    assert stages == ["cache_local", "cache_redis"]
+    payload = json.loads((tmp_path / "traces.jsonl").read_text())
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    root, *children = spans
+    assert root["name"] == "GET /" and "parentSpanId" not in root
+    assert root["attributes"] == [{"key": "http.response.status_code", "value": {"intValue": "200"}}]
+    assert [span["name"] for span in children] == ["cache_local", "cache_redis"]
+    assert all(span["traceId"] == root["traceId"] and span["parentSpanId"] == root["spanId"] for span in children)
+    assert all(int(span["endTimeUnixNano"]) >= int(span["startTimeUnixNano"]) for span in spans)
+
+
+def test_unsampled_requests_only_feed_stage_metrics(monkeypatch):
+    monkeypatch.setattr(tracing.settings, "TRACING_ENABLED", False)
+    stages = []
+    monkeypatch.setattr(tracing.MetricsCollector, "record_stage", lambda stage, duration: stages.append(stage))
+    tracer = tracing.Tracer()
+
+    assert tracer.start_request() is None
+    with tracer.stage("ip_lists"):
+        pass
+    assert stages == ["ip_lists"]
+    assert asyncio.run(tracer.export()) == 0
+
+
+def _busy_loop_for_profile(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_profiler_returns_collapsed_stacks_of_the_loop_thread():
+    async def run():
+        sampler = profiler.SamplingProfiler()
+        profile = asyncio.ensure_future(sampler.profile(0.2, 0.005))
+        await asyncio.sleep(0.02)
+        _busy_loop_for_profile(0.15)
+        return await profile
+
+    lines = asyncio.run(run()).splitlines()
+
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("_busy_loop_for_profile" in line for line in lines)
@@ -0,0 +1,132 @@
+import asyncio
+import random
+from collections import Counter
+
+import pytest
+
+from app.services import traffic
+from app.services.cache import CacheService
+
+
+def stream(count, seed=1):
+    rng = random.Random(seed)
+    heavy = ["203.0.113.5", "198.51.100.9", "2001:db8::7"]
+    ips = []
+    for _ in range(count):
+        r = rng.random()
+        ips.append(heavy[0] if r < 0.05 else heavy[1] if r < 0.08 else heavy[2] if r < 0.1
+                   else f"10.{rng.randrange(4)}.{rng.randrange(256)}.{rng.randrange(256)}")
+    return ips
+
+
+def test_count_min_never_undercounts_and_merges_exactly():
+    ips = stream(20000)
+    first, second, whole = traffic.TrafficSketch(), traffic.TrafficSketch(), traffic.TrafficSketch()
+    for position, ip in enumerate(ips):
+        (first if position % 2 else second).add(ip)
+        whole.add(ip)
+    first.merge(second)
+
+    assert first.ips.cms.counts == whole.ips.cms.counts
+    assert first.requests == 20000
+    true_counts = Counter(ips)
+    for ip in list(true_counts)[:500]:
+        estimate = whole.ips.cms.estimate(*traffic._hash(ip))
+        # Within e/width of the traffic, with high probability
+        assert true_counts[ip] <= estimate <= true_counts[ip] + 0.002 * len(ips)
+
+
+def test_top_talkers_and_distinct_counts():
+    ips = stream(50000)
+    sketch = traffic.TrafficSketch()
+    for ip in ips:
+        sketch.add(ip)
+
+    assert [ip for ip, _ in sketch.ips.top(3)] == ["203.0.113.5", "198.51.100.9", "2001:db8::7"]
+    assert sketch.subnets.top(1)[0][0] == "203.0.113.0/24"
+    for estimate, keys in ((sketch.ips.hll.estimate(), ips), (sketch.subnets.hll.estimate(), map(traffic.subnet_of, ips))):
+        distinct = len(set(keys))
+        assert abs(estimate - distinct) < 0.05 * distinct
+
+
+def test_sketch_survives_serialization():
+    sketch = traffic.TrafficSketch()
+    for ip in stream(2000):
+        sketch.add(ip)
+    copy = traffic.TrafficSketch.loads(sketch.dumps())
+
+    assert copy.requests == sketch.requests
+    assert copy.ips.cms.counts == sketch.ips.cms.counts
+    assert copy.subnets.hll.registers == sketch.subnets.hll.registers
+    assert copy.ips.top(3) == sketch.ips.top(3)
+
+
+def test_workers_are_merged_through_redis_over_the_window(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    now = [1_000_000.0]
+    monkeypatch.setattr(traffic.time, "time", lambda: now[0])
+    monkeypatch.setattr(traffic.settings, "TRAFFIC_BUCKET_SECONDS", 10)
+    monkeypatch.setattr(traffic.settings, "TRAFFIC_WINDOWS", [60, 300])
+
+    def worker():
+        service = CacheService()
+        service.redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        service._listener_task = object()
+        return service, traffic.TrafficAnalytics()
+
+    async def run():
+        (first_cache, first), (second_cache, second) = worker(), worker()
+        monkeypatch.setattr(traffic, "cache_service", first_cache)
+        for _ in range(30):
+            first.record("203.0.113.5")
+        now[0] += 120
+        for _ in range(5):
+            first.record("198.51.100.1")
+        await first.flush()
+        monkeypatch.setattr(traffic, "cache_service", second_cache)
+        for host in range(20):
+            second.record(f"198.51.100.{host}")
+        return await second.summary(60), await second.summary(300)
+
+    recent, longer = asyncio.run(run())
+    assert recent["requests"] == 25
+    assert recent["distinct_ips"] == 20
+    assert recent["top_ips"][0] == {"ip": "198.51.100.1", "requests": 6}
+    assert recent["top_subnets"] == [{"subnet": "198.51.100.0/24", "requests": 25}]
+    assert longer["requests"] == 55
+    assert longer["top_ips"][0] == {"ip": "203.0.113.5", "requests": 30}
+
+
+def test_closed_buckets_are_kept_while_redis_is_down(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(traffic.time, "time", lambda: now[0])
+    writes = []
+
+    async def set_field(key, field, value, expire):
+        writes.append(key)
+        return False
+
+    monkeypatch.setattr(traffic.cache_service, "set_field", set_field)
+    analytics = traffic.TrafficAnalytics()
+    for _ in range(10):
+        analytics.record("203.0.113.5")
+        now[0] += traffic.settings.TRAFFIC_BUCKET_SECONDS
+
+    asyncio.run(analytics.flush())
+    # One attempt; the newest closed buckets stay queued, bounded
+    assert len(writes) == 1
+    assert len(analytics._unflushed) == traffic.MAX_UNFLUSHED
+
+
+def test_summary_is_exported_as_gauges_by_rank():
+    from app.config import monitoring
+    summary = {"window": 60, "requests": 7, "distinct_ips": 3, "distinct_subnets": 2,
+               "top_ips": [{"ip": "203.0.113.5", "requests": 5}], "top_subnets": []}
+
+    monitoring.MetricsCollector.set_traffic_summary(summary, 3)
+
+    top = monitoring.TRAFFIC_TOP_REQUESTS
+    assert monitoring.TRAFFIC_REQUESTS.labels(window="60s")._value.get() == 7
+    assert monitoring.TRAFFIC_DISTINCT.labels(window="60s", kind="subnets")._value.get() == 2
+    assert [top.labels(window="60s", kind="ips", rank=str(rank))._value.get() for rank in (1, 2, 3)] == [5, 0, 0]
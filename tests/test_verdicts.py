@@ -0,0 +1,184 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+from app.services import verdicts
+from app.services.policy import CompiledPolicy
+
+
+def test_failed_lookup_is_not_cached_and_falls_back(monkeypatch):
+    monkeypatch.setattr(verdicts.ipqs_service, "check_ip", AsyncMock(return_value={"error": "HTTP error"}))
+    cache_set = AsyncMock()
+    monkeypatch.setattr(verdicts.cache_service, "set", cache_set)
+    monkeypatch.setattr(verdicts.settings, "IPQS_FAILURE_POLICY", "closed")
+    service = verdicts.VerdictService()
+
+    verdict = asyncio.run(service.resolve("198.51.100.9", None, "ua"))
+
+    assert verdict["risk_level"] == "high"
+    assert verdict["degraded"] is True
+    cache_set.assert_not_awaited()
+
+
+def test_stale_verdict_is_served_and_refreshed(monkeypatch):
+    check_ip = AsyncMock(return_value={"success": True, "fraud_score": 10})
+    monkeypatch.setattr(verdicts.ipqs_service, "check_ip", check_ip)
+    monkeypatch.setattr(verdicts.ipqs_service, "calculate_risk_level", lambda ip_data, device_data: "low")
+    cache_set = AsyncMock()
+    monkeypatch.setattr(verdicts.cache_service, "set", cache_set)
+    service = verdicts.VerdictService()
+    stale = {"ip_address": "198.51.100.9", "risk_level": "high", "expires_at": time.time() - 1}
+
+    async def run():
+        verdict = await service.resolve("198.51.100.9", stale, "ua")
+        await asyncio.sleep(0.01)
+        return verdict
+
+    verdict = asyncio.run(run())
+
+    assert verdict is stale
+    check_ip.assert_awaited_once()
+    key, refreshed = cache_set.await_args.args[:2]
+    assert key == "ip:198.51.100.9"
+    assert refreshed["risk_level"] == "low"
+    assert refreshed["expires_at"] > time.time()
+
+
+def test_verdict_ttl_by_flag_then_risk_level(monkeypatch):
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL_JITTER", 0)
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL_BY_FLAG", {"tor": 600})
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL_BY_RISK_LEVEL", {"high": 300})
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL", 100)
+
+    assert verdicts.verdict_ttl({"risk_level": "high", "is_tor": True}) == 600
+    assert verdicts.verdict_ttl({"risk_level": "high", "is_tor": False}) == 300
+    assert verdicts.verdict_ttl({"risk_level": "low"}) == 100
+
+
+def test_verdict_ttl_jitter_stays_in_bounds(monkeypatch):
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL_JITTER", 0.1)
+    monkeypatch.setattr(verdicts.settings, "CACHE_TTL_BY_RISK_LEVEL", {"low": 1000})
+
+    ttls = {verdicts.verdict_ttl({"risk_level": "low"}) for _ in range(200)}
+
+    assert min(ttls) >= 900 and max(ttls) <= 1100
+    assert len(ttls) > 1
+
+
+def fake_cache(monkeypatch):
+    store = {}
+    ttls = {}
+
+    async def get(key, use_local=True):
+        return store.get(key)
+
+    async def set(key, value, expire=None):
+        store[key] = value
+        ttls[key] = expire
+        return True
+
+    monkeypatch.setattr(verdicts.cache_service, "get", get)
+    monkeypatch.setattr(verdicts.cache_service, "set", set)
+    monkeypatch.setattr(verdicts.cache_service, "local_get", lambda key: None)
+    return store, ttls
+
+
+def slow(result, delay):
+    async def call(*args):
+        await asyncio.sleep(delay)
+        return result
+    return AsyncMock(side_effect=call)
+
+
+def test_ip_and_device_lookups_run_concurrently(monkeypatch):
+    store, ttls = fake_cache(monkeypatch)
+    monkeypatch.setattr(verdicts.settings, "DEVICE_CACHE_TTL", 120)
+    monkeypatch.setattr(verdicts.ipqs_service, "check_ip", slow({"success": True, "fraud_score": 10}, 0.1))
+    monkeypatch.setattr(verdicts.ipqs_service, "check_device", slow({"success": True, "fraud_score": 90}, 0.1))
+    service = verdicts.VerdictService()
+
+    async def run():
+        start = time.perf_counter()
+        verdict = await service.lookup("198.51.100.9", "ua", "fp-1")
+        return verdict, time.perf_counter() - start
+
+    verdict, elapsed = asyncio.run(run())
+
+    assert elapsed < 0.18
+    assert verdict["risk_level"] == "high"
+    assert verdict["device_fingerprint"] == "fp-1"
+    # The IP verdict is cached on its own; the device result under its own key and TTL
+    cached_ip = store["ip:198.51.100.9"]
+    assert cached_ip["risk_level"] == "low" and cached_ip["device_fingerprint"] is None
+    assert store["device:fp-1"] == {"success": True, "fraud_score": 90}
+    assert ttls["device:fp-1"] == 120
+
+
+def test_slow_device_lookup_is_cut_off_at_the_deadline(monkeypatch):
+    store, _ = fake_cache(monkeypatch)
+    monkeypatch.setattr(verdicts.settings, "IPQS_LOOKUP_DEADLINE", 0.05)
+    monkeypatch.setattr(verdicts.ipqs_service, "check_ip", AsyncMock(return_value={"success": True, "fraud_score": 10}))
+    monkeypatch.setattr(verdicts.ipqs_service, "check_device", slow({"success": True, "fraud_score": 90}, 0.2))
+    service = verdicts.VerdictService()
+
+    async def run():
+        verdict = await service.lookup("198.51.100.9", "ua", "fp-1")
+        cached_before = "device:fp-1" in store
+        await asyncio.sleep(0.25)
+        return verdict, cached_before
+
+    verdict, cached_before = asyncio.run(run())
+
+    assert verdict["risk_level"] == "low"
+    assert not cached_before
+    # The late result still lands in the device cache for the next request
+    assert "device:fp-1" in store
+
+
+def test_device_cache_is_shared_by_concurrent_requests(monkeypatch):
+    fake_cache(monkeypatch)
+    check_device = slow({"success": True, "fraud_score": 60}, 0.01)
+    monkeypatch.setattr(verdicts.ipqs_service, "check_device", check_device)
+    monkeypatch.setattr(verdicts.ipqs_service, "calculate_risk_level",
+                        lambda ip_data, device_data: "medium" if device_data["fraud_score"] >= 50 else "low")
+    service = verdicts.VerdictService()
+    cached = {"ip_address": "198.51.100.9", "risk_score": 5, "risk_level": "low", "device_fingerprint": None}
+
+    async def run():
+        first = await asyncio.gather(*[service.with_device(cached, "fp-2") for _ in range(20)])
+        again = await service.with_device(cached, "fp-2")
+        return first, again
+
+    first, again = asyncio.run(run())
+
+    check_device.assert_awaited_once()
+    assert {verdict["risk_level"] for verdict in first} == {"medium"}
+    assert again["risk_level"] == "medium"
+    assert cached["risk_level"] == "low"
+
+
+def test_failed_device_lookup_is_not_cached(monkeypatch):
+    store, _ = fake_cache(monkeypatch)
+    monkeypatch.setattr(verdicts.ipqs_service, "check_device", AsyncMock(return_value={"error": "HTTP error"}))
+    service = verdicts.VerdictService()
+    cached = {"ip_address": "198.51.100.9", "risk_score": 5, "risk_level": "low"}
+
+    verdict = asyncio.run(service.with_device(cached, "fp-3"))
+
+    assert verdict["risk_level"] == "low"
+    assert "device:fp-3" not in store
+
+
+def test_cached_verdict_is_re_decided_under_a_newer_policy(monkeypatch):
+    compiled = CompiledPolicy({"rules": [{"action": "block", "tor": True}], "default": "allow"}, version=5)
+    monkeypatch.setattr(verdicts.risk_policy, "policy", compiled)
+    service = verdicts.VerdictService()
+    cached = {"ip_address": "198.51.100.9", "risk_score": 5, "is_tor": True, "risk_level": "low",
+              "policy_version": 0, "expires_at": time.time() + 60}
+
+    verdict = service.resolve_cached("198.51.100.9", cached, "ua")
+
+    assert verdict["risk_level"] == "high" and verdict["policy_version"] == 5
+    assert cached["risk_level"] == "low"
+    current = dict(cached, policy_version=5)
+    assert service.resolve_cached("198.51.100.9", current, "ua") is current
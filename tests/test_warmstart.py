@@ -0,0 +1,100 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from app.services import warmstart
+
+
+def audit_row(ip, minutes_ago, score=10, source="ipqs", **flags):
+    return {"ip_address": ip, "risk_score": score, "is_proxy": flags.get("proxy", False),
+            "is_vpn": flags.get("vpn", False), "is_tor": flags.get("tor", False), "country_code": "US",
+            "city": None, "action_taken": "low", "verdict_source": source, "request_path": "/login",
+            "user_agent": "test-agent", "timestamp": datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)}
+
+
+@pytest.fixture
+def fake_service(fake_cache, monkeypatch):
+    monkeypatch.setattr(warmstart, "cache_service", fake_cache)
+    monkeypatch.setattr(warmstart.settings, "CACHE_TTL_JITTER", 0.0)
+    return fake_cache
+
+
+def test_reconcile_restores_whitelist_and_purges_expired_rows(run_with_db, fake_service):
+    now = datetime.now(timezone.utc)
+    table = warmstart.WhitelistedIP.__table__
+
+    async def body(db):
+        await db.execute_many(table.insert(), [
+            {"ip_address": "192.0.2.1", "expires_at": now + timedelta(hours=1)},
+            {"ip_address": "192.0.2.2", "expires_at": now - timedelta(minutes=1)},
+        ])
+        counts = await warmstart.CacheWarmer().reconcile()
+        remaining = [row["ip_address"] for row in await db.fetch_all(table.select())]
+        return counts, remaining, await fake_service.redis.ttl("whitelist:192.0.2.1")
+
+    counts, remaining, ttl = run_with_db(body, warmstart)
+
+    assert counts == {"whitelist": 1, "verdicts": 0, "purged": 1}
+    assert remaining == ["192.0.2.1"]
+    assert 3590 <= ttl <= 3600
+
+    async def check():
+        return await fake_service.is_whitelisted("192.0.2.1"), await fake_service.is_whitelisted("192.0.2.2")
+
+    assert asyncio.run(check()) == (True, False)
+
+
+def test_verdicts_are_warmed_from_latest_audit_rows(run_with_db, monkeypatch, fake_service):
+    monkeypatch.setattr(warmstart.settings, "WARM_START_REVALIDATE_RATE", 1000.0)
+    refreshed = []
+    monkeypatch.setattr(warmstart.verdict_service, "refresh_in_background",
+                        lambda ip, user_agent, request_path="": refreshed.append(ip))
+
+    async def body(db):
+        await fake_service.redis.set("ip:192.0.2.4", json.dumps({"ip_address": "192.0.2.4", "risk_score": 5}))
+        await db.execute_many(warmstart.AuditLog.__table__.insert(), [
+            audit_row("192.0.2.1", 200, score=10),
+            audit_row("192.0.2.1", 5, score=95),  # latest row for .1 wins
+            audit_row("192.0.2.2", 120, score=20),  # past its one-hour TTL
+            audit_row("192.0.2.3", 1, score=100, source="fallback"),
+            audit_row("192.0.2.6", 1, score=90, source="subnet"),  # borrowed from its /24
+            audit_row("192.0.2.7", 1, score=0, source="local"),
+            audit_row("192.0.2.8", 1, score=10, source="device"),
+            audit_row("192.0.2.4", 1, score=50),  # already cached
+            audit_row("192.0.2.5", 60 * 12, score=10),  # outside the lookback
+        ])
+        warmer = warmstart.CacheWarmer()
+        counts = await warmer.reconcile()
+        await warmer._revalidate_task
+        again = await warmer.reconcile()
+        values = await fake_service.redis.mget([f"ip:192.0.2.{n}" for n in range(1, 9)])
+        return counts, again, [json.loads(value) if value else None for value in values]
+
+    clock = time.time()
+    counts, again, cached = run_with_db(body, warmstart)
+
+    assert counts["verdicts"] == 2 and again["verdicts"] == 0
+    first, second, fallback, existing, outside, *borrowed = cached
+    assert (first["risk_score"], first["risk_level"]) == (95, "high")
+    assert first["expires_at"] == pytest.approx(clock - 300 + 21600, abs=5)
+    # Stale: kept fresh until its turn to be revalidated, then handed to IPQS
+    assert second["risk_level"] == "low" and clock < second["expires_at"] < clock + 5
+    assert refreshed == ["192.0.2.2"]
+    assert fallback is None and outside is None and borrowed == [None, None, None]
+    assert existing == {"ip_address": "192.0.2.4", "risk_score": 5}
+    assert fake_service.local_get("ip:192.0.2.1")["risk_score"] == 95
+
+
+def test_fill_writes_only_missing_keys(fake_service):
+    async def run():
+        await fake_service.redis.set("a", json.dumps(1))
+        written = await fake_service.fill([("a", 2, 60), ("b", 3, 60), ("c", 4, 0.5)], batch=2)
+        return written, await fake_service.redis.mget(["a", "b", "c"]), await fake_service.redis.ttl("c")
+
+    written, values, ttl = asyncio.run(run())
+
+    assert written == ["b", "c"]
+    assert values == ["1", "3", "4"]
+    assert ttl == 1